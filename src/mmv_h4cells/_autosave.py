@@ -0,0 +1,146 @@
+import itertools
+import numpy as np
+from typing import Dict, List, Optional, Set, Tuple
+
+from mmv_h4cells._undo import UndoEntry
+
+# interval of the autosave of the widget in milliseconds
+AUTOSAVE_INTERVAL_MS = 2 * 60 * 1000
+
+
+class SessionChanges:
+    """
+    Parts of a session that changed since it was last saved
+
+    Label images are tracked by the zarr chunks the evaluation wrote to,
+    the metric data and the undo stack by the amount of leading rows and
+    entries that are still the same as in the saved session. Everything
+    past those is appended on the next save.
+    """
+
+    def __init__(
+        self,
+        chunk_shape: Tuple[int, ...],
+        undo_start: int = 0,
+        metric_start: int = 0,
+    ):
+        self.chunk_shape = chunk_shape  # chunk shape of the label images
+        self.chunks: Set[Tuple[int, ...]] = (
+            set()
+        )  # grid positions of the changed chunks
+        self.undo_start = undo_start  # amount of unchanged undo entries
+        self.metric_start = metric_start  # amount of unchanged metric rows
+
+    def mark_region(self, region: Optional[Tuple[slice, ...]]):
+        """
+        Marks all chunks intersecting a region as changed
+
+        Parameters
+        ----------
+        region : tuple of slice or None
+            Region of the label images, None if nothing was written
+        """
+        if region is None:
+            return
+        ranges = [
+            range(s.start // size, -(-s.stop // size))
+            for s, size in zip(region, self.chunk_shape)
+        ]
+        self.chunks.update(itertools.product(*ranges))
+
+    def mark_undo(self, length: int):
+        """Marks the undo entries from `length` on as changed"""
+        self.undo_start = min(self.undo_start, length)
+
+    def mark_metric(self, index: int):
+        """Marks the metric rows from `index` on as changed"""
+        self.metric_start = min(self.metric_start, index)
+
+    def merge(self, other: "SessionChanges"):
+        """Adds the changes of a save that failed"""
+        self.chunks |= other.chunks
+        self.undo_start = min(self.undo_start, other.undo_start)
+        self.metric_start = min(self.metric_start, other.metric_start)
+
+    def pending(self, undo_length: int, metric_length: int) -> bool:
+        """
+        Returns whether there is anything to save
+
+        Parameters
+        ----------
+        undo_length : int
+            Current amount of undo entries
+        metric_length : int
+            Current amount of metric rows
+
+        Returns
+        -------
+        bool
+            Whether the session differs from the saved one
+        """
+        return (
+            len(self.chunks) > 0
+            or undo_length != self.undo_start
+            or metric_length != self.metric_start
+        )
+
+    def chunk_region(
+        self, chunk: Tuple[int, ...], shape: Tuple[int, ...]
+    ) -> Tuple[slice, ...]:
+        """
+        Returns the region of the label images covered by a chunk
+
+        Parameters
+        ----------
+        chunk : tuple of int
+            Grid position of the chunk
+        shape : tuple of int
+            Shape of the label images, chunks at the border are clipped
+
+        Returns
+        -------
+        tuple of slice
+            Region of the chunk
+        """
+        return tuple(
+            slice(i * size, min((i + 1) * size, length))
+            for i, size, length in zip(chunk, self.chunk_shape, shape)
+        )
+
+
+class SessionUpdate:
+    """
+    Snapshot of the changes of a session, written by `update_zarr`
+
+    The snapshot holds copies of the changed chunks and references to the
+    new rows and entries, so it can be written on another thread while the
+    evaluation goes on.
+    """
+
+    def __init__(
+        self,
+        changes: SessionChanges,
+        label_chunks: Dict[str, List[Tuple[Tuple[slice, ...], np.ndarray]]],
+        metric_rows: List[Tuple[int, int, Tuple[int, int]]],
+        metrics: Tuple[float, float],
+        undo_entries: List[UndoEntry],
+        redo_entries: List[UndoEntry],
+        selfdrawn_lower_bound: int,
+        generation: int,
+    ):
+        self.changes = changes  # changes the snapshot was taken of
+        self.label_chunks = (
+            label_chunks  # regions and values of the changed chunks by name
+        )
+        self.metric_rows = metric_rows  # metric rows past the unchanged ones
+        self.metrics = metrics  # mean and standard deviation of the sizes
+        self.undo_entries = (
+            undo_entries  # undo entries past the unchanged ones
+        )
+        self.redo_entries = redo_entries  # all undone entries
+        self.selfdrawn_lower_bound = (
+            selfdrawn_lower_bound  # lowest id of self drawn cells
+        )
+        self.generation = (
+            generation  # export the changes are relative to, see the session
+        )
@@ -0,0 +1,137 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+from mmv_h4cells._label_index import (
+    LabelIndex,
+    crop_region,
+    store_region,
+)
+
+
+class CellStore:
+    """
+    Label image of evaluated cells that remembers where each cell is
+
+    Cells are written to and removed from the label image through their
+    bounding box only, so the cost of an update depends on the size of the
+    cell instead of the size of the image.
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        regions: Dict[int, Tuple[slice, ...]] = None,
+    ):
+        self.data = data  # label image of all cells in the store
+        self.regions: Dict[int, Tuple[slice, ...]] = (
+            {} if regions is None else regions
+        )  # bounding box of every cell in the store
+
+    @classmethod
+    def from_array(cls, data: np.ndarray) -> "CellStore":
+        """
+        Creates a store for a label image that may already contain cells
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Label image
+
+        Returns
+        -------
+        CellStore
+            Store holding all cells of the label image
+        """
+        index = LabelIndex.from_array(data)
+        regions = {int(id_): index.bbox(id_) for id_ in index.ids}
+        return cls(data, regions)
+
+    def __contains__(self, id_: int) -> bool:
+        return id_ in self.regions
+
+    def __len__(self) -> int:
+        return len(self.regions)
+
+    def add(
+        self,
+        id_: int,
+        region: Tuple[slice, ...],
+        mask: np.ndarray,
+        crop: bool = True,
+    ):
+        """
+        Writes a cell into the label image
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+        region : tuple of slice
+            Region of the label image covered by the mask
+        mask : np.ndarray
+            Boolean mask of the cell within the region
+        crop : bool, optional
+            Whether to crop the region to the bounding box of the mask, by
+            default True. Can be skipped if the region is the bounding box.
+        """
+        if crop:
+            cropped = crop_region(region, mask)
+            if cropped is None:
+                return
+            region, mask = cropped
+        view = self.data[region]
+        view[mask] = id_
+        store_region(self.data, region, view)
+        if id_ in self.regions:
+            region = tuple(
+                slice(min(old.start, new.start), max(old.stop, new.stop))
+                for old, new in zip(self.regions[id_], region)
+            )
+        self.regions[id_] = region
+
+    def get(self, id_: int) -> Optional[Tuple[Tuple[slice, ...], np.ndarray]]:
+        """
+        Returns the bounding box of a cell and its mask within that box
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+
+        Returns
+        -------
+        tuple or None
+            Slices of the bounding box and boolean mask of the cell inside
+            it, None if the cell is not in the store
+        """
+        region = self.regions.get(id_)
+        if region is None:
+            return None
+        return region, np.asarray(self.data[region]) == id_
+
+    def remove(
+        self, id_: int
+    ) -> Optional[Tuple[Tuple[slice, ...], np.ndarray]]:
+        """
+        Removes a cell from the label image
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+
+        Returns
+        -------
+        tuple or None
+            Slices of the bounding box and boolean mask of the removed cell
+            inside it, None if the cell was not in the store
+        """
+        cell = self.get(id_)
+        if cell is None:
+            return None
+        region, mask = cell
+        view = self.data[region]
+        view[mask] = 0
+        store_region(self.data, region, view)
+        del self.regions[id_]
+        return region, mask
@@ -0,0 +1,305 @@
+import argparse
+import glob
+import numpy as np
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from mmv_h4cells._reader import read_tiff
+from mmv_h4cells._roi import (
+    ROI_FEATURES,
+    iter_roi_tiles,
+    roi_metrics,
+    roi_statistics,
+)
+from mmv_h4cells._writer import (
+    TIFF_TILE_SIZE,
+    label_dtype,
+    write_csv,
+    write_parquet,
+    write_tiff_tiles,
+    write_zarr,
+)
+
+# suffix of the stem of all files written for an input file
+OUTPUT_SUFFIX = "_analysis"
+
+# file extensions of label images in input directories
+LABEL_EXTENSIONS = (".tif", ".tiff")
+
+
+def find_label_files(inputs: Sequence[str]) -> List[Path]:
+    """
+    Collects the label images given as files, directories or glob patterns
+
+    Files written by a previous run are left out, so a directory can be
+    analysed again in place.
+
+    Parameters
+    ----------
+    inputs : sequence of str
+        Paths of files or directories, or glob patterns
+
+    Returns
+    -------
+    list of Path
+        Sorted label images without duplicates
+    """
+    files = set()
+    for entry in inputs:
+        path = Path(entry)
+        if path.is_dir():
+            candidates = path.iterdir()
+        elif path.is_file():
+            candidates = [path]
+        else:
+            candidates = [Path(match) for match in glob.glob(entry)]
+        for candidate in candidates:
+            if (
+                candidate.is_file()
+                and candidate.suffix.lower() in LABEL_EXTENSIONS
+                and not candidate.stem.endswith(OUTPUT_SUFFIX)
+            ):
+                files.add(candidate)
+    return sorted(files)
+
+
+def analyse_file(
+    path: Path,
+    output: Optional[Path],
+    size_threshold: int = 0,
+    roi: Optional[Tuple[int, int, int, int]] = None,
+    features: Sequence[str] = (),
+    session: bool = False,
+    parquet: bool = False,
+) -> dict:
+    """
+    Computes the cell statistics of a label image and writes the results
+
+    Writes `<stem>_analysis.csv` with one row per cell and
+    `<stem>_analysis.tiff` with the labels of the kept cells, like the ROI
+    export of the widget. The zarr session holds all kept cells as included,
+    so it can be imported into the widget to continue the evaluation.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the label image
+    output : Path, optional
+        Directory of the results, by default the directory of the image
+    size_threshold : int, optional
+        Cells with at most this amount of pixels are left out, by default 0
+    roi : tuple of int, optional
+        Lower and upper row and lower and upper column of the analysed
+        region, -1 as upper bound extends to the image border, by default
+        the whole image
+    features : sequence of str, optional
+        Extra features to compute, keys of ROI_FEATURES, by default none
+    session : bool, optional
+        Whether to write a zarr session, by default False
+    parquet : bool, optional
+        Whether to also write the cells as `<stem>_analysis.parquet` result
+        table, see write_parquet, by default False
+
+    Returns
+    -------
+    dict
+        Path, amount of cells and pixels and runtime of the file
+    """
+    start = time.perf_counter()
+    path = Path(path)
+    output = path.parent if output is None else Path(output)
+    stem = output / (path.stem + OUTPUT_SUFFIX)
+    labels = read_tiff(path)
+    if roi is None:
+        roi = (0, -1, 0, -1)
+    y = (roi[0], labels.shape[0] if roi[1] == -1 else roi[1])
+    x = (roi[2], labels.shape[1] if roi[3] == -1 else roi[3])
+
+    df, cropped = roi_statistics(labels, y, x, size_threshold, features)
+    metrics = roi_metrics(df, size_threshold)
+    write_csv(
+        stem.with_suffix(".csv"),
+        df,
+        metrics,
+        list(df.columns[3:]),
+    )
+    if parquet:
+        write_parquet(
+            stem.with_suffix(".parquet"), df, metrics, list(df.columns[3:])
+        )
+    ids = df["id"].to_numpy()
+    tiles = iter_roi_tiles(cropped, ids, TIFF_TILE_SIZE)
+    dtype = label_dtype(int(ids.max(initial=0)))
+    write_tiff_tiles(stem.with_suffix(".tiff"), cropped.shape, dtype, tiles)
+    if session:
+        accepted = np.zeros_like(labels)
+        accepted[y[0] : y[1], x[0] : x[1]] = np.where(
+            np.isin(cropped, ids), cropped, 0
+        )
+        write_zarr(
+            stem.with_suffix(".zarr"),
+            labels,
+            accepted,
+            np.zeros_like(labels),
+            list(
+                df[["id", "count [px]", "centroid (y,x)"]].itertuples(
+                    index=False, name=None
+                )
+            ),
+            metrics[:2],
+            ids.tolist(),
+            int(labels.max()) + 1,
+        )
+    return {
+        "file": str(path),
+        "cells": len(df),
+        "pixels": cropped.size,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def analyse_files(
+    files: Sequence[Path],
+    output: Optional[Path] = None,
+    jobs: int = 1,
+    **kwargs,
+) -> List[dict]:
+    """
+    Analyses label images in parallel worker processes
+
+    Parameters
+    ----------
+    files : sequence of Path
+        Paths of the label images
+    output : Path, optional
+        Directory of the results, by default the directory of each image
+    jobs : int, optional
+        Amount of worker processes, 1 analyses the files in this process,
+        by default 1
+    **kwargs
+        Options passed on to analyse_file
+
+    Returns
+    -------
+    list of dict
+        Result of each file in the order of the files
+    """
+    if output is not None:
+        Path(output).mkdir(parents=True, exist_ok=True)
+    if jobs == 1 or len(files) < 2:
+        return [analyse_file(path, output, **kwargs) for path in files]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as executor:
+        futures = [
+            executor.submit(analyse_file, path, output, **kwargs)
+            for path in files
+        ]
+        return [future.result() for future in futures]
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="mmv-h4cells",
+        description="Batch analysis of label images without napari",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    analyse = subparsers.add_parser(
+        "analyse",
+        help="compute cell sizes and centroids of label images",
+        description="Computes size and centroid of all cells of label "
+        "images and writes a csv and tiff file per image.",
+    )
+    analyse.add_argument(
+        "inputs",
+        nargs="+",
+        help="label tiff files, directories or glob patterns",
+    )
+    analyse.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help="directory of the results, by default next to each image",
+    )
+    analyse.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="amount of worker processes (default: amount of CPUs)",
+    )
+    analyse.add_argument(
+        "-t",
+        "--threshold",
+        type=int,
+        default=0,
+        help="leave out cells with at most this many pixels (default: 0)",
+    )
+    analyse.add_argument(
+        "--roi",
+        type=int,
+        nargs=4,
+        metavar=("Y0", "Y1", "X0", "X1"),
+        help="only analyse this region, -1 as upper bound extends to the "
+        "image border",
+    )
+    analyse.add_argument(
+        "--features",
+        nargs="+",
+        default=[],
+        choices=[key for key in ROI_FEATURES if key != "mean_intensity"],
+        help="additional per-cell features",
+    )
+    analyse.add_argument(
+        "--zarr",
+        action="store_true",
+        help="also write a session that can be imported into the widget",
+    )
+    analyse.add_argument(
+        "--parquet",
+        action="store_true",
+        help="also write a parquet result table per image (needs pyarrow)",
+    )
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = create_parser().parse_args(argv)
+    if args.jobs < 1:
+        print("--jobs must be at least 1", file=sys.stderr)
+        return 2
+    files = find_label_files(args.inputs)
+    if len(files) == 0:
+        print("No label images found", file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    results = analyse_files(
+        files,
+        args.output,
+        args.jobs,
+        size_threshold=args.threshold,
+        roi=args.roi,
+        features=args.features,
+        session=args.zarr,
+        parquet=args.parquet,
+    )
+    seconds = time.perf_counter() - start
+    for result in results:
+        print(
+            f"{result['file']}: {result['cells']} cells "
+            f"in {result['seconds']:.2f} s"
+        )
+    cells = sum(result["cells"] for result in results)
+    # analyse_files starts no more workers than there are files
+    jobs = 1 if len(files) < 2 else min(args.jobs, len(files))
+    print(
+        f"{len(results)} files, {cells} cells in {seconds:.2f} s "
+        f"({len(results) / seconds:.2f} files/s, {jobs} jobs)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
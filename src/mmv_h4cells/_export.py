@@ -0,0 +1,328 @@
+import copy
+import itertools
+import numpy as np
+import os
+import shutil
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from mmv_h4cells._autosave import SessionChanges
+from mmv_h4cells._metric_table import MetricTable
+from mmv_h4cells._undo import UndoStack
+from mmv_h4cells._writer import (
+    ZARR_LABEL_IMAGES,
+    write_csv,
+    write_tiff,
+    write_zarr,
+)
+
+# interval in seconds in which a running export reports its progress
+EXPORT_PROGRESS_INTERVAL = 0.1
+
+# amount of label images read by an export, the accepted cells are read
+# twice for the tiff file and all three label images for the zarr session
+EXPORT_READS = 5
+
+# suffix of the files an export writes before moving them into place
+PARTIAL_SUFFIX = ".partial"
+
+
+class ExportCancelled(Exception):
+    """Raised by the reads of an export that was cancelled"""
+
+
+class ArraySnapshot:
+    """
+    Read-only view of a label image as it was when the snapshot was taken
+
+    Nothing is copied when the snapshot is taken. Before a region of the
+    label image is edited, `preserve` copies the chunks intersecting it, and
+    reads of the snapshot put those copies over the edited pixels. Only the
+    chunks edited while the snapshot is in use are held in memory.
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        chunks: Tuple[int, ...],
+        on_read: Callable[[int], None] = None,
+    ):
+        self.data = data  # label image the snapshot was taken of
+        self.chunks = tuple(chunks)  # edge lengths of the preserved chunks
+        self.on_read = on_read  # called with the amount of pixels read
+        self.saved: Dict[Tuple[int, ...], np.ndarray] = (
+            {}
+        )  # original values of the edited chunks by grid position
+        self.lock = threading.Lock()  # orders reads and preserves
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.data.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.data.dtype
+
+    @property
+    def ndim(self) -> int:
+        return len(self.data.shape)
+
+    def _region(self, index) -> Tuple[slice, ...]:
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > self.ndim or not all(
+            isinstance(s, slice) and s.step in (None, 1) for s in index
+        ):
+            raise TypeError("snapshots are read by contiguous slices")
+        index = index + (slice(None),) * (self.ndim - len(index))
+        return tuple(
+            slice(*s.indices(length)[:2])
+            for s, length in zip(index, self.shape)
+        )
+
+    def _grid(self, region: Tuple[slice, ...]) -> Iterator[Tuple[int, ...]]:
+        ranges = [
+            range(s.start // size, -(-s.stop // size))
+            for s, size in zip(region, self.chunks)
+        ]
+        return itertools.product(*ranges)
+
+    def _chunk_region(self, chunk: Tuple[int, ...]) -> Tuple[slice, ...]:
+        return tuple(
+            slice(i * size, min((i + 1) * size, length))
+            for i, size, length in zip(chunk, self.chunks, self.shape)
+        )
+
+    def preserve(self, region: Tuple[slice, ...]):
+        """
+        Copies the chunks of a region that is about to be edited
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the label image, chunks already copied are kept
+        """
+        with self.lock:
+            for chunk in self._grid(region):
+                if chunk not in self.saved:
+                    self.saved[chunk] = np.array(
+                        self.data[self._chunk_region(chunk)]
+                    )
+
+    def __getitem__(self, index) -> np.ndarray:
+        region = self._region(index)
+        with self.lock:
+            values = np.array(self.data[region])
+            for chunk in self._grid(region):
+                saved = self.saved.get(chunk)
+                if saved is None:
+                    continue
+                chunk_region = self._chunk_region(chunk)
+                overlap = tuple(
+                    slice(max(a.start, b.start), min(a.stop, b.stop))
+                    for a, b in zip(region, chunk_region)
+                )
+                values[
+                    tuple(
+                        slice(s.start - r.start, s.stop - r.start)
+                        for s, r in zip(overlap, region)
+                    )
+                ] = saved[
+                    tuple(
+                        slice(s.start - c.start, s.stop - c.start)
+                        for s, c in zip(overlap, chunk_region)
+                    )
+                ]
+        if self.on_read is not None:
+            self.on_read(values.size)
+        return values
+
+
+class SessionExport:
+    """
+    Snapshot of a session written to csv, tiff and zarr in the background
+
+    The label images are snapshotted with ArraySnapshot and the metric data
+    and undo journal are copied, so the evaluation can go on while the
+    snapshot is written. The three files are written concurrently to
+    temporary paths and only moved into place by `commit`, a cancelled or
+    failed export leaves the previous export untouched.
+    """
+
+    def __init__(
+        self,
+        labels: np.ndarray,
+        accepted_cells: np.ndarray,
+        rejected_cells: np.ndarray,
+        metric_data: MetricTable,
+        metrics: Tuple[float, float],
+        undo_stack: UndoStack,
+        selfdrawn_lower_bound: int,
+        changes: SessionChanges,
+    ):
+        self.arrays: Dict[str, ArraySnapshot] = {
+            name: ArraySnapshot(data, changes.chunk_shape, self.count_read)
+            for name, data in zip(
+                ZARR_LABEL_IMAGES, (labels, accepted_cells, rejected_cells)
+            )
+        }  # snapshots of the label images by name
+        self.metric_data = MetricTable.from_array(
+            metric_data.to_array()
+        )  # copy of the metric data
+        self.metrics = metrics  # mean and standard deviation of the sizes
+        self.undo_stack = UndoStack(
+            [copy.copy(entry) for entry in undo_stack.entries],
+            undo_stack.max_bytes,
+        )  # copy of the undo journal
+        self.undo_stack.redo_entries = [
+            copy.copy(entry) for entry in undo_stack.redo_entries
+        ]
+        self.selfdrawn_lower_bound = (
+            selfdrawn_lower_bound  # lowest id of self drawn cells
+        )
+        self.changes = changes  # unsaved changes when the export started
+        self.csv_filepath: Path = None  # path of the csv file, set by run
+        self.total = max(
+            EXPORT_READS * int(np.prod(labels.shape)), 1
+        )  # amount of pixels read by the export
+        self.read = 0  # amount of pixels read so far
+        self.cancelled = threading.Event()  # set to stop the export
+        self.lock = threading.Lock()  # guards read
+
+    @property
+    def paths(self) -> List[Tuple[Path, Path]]:
+        """Temporary and final paths of the csv, tiff and zarr files"""
+        return [
+            (path.with_name(path.name + PARTIAL_SUFFIX), path)
+            for path in (
+                self.csv_filepath,
+                self.csv_filepath.with_suffix(".tiff"),
+                self.csv_filepath.with_suffix(".zarr"),
+            )
+        ]
+
+    def preserve(self, region: Tuple[slice, ...]):
+        """
+        Keeps a region of all label images before it is edited
+
+        Parameters
+        ----------
+        region : tuple of slice or None
+            Region about to be edited, None if nothing is edited
+        """
+        if region is None:
+            return
+        for array in self.arrays.values():
+            array.preserve(region)
+
+    def count_read(self, pixels: int):
+        """Adds read pixels to the progress, stops a cancelled export"""
+        if self.cancelled.is_set():
+            raise ExportCancelled("Export cancelled")
+        with self.lock:
+            self.read += pixels
+
+    def progress(self) -> float:
+        """Returns the fraction of the export done"""
+        with self.lock:
+            return min(self.read / self.total, 1.0)
+
+    def cancel(self):
+        """Stops the export at the next read of a label image"""
+        self.cancelled.set()
+
+    def run(self, csv_filepath: Path) -> Iterator[float]:
+        """
+        Writes the csv, tiff and zarr files to temporary paths
+
+        Each file is written on its own thread. While they are written, the
+        progress is yielded every EXPORT_PROGRESS_INTERVAL seconds.
+
+        Parameters
+        ----------
+        csv_filepath : Path
+            Path of the csv file, the tiff and zarr files are written next
+            to it
+
+        Yields
+        ------
+        float
+            Fraction of the export done
+
+        Raises
+        ------
+        ExportCancelled
+            If the export was cancelled
+        """
+        self.csv_filepath = Path(csv_filepath)
+        (csv_path, _), (tiff_path, _), (zarr_path, _) = self.paths
+        self.discard()
+        with ThreadPoolExecutor(
+            max_workers=3, thread_name_prefix="export"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    write_csv,
+                    csv_path,
+                    self.metric_data,
+                    (*self.metrics, 0),
+                    compression=(
+                        "gzip" if self.csv_filepath.suffix == ".gz" else None
+                    ),
+                ),
+                executor.submit(
+                    write_tiff, tiff_path, self.arrays["accepted_cells"]
+                ),
+                executor.submit(
+                    write_zarr,
+                    zarr_path,
+                    *self.arrays.values(),
+                    self.metric_data,
+                    self.metrics,
+                    self.undo_stack,
+                    self.selfdrawn_lower_bound,
+                ),
+            ]
+            try:
+                while True:
+                    done, pending = wait(
+                        futures,
+                        timeout=EXPORT_PROGRESS_INTERVAL,
+                        return_when=FIRST_EXCEPTION,
+                    )
+                    if not pending or any(
+                        future.exception() is not None for future in done
+                    ):
+                        break
+                    yield self.progress()
+            finally:
+                # a failed file or a closed generator stops the other files
+                if any(not future.done() for future in futures):
+                    self.cancel()
+        for future in futures:
+            future.result()
+        yield 1.0
+
+    def write(self, csv_filepath: Path):
+        """Writes the files like `run` without reporting progress"""
+        for _ in self.run(csv_filepath):
+            pass
+
+    def commit(self):
+        """Replaces the previous export with the written files"""
+        for partial, path in self.paths:
+            if partial.is_dir() and path.exists():
+                shutil.rmtree(path)
+            os.replace(partial, path)
+
+    def discard(self):
+        """Removes the files written by a cancelled or failed export"""
+        if self.csv_filepath is None:
+            return
+        for partial, _ in self.paths:
+            if partial.is_dir():
+                shutil.rmtree(partial)
+            elif partial.exists():
+                partial.unlink()
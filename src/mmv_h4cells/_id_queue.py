@@ -0,0 +1,93 @@
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import MutableSet
+from typing import Iterable, Iterator, Optional
+
+
+class IdQueue(MutableSet):
+    """
+    Set of cell ids kept in ascending order
+
+    Membership tests and lookups of the neighbouring ids of a given id use
+    binary search, so navigating between cells stays O(log n) regardless of
+    the amount of remaining cells.
+    """
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.ids = sorted(
+            {int(id_) for id_ in ids}
+        )  # ascending ids without duplicates
+
+    def __contains__(self, id_) -> bool:
+        try:
+            id_ = int(id_)
+        except (TypeError, ValueError):
+            return False
+        position = bisect_left(self.ids, id_)
+        return position < len(self.ids) and self.ids[position] == id_
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.ids})"
+
+    def add(self, id_: int):
+        """Adds an id if it is not present yet"""
+        if id_ not in self:
+            insort(self.ids, int(id_))
+
+    def discard(self, id_: int):
+        """Removes an id if it is present"""
+        if id_ in self:
+            del self.ids[bisect_left(self.ids, int(id_))]
+
+    def remove(self, id_: int):
+        """Removes an id, raises KeyError if it is not present"""
+        if id_ not in self:
+            raise KeyError(id_)
+        self.discard(id_)
+
+    def lowest(self) -> Optional[int]:
+        """Returns the lowest id, None if the queue is empty"""
+        return self.ids[0] if self.ids else None
+
+    def highest(self) -> Optional[int]:
+        """Returns the highest id, None if the queue is empty"""
+        return self.ids[-1] if self.ids else None
+
+    def next_higher(self, id_: int) -> Optional[int]:
+        """
+        Returns the lowest id that is greater than the given id
+
+        Parameters
+        ----------
+        id_ : int
+            Reference id, does not need to be in the queue
+
+        Returns
+        -------
+        int or None
+            Next higher id, None if there is none
+        """
+        position = bisect_right(self.ids, id_)
+        return self.ids[position] if position < len(self.ids) else None
+
+    def next_lower(self, id_: int) -> Optional[int]:
+        """
+        Returns the highest id that is less than the given id
+
+        Parameters
+        ----------
+        id_ : int
+            Reference id, does not need to be in the queue
+
+        Returns
+        -------
+        int or None
+            Next lower id, None if there is none
+        """
+        position = bisect_left(self.ids, id_)
+        return self.ids[position - 1] if position > 0 else None
@@ -0,0 +1,762 @@
+import itertools
+import numpy as np
+import os
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection, List, Optional, Sequence, Tuple
+
+# amount of pixels processed at once while building the index
+BLOCK_PIXELS = 2**24
+
+# amount of threads reading blocks of label images in parallel
+INDEX_WORKERS = min(os.cpu_count() or 1, 8)
+
+# labels of a block are counted with np.bincount over their id range if the
+# range is at most this many times the amount of labeled pixels, otherwise
+# they are factorized with a hash table first
+DENSE_ID_FACTOR = 4
+
+
+def bbox_to_slices(lower: np.ndarray, upper: np.ndarray) -> Tuple[slice, ...]:
+    """
+    Converts lower and upper corners of a bounding box to a tuple of slices
+
+    Parameters
+    ----------
+    lower : np.ndarray
+        Inclusive lower corner of the bounding box
+    upper : np.ndarray
+        Exclusive upper corner of the bounding box
+
+    Returns
+    -------
+    tuple of slice
+        Slices selecting the bounding box
+    """
+    return tuple(slice(int(lo), int(up)) for lo, up in zip(lower, upper))
+
+
+def full_region(shape: Tuple[int, ...]) -> Tuple[slice, ...]:
+    """
+    Returns slices selecting a whole array of the given shape
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the array
+
+    Returns
+    -------
+    tuple of slice
+        Slices selecting the whole array
+    """
+    return tuple(slice(0, size) for size in shape)
+
+
+def crop_region(
+    slices: Tuple[slice, ...], data: np.ndarray
+) -> Optional[Tuple[Tuple[slice, ...], np.ndarray]]:
+    """
+    Shrinks a region to the bounding box of the nonzero values of an array
+
+    Parameters
+    ----------
+    slices : tuple of slice
+        Region of an image, all slices must have explicit starts
+    data : np.ndarray
+        Array covering the region
+
+    Returns
+    -------
+    tuple or None
+        Slices of the shrunk region and the array cropped to it, None if the
+        array is empty
+    """
+    bbox = mask_bbox(data)
+    if bbox is None:
+        return None
+    cropped = tuple(
+        slice(outer.start + inner.start, outer.start + inner.stop)
+        for outer, inner in zip(slices, bbox)
+    )
+    return cropped, data[bbox]
+
+
+def store_region(
+    data: np.ndarray, region: Tuple[slice, ...], values: np.ndarray
+):
+    """
+    Writes an edited region of a label image back into the image
+
+    Regions of NumPy arrays are views, so their edits are already part of
+    the image. Regions of lazily opened zarr arrays are copies and have to
+    be written back.
+
+    Parameters
+    ----------
+    data : np.ndarray or zarr.Array
+        Label image
+    region : tuple of slice
+        Region of the image
+    values : np.ndarray
+        Edited values of the region
+    """
+    if not isinstance(data, np.ndarray):
+        data[region] = values
+
+
+def mask_bbox(mask: np.ndarray) -> Optional[Tuple[slice, ...]]:
+    """
+    Returns the bounding box of the nonzero values of an array
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Array to compute the bounding box for
+
+    Returns
+    -------
+    tuple of slice or None
+        Slices selecting the bounding box or None if the array is empty
+    """
+    slices = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(i for i in range(mask.ndim) if i != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other_axes))
+        if len(indices) == 0:
+            return None
+        slices.append(slice(int(indices[0]), int(indices[-1]) + 1))
+    return tuple(slices)
+
+
+def edited_region(
+    atoms: Sequence, shape: Tuple[int, ...]
+) -> Optional[Tuple[slice, ...]]:
+    """
+    Returns the bounding box of the edits of a napari paint event
+
+    Parameters
+    ----------
+    atoms : sequence
+        History atoms of the paint event, either masked paint atoms with a
+        `slice_key` or tuples of indices, old values and new values
+    shape : tuple of int
+        Shape of the painted label image, the box is clipped to it
+
+    Returns
+    -------
+    tuple of slice or None
+        Slices selecting the edited pixels, None if no pixel was edited
+    """
+    lower = np.array(shape, dtype=np.int64)
+    upper = np.zeros(len(shape), dtype=np.int64)
+    for atom in atoms:
+        slice_key = getattr(atom, "slice_key", None)
+        if slice_key is not None:
+            atom_lower = [s.start or 0 for s in slice_key]
+            atom_upper = [
+                length if s.stop is None else s.stop
+                for s, length in zip(slice_key, shape)
+            ]
+        else:
+            indices = [np.asarray(index) for index in atom[0]]
+            if len(indices) == 0 or indices[0].size == 0:
+                continue
+            atom_lower = [int(index.min()) for index in indices]
+            atom_upper = [int(index.max()) + 1 for index in indices]
+        lower = np.minimum(lower, atom_lower)
+        upper = np.maximum(upper, atom_upper)
+    lower = np.maximum(lower, 0)
+    upper = np.minimum(upper, shape)
+    if np.any(lower >= upper):
+        return None
+    return bbox_to_slices(lower, upper)
+
+
+def find_overlap(
+    cell: np.ndarray, labels: np.ndarray, cell_id: int
+) -> np.ndarray:
+    """
+    Returns the pixels where a cell covers labels of other cells
+
+    Parameters
+    ----------
+    cell : np.ndarray
+        Labels of the cell
+    labels : np.ndarray
+        Labels of all cells in the same region as `cell`
+    cell_id : int
+        Id of the cell, pixels of `labels` with this id are no overlap
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the overlapping pixels
+    """
+    overlap = cell != 0
+    overlap &= labels != 0
+    overlap &= labels != cell_id
+    return overlap
+
+
+def _group_by_label(
+    labels: np.ndarray, coords: Tuple[np.ndarray, ...], counts: np.ndarray
+):
+    """
+    Reduces per-pixel (or per-entry) statistics to per-label statistics
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Label of each entry
+    coords : tuple of np.ndarray
+        Tuple of (lower, upper, sums) arrays of shape (n, ndim)
+    counts : np.ndarray
+        Amount of pixels each entry represents
+
+    Returns
+    -------
+    tuple
+        Sorted unique ids, lower corners, upper corners, coordinate sums and
+        pixel counts
+    """
+    lower, upper, sums = coords
+    if len(labels) == 0:
+        return labels, lower, upper, sums, counts
+    order = np.argsort(labels, kind="stable")
+    labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    ids = labels[starts]
+    lower = np.minimum.reduceat(lower[order], starts, axis=0)
+    upper = np.maximum.reduceat(upper[order], starts, axis=0)
+    sums = np.add.reduceat(sums[order], starts, axis=0)
+    counts = np.add.reduceat(counts[order], starts)
+    return ids, lower, upper, sums, counts
+
+
+def compact_labels(labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Maps label ids to consecutive bins for counting them with np.bincount
+
+    Dense id ranges are mapped by subtracting the lowest id, other ranges
+    are factorized with a hash table, so the labels are never sorted and
+    the amount of bins equals the amount of labels.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Nonzero labels
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Sorted ids of the labels and the bin of each label
+    """
+    lowest, highest = int(labels.min()), int(labels.max())
+    if highest - lowest < DENSE_ID_FACTOR * len(labels):
+        offsets = (labels - lowest).astype(np.intp)
+        present = np.flatnonzero(
+            np.bincount(offsets, minlength=highest - lowest + 1)
+        )
+        bins = np.zeros(highest - lowest + 1, dtype=np.intp)
+        bins[present] = np.arange(len(present))
+        return present.astype(np.int64) + lowest, bins[offsets]
+    bins, ids = pd.factorize(labels, sort=True)
+    return np.asarray(ids, dtype=np.int64), bins.astype(np.intp)
+
+
+def _block_statistics(block: np.ndarray, offset: np.ndarray):
+    """
+    Computes bounding boxes, coordinate sums and counts of all labels in a block
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Part of the label image
+    offset : np.ndarray
+        Position of the block in the label image
+
+    Returns
+    -------
+    tuple
+        Same as `_group_by_label`
+    """
+    ndim = block.ndim
+    flat = block.ravel()
+    nonzero = np.flatnonzero(flat)
+    if len(nonzero) == 0:
+        empty = np.zeros((0, ndim), dtype=np.int64)
+        return np.zeros(0, dtype=np.int64), empty, empty, empty, empty[:, 0]
+    ids, bins = compact_labels(flat[nonzero])
+    counts = np.bincount(bins, minlength=len(ids))
+    lower = np.empty((len(ids), ndim), dtype=np.int64)
+    upper = np.empty((len(ids), ndim), dtype=np.int64)
+    sums = np.empty((len(ids), ndim), dtype=np.int64)
+    for axis, coords in enumerate(np.unravel_index(nonzero, block.shape)):
+        minimum = np.full(len(ids), np.iinfo(np.intp).max, dtype=np.intp)
+        np.minimum.at(minimum, bins, coords)
+        maximum = np.zeros(len(ids), dtype=np.intp)
+        np.maximum.at(maximum, bins, coords)
+        # sums of up to BLOCK_PIXELS coordinates are exact in float64
+        total = np.bincount(bins, weights=coords, minlength=len(ids))
+        lower[:, axis] = minimum + offset[axis]
+        upper[:, axis] = maximum + offset[axis] + 1
+        sums[:, axis] = np.rint(total).astype(np.int64)
+        sums[:, axis] += counts * offset[axis]
+    return ids, lower, upper, sums, counts
+
+
+def remaining_labels(data: np.ndarray, ids: Sequence[int]) -> np.ndarray:
+    """
+    Returns a label image that only keeps the labels with the given ids
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Label image, chunked label images give a dask array that is
+        computed chunk by chunk when it is displayed
+    ids : sequence of int
+        Ids of the labels to keep
+
+    Returns
+    -------
+    np.ndarray or dask.array.Array
+        Label image with all other labels set to 0
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+
+    def keep(block: np.ndarray) -> np.ndarray:
+        return np.where(np.isin(block, ids), block, 0)
+
+    if isinstance(data, np.ndarray):
+        return keep(data)
+    import dask.array as da
+
+    return da.from_array(data, chunks=data.chunks).map_blocks(
+        keep, dtype=data.dtype
+    )
+
+
+def _block_region(
+    shape: Tuple[int, ...], block: Sequence[int], start: Sequence[int]
+) -> Tuple[slice, ...]:
+    """Returns the region of a block starting at `start`, padded with axes"""
+    start = tuple(start) + (0,) * (len(shape) - len(start))
+    return tuple(
+        slice(lo, min(lo + size, length))
+        for lo, size, length in zip(start, block, shape)
+    )
+
+
+def _read_block_statistics(data: np.ndarray, region: Tuple[slice, ...]):
+    """Reads a block of a label image and computes its statistics"""
+    offset = np.array([s.start for s in region], dtype=np.int64)
+    return _block_statistics(np.asarray(data[region]), offset)
+
+
+def _block_shape(data, pixels: int) -> Tuple[int, ...]:
+    """
+    Returns the shape of the blocks a chunked label image is read in
+
+    Blocks consist of whole chunks and are grown from the last axis on
+    until they hold about `pixels` pixels.
+
+    Parameters
+    ----------
+    data : zarr.Array or dask.array.Array
+        Label image, arrays without chunks are read in rows
+    pixels : int
+        Amount of pixels of a block
+
+    Returns
+    -------
+    tuple of int
+        Shape of the blocks
+    """
+    chunks = getattr(data, "chunks", None)
+    if chunks is None:
+        chunks = (1,) * (data.ndim - 1) + (data.shape[-1],)
+    lengths = []
+    for length in chunks:
+        if isinstance(length, tuple):
+            # dask arrays list the length of every chunk
+            length = length[0] if length else 1
+        lengths.append(max(int(length), 1))
+    block = list(lengths)
+    for axis in reversed(range(data.ndim)):
+        factor = max(pixels // int(np.prod(block)), 1)
+        limit = -(-data.shape[axis] // lengths[axis]) * lengths[axis]
+        block[axis] = min(block[axis] * factor, max(limit, 1))
+    return tuple(block)
+
+
+def _block_regions(data) -> List[Tuple[slice, ...]]:
+    """
+    Returns the regions a label image is read in block by block
+
+    NumPy images are split into blocks of whole rows, blocks of chunked
+    images are aligned to the chunks so no chunk is read twice. Blocks hold
+    about BLOCK_PIXELS / INDEX_WORKERS pixels.
+
+    Parameters
+    ----------
+    data : np.ndarray, zarr.Array or dask.array.Array
+        Label image
+
+    Returns
+    -------
+    list of tuple of slice
+        Regions covering the image
+    """
+    ndim = data.ndim
+    pixels = BLOCK_PIXELS // INDEX_WORKERS
+    if isinstance(data, np.ndarray):
+        axis = max(ndim - 2, 0)
+        row_size = max(int(np.prod(data.shape)) // max(data.shape[axis], 1), 1)
+        step = max(pixels // row_size, 1)
+        block = list(data.shape)
+        block[axis] = step
+        return [
+            _block_region(data.shape, block, (0,) * axis + (start,))
+            for start in range(0, data.shape[axis], step)
+        ]
+    block = _block_shape(data, pixels)
+    return [
+        _block_region(data.shape, block, start)
+        for start in itertools.product(
+            *(range(0, n, b) for n, b in zip(data.shape, block))
+        )
+    ]
+
+
+def _map_blocks(function, data) -> list:
+    """Applies a function to the block regions of an image in parallel"""
+    regions = _block_regions(data)
+    if len(regions) == 1:
+        return [function(regions[0])]
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+        return list(executor.map(function, regions))
+
+
+def _read_label_statistics(
+    data: np.ndarray, region: Tuple[slice, ...], id_: int
+):
+    """Reads a block of a label image and computes statistics of one label"""
+    coords = np.nonzero(np.asarray(data[region]) == id_)
+    if len(coords[0]) == 0:
+        return None
+    offset = np.array([s.start for s in region], dtype=np.int64)
+    lower = np.array([c.min() for c in coords], dtype=np.int64) + offset
+    upper = np.array([c.max() for c in coords], dtype=np.int64) + offset + 1
+    count = len(coords[0])
+    sums = np.array([c.sum() for c in coords], dtype=np.int64) + count * offset
+    return lower, upper, sums, count
+
+
+class LabelIndex:
+    """
+    Index of the bounding box, pixel count and centroid of every label
+
+    The index is built once per label layer so that operations on a single
+    cell only need to touch the bounding box of that cell instead of the
+    whole image.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        lower: np.ndarray,
+        upper: np.ndarray,
+        counts: np.ndarray,
+        centroids: np.ndarray,
+    ):
+        self.ids = ids  # sorted label ids, background excluded
+        self.lower = lower  # inclusive lower corner of each bounding box
+        self.upper = upper  # exclusive upper corner of each bounding box
+        self.counts = counts  # amount of pixels of each label
+        self.centroids = centroids  # centroid of each label
+
+    @classmethod
+    def from_array(cls, data: np.ndarray) -> "LabelIndex":
+        """
+        Builds the index for a label image
+
+        The image is split into blocks of about BLOCK_PIXELS / INDEX_WORKERS
+        pixels that are evaluated in parallel. The labels of a block are
+        counted with np.bincount instead of being sorted, see compact_labels.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Label image
+
+        Returns
+        -------
+        LabelIndex
+            Index of all nonzero labels in the image
+        """
+        ndim = data.ndim
+        results = _map_blocks(
+            lambda region: _read_block_statistics(data, region), data
+        )
+        results = [result for result in results if len(result[0])]
+        if len(results) == 0:
+            return cls.empty(ndim)
+        ids, lower, upper, sums, counts = _group_by_label(
+            np.concatenate([result[0] for result in results]),
+            tuple(
+                np.concatenate([result[i] for result in results])
+                for i in range(1, 4)
+            ),
+            np.concatenate([result[4] for result in results]),
+        )
+        return cls(ids, lower, upper, counts, sums / counts[:, None])
+
+    @classmethod
+    def empty(cls, ndim: int) -> "LabelIndex":
+        """
+        Returns an index without any labels
+
+        Parameters
+        ----------
+        ndim : int
+            Dimensionality of the label image
+
+        Returns
+        -------
+        LabelIndex
+            Empty index
+        """
+        return cls(
+            np.zeros(0, dtype=np.int64),
+            np.zeros((0, ndim), dtype=np.int64),
+            np.zeros((0, ndim), dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            np.zeros((0, ndim), dtype=np.float64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id_: int) -> bool:
+        return self._position(id_) is not None
+
+    def _position(self, id_: int) -> Optional[int]:
+        position = int(np.searchsorted(self.ids, id_))
+        if position < len(self.ids) and self.ids[position] == id_:
+            return position
+        return None
+
+    def _get_position(self, id_: int) -> int:
+        position = self._position(id_)
+        if position is None:
+            raise KeyError(id_)
+        return position
+
+    @property
+    def max_id(self) -> int:
+        """Highest label id in the index, 0 if the index is empty"""
+        return int(self.ids[-1]) if len(self.ids) else 0
+
+    def bbox(self, id_: int) -> Tuple[slice, ...]:
+        """
+        Returns the bounding box of a label
+
+        Parameters
+        ----------
+        id_ : int
+            Label id
+
+        Returns
+        -------
+        tuple of slice
+            Slices selecting the bounding box of the label
+        """
+        position = self._get_position(id_)
+        return bbox_to_slices(self.lower[position], self.upper[position])
+
+    def count(self, id_: int) -> int:
+        """Returns the amount of pixels of a label"""
+        return int(self.counts[self._get_position(id_)])
+
+    def centroid(self, id_: int) -> Tuple[float, ...]:
+        """Returns the centroid of a label"""
+        return tuple(
+            float(value) for value in self.centroids[self._get_position(id_)]
+        )
+
+    def mask(
+        self, data: np.ndarray, id_: int
+    ) -> Tuple[Tuple[slice, ...], np.ndarray]:
+        """
+        Returns the bounding box of a label and its mask within that box
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Label image the index was built for
+        id_ : int
+            Label id
+
+        Returns
+        -------
+        tuple
+            Slices of the bounding box and boolean mask of the label inside it
+        """
+        slices = self.bbox(id_)
+        return slices, np.asarray(data[slices]) == id_
+
+    def add(self, id_: int, slices: Tuple[slice, ...], mask: np.ndarray):
+        """
+        Adds or replaces a label using its mask within a region
+
+        Parameters
+        ----------
+        id_ : int
+            Label id
+        slices : tuple of slice
+            Region of the label image the mask belongs to
+        mask : np.ndarray
+            Boolean mask of the label within the region
+        """
+        self.remove(id_)
+        bbox = mask_bbox(mask)
+        if bbox is None:
+            return
+        offset = np.array([s.start or 0 for s in slices], dtype=np.int64)
+        coords = np.nonzero(mask)
+        lower = np.array([s.start for s in bbox]) + offset
+        upper = np.array([s.stop for s in bbox]) + offset
+        count = len(coords[0])
+        centroid = np.array([np.mean(c) for c in coords]) + offset
+        self._insert(id_, lower, upper, count, centroid)
+
+    def search(self, data: np.ndarray, id_: int):
+        """
+        Indexes a label again by searching the whole label image
+
+        The image is read block by block like in `from_array`, so chunked
+        images are never loaded as a whole.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Label image the index was built for
+        id_ : int
+            Label id, removed from the index if it has no pixels
+        """
+        results = _map_blocks(
+            lambda region: _read_label_statistics(data, region, id_), data
+        )
+        results = [result for result in results if result is not None]
+        self.remove(id_)
+        if len(results) == 0:
+            return
+        lower, upper, sums, counts = zip(*results)
+        count = int(sum(counts))
+        self._insert(
+            id_,
+            np.min(lower, axis=0),
+            np.max(upper, axis=0),
+            count,
+            np.sum(sums, axis=0) / count,
+        )
+
+    def _insert(
+        self,
+        id_: int,
+        lower: np.ndarray,
+        upper: np.ndarray,
+        count: int,
+        centroid: np.ndarray,
+    ):
+        """Inserts a label missing from the index at its sorted position"""
+        position = int(np.searchsorted(self.ids, id_))
+        self.ids = np.insert(self.ids, position, id_)
+        self.lower = np.insert(self.lower, position, lower, axis=0)
+        self.upper = np.insert(self.upper, position, upper, axis=0)
+        self.counts = np.insert(self.counts, position, count)
+        self.centroids = np.insert(self.centroids, position, centroid, axis=0)
+
+    def update_region(
+        self,
+        data: np.ndarray,
+        region: Tuple[slice, ...],
+        keep: Collection[int] = (),
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Indexes the labels of an edited region again
+
+        The statistics of the labels found in the region are computed from
+        the region alone if the label was not indexed before or its previous
+        bounding box lies within the region. Other labels found in the
+        region, and indexed labels whose bounding box intersects it, are
+        indexed again from the union of their bounding box and the region.
+        The rest of the label image is not read.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Label image the index was built for, after the edit
+        region : tuple of slice
+            Region of the label image containing all edited pixels
+        keep : collection of int, optional
+            Ids whose entries are kept if they have no pixels in the region,
+            like cells whose pixels were cleared on purpose, by default none
+
+        Returns
+        -------
+        tuple of list of int
+            Ids of the labels added to the index and ids of the labels that
+            no longer have any pixels
+        """
+        start = np.array([s.start for s in region], dtype=np.int64)
+        stop = np.array([s.stop for s in region], dtype=np.int64)
+        ids, *statistics = _block_statistics(np.asarray(data[region]), start)
+        inside = dict(zip(ids.tolist(), zip(*statistics)))
+        intersecting = self.ids[
+            np.all((self.lower < stop) & (self.upper > start), axis=1)
+        ]
+        added, removed = [], []
+        for id_ in sorted(set(inside) | set(intersecting.tolist())):
+            if id_ in keep and id_ not in inside:
+                continue
+            position = self._position(id_)
+            if position is not None and not (
+                np.all(self.lower[position] >= start)
+                and np.all(self.upper[position] <= stop)
+            ):
+                bbox = self.bbox(id_)
+                union = tuple(
+                    slice(min(a.start, b.start), max(a.stop, b.stop))
+                    for a, b in zip(bbox, region)
+                )
+                self.add(id_, union, np.asarray(data[union]) == id_)
+            else:
+                self.remove(id_)
+                if id_ in inside:
+                    lower, upper, sums, count = inside[id_]
+                    self._insert(id_, lower, upper, count, sums / count)
+            if position is None and id_ in self:
+                added.append(id_)
+            elif position is not None and id_ not in self:
+                removed.append(id_)
+        return added, removed
+
+    def remove(self, id_: int):
+        """
+        Removes a label from the index if it is present
+
+        Parameters
+        ----------
+        id_ : int
+            Label id
+        """
+        position = self._position(id_)
+        if position is None:
+            return
+        self.ids = np.delete(self.ids, position)
+        self.lower = np.delete(self.lower, position, axis=0)
+        self.upper = np.delete(self.upper, position, axis=0)
+        self.counts = np.delete(self.counts, position)
+        self.centroids = np.delete(self.centroids, position, axis=0)
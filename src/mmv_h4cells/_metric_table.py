@@ -0,0 +1,331 @@
+import numpy as np
+from collections.abc import MutableSequence
+from numpy.lib import recfunctions
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from mmv_h4cells._running_stats import RunningStats
+
+# columns of a metric row, the centroid is split into its coordinates
+METRIC_DTYPE = np.dtype(
+    [("id", np.int64), ("size", np.int64), ("y", np.int64), ("x", np.int64)]
+)
+
+# columns the zarr session and the csv file store, in their order
+METRIC_COLUMNS = ("id", "size", "y", "x")
+
+# columns running statistics are kept for
+STATISTIC_COLUMNS = ("size",)
+
+# capacity of an empty table
+INITIAL_CAPACITY = 64
+
+
+class MetricTable(MutableSequence):
+    """
+    Growable columnar table of the metric data of the included cells
+
+    Rows are stored in a NumPy structured array that doubles its capacity
+    when it is full, so appending and popping rows is amortised O(1).
+    Indexing and iteration return `(id, size, (y, x), *extra)` tuples, so
+    the table can be used wherever the list of metric tuples is expected,
+    while `column` and `to_array` give the columns without copying.
+    Further metric columns are added by extending the dtype, running
+    statistics of a column are kept up to date on every change when it is
+    listed in `statistic_columns`.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[tuple] = (),
+        dtype: np.dtype = METRIC_DTYPE,
+        statistic_columns: Tuple[str, ...] = STATISTIC_COLUMNS,
+    ):
+        self.dtype = np.dtype(dtype)  # columns of the table
+        self.data = np.zeros(
+            INITIAL_CAPACITY, dtype=self.dtype
+        )  # rows of the table followed by unused capacity
+        self.length = 0  # amount of rows in the table
+        self.statistics: Dict[str, RunningStats] = {
+            name: RunningStats() for name in statistic_columns
+        }  # running statistics by column
+        self._statistic_fields = [
+            (name, self.dtype.names.index(name)) for name in statistic_columns
+        ]  # columns with statistics and their position in a record
+        rows = [self._to_record(row) for row in rows]
+        if rows:
+            self._reserve(len(rows))
+            self.data[: len(rows)] = rows
+            self.length = len(rows)
+            self._compute_statistics()
+
+    @classmethod
+    def from_array(
+        cls, array: np.ndarray, dtype: np.dtype = METRIC_DTYPE
+    ) -> "MetricTable":
+        """
+        Creates a table from an array with one column per field
+
+        Parameters
+        ----------
+        array : np.ndarray
+            Array of shape (n, amount of fields) as returned by `to_array`
+        dtype : np.dtype, optional
+            Columns of the table, by default METRIC_DTYPE
+
+        Returns
+        -------
+        MetricTable
+            Table holding the rows of the array
+        """
+        table = cls(dtype=dtype)
+        array = np.asarray(array).reshape(-1, len(table.dtype.names))
+        table._reserve(len(array))
+        table.data[: len(array)] = recfunctions.unstructured_to_structured(
+            array, dtype=table.dtype
+        )
+        table.length = len(array)
+        table._compute_statistics()
+        return table
+
+    def _compute_statistics(self):
+        """Computes the running statistics of all rows at once"""
+        for name, _ in self._statistic_fields:
+            self.statistics[name] = RunningStats.from_values(
+                self.column(name)
+            )
+
+    def _add_statistics(self, record: tuple):
+        for name, position in self._statistic_fields:
+            self.statistics[name].add(record[position])
+
+    def _remove_statistics(self, record: tuple):
+        for name, position in self._statistic_fields:
+            self.statistics[name].remove(record[position])
+
+    def _to_record(self, row: Sequence) -> tuple:
+        id_, size, centroid, *extra = row
+        return (id_, size, *centroid, *extra)
+
+    @staticmethod
+    def _to_row(record: tuple) -> tuple:
+        id_, size, y, x, *extra = record
+        return (id_, size, (y, x), *extra)
+
+    def _reserve(self, length: int):
+        """Grows the capacity to hold at least `length` rows"""
+        if length <= len(self.data):
+            return
+        capacity = max(len(self.data), INITIAL_CAPACITY)
+        while capacity < length:
+            capacity *= 2
+        data = np.zeros(capacity, dtype=self.dtype)
+        data[: self.length] = self.data[: self.length]
+        self.data = data
+
+    def _index(self, index: int) -> int:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("metric table index out of range")
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._to_row(r) for r in self.rows[index].tolist()]
+        return self._to_row(self.data[self._index(index)].tolist())
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            rows = list(self)
+            rows[index] = value
+            self.length = 0
+            for row in rows:
+                self.append(row)
+            self._compute_statistics()
+            return
+        index = self._index(index)
+        record = self._to_record(value)
+        self._remove_statistics(self.data[index].tolist())
+        self.data[index] = record
+        self._add_statistics(record)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            keep = np.ones(self.length, dtype=bool)
+            keep[index] = False
+            rows = self.rows[keep]
+            self.data[: len(rows)] = rows
+            self.length = len(rows)
+            self._compute_statistics()
+            return
+        index = self._index(index)
+        self._remove_statistics(self.data[index].tolist())
+        self.data[index : self.length - 1] = self.data[index + 1 : self.length]
+        self.length -= 1
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        return (self._to_row(record) for record in self.rows.tolist())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (MetricTable, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)})"
+
+    def insert(self, index: int, value: tuple):
+        if index < 0:
+            index = max(index + self.length, 0)
+        index = min(index, self.length)
+        self._reserve(self.length + 1)
+        self.data[index + 1 : self.length + 1] = self.data[index : self.length]
+        record = self._to_record(value)
+        self.data[index] = record
+        self.length += 1
+        self._add_statistics(record)
+
+    def append(self, value: tuple):
+        self._reserve(self.length + 1)
+        record = self._to_record(value)
+        self.data[self.length] = record
+        self.length += 1
+        self._add_statistics(record)
+
+    def extend(self, values: Iterable[tuple]):
+        """
+        Appends several rows at once
+
+        The rows are written in one step and their statistics are merged
+        into the running statistics instead of being added one at a time.
+
+        Parameters
+        ----------
+        values : iterable of tuple
+            Rows to append
+        """
+        records = [self._to_record(row) for row in values]
+        if not records:
+            return
+        self._reserve(self.length + len(records))
+        added = self.data[self.length : self.length + len(records)]
+        added[:] = records
+        self.length += len(records)
+        for name, _ in self._statistic_fields:
+            self.statistics[name].merge(RunningStats.from_values(added[name]))
+
+    def pop(self, index: int = -1) -> tuple:
+        row = self[index]
+        del self[index]
+        return row
+
+    @property
+    def rows(self) -> np.ndarray:
+        """Structured array of all rows, a view of the table"""
+        return self.data[: self.length]
+
+    def stats(self, name: str) -> RunningStats:
+        """
+        Returns the running statistics of a column
+
+        Parameters
+        ----------
+        name : str
+            Name of the column, one of the statistic columns
+
+        Returns
+        -------
+        RunningStats
+            Count, mean, standard deviation and extrema of the column
+        """
+        stats = self.statistics[name]
+        stats.update_extrema(self.column(name))
+        return stats
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Returns a column of the table without copying it
+
+        Parameters
+        ----------
+        name : str
+            Name of the column, a field of the dtype
+
+        Returns
+        -------
+        np.ndarray
+            View of the column
+        """
+        return self.rows[name]
+
+    def to_array(
+        self, columns: Tuple[str, ...] = METRIC_COLUMNS
+    ) -> np.ndarray:
+        """
+        Returns columns of the table as 2D array
+
+        Parameters
+        ----------
+        columns : tuple of str, optional
+            Names of the columns, by default METRIC_COLUMNS
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (n, len(columns)), a view of the table if the
+            columns share their dtype
+        """
+        return recfunctions.structured_to_unstructured(
+            self.rows[list(columns)], copy=False
+        )
+
+    def sort(self, key=None, reverse: bool = False):
+        """
+        Sorts the rows in place like `list.sort`
+
+        Without key the rows are sorted by id in a single vectorised step.
+
+        Parameters
+        ----------
+        key : callable, optional
+            Function computing the sort key of a row tuple
+        reverse : bool, optional
+            Whether to sort in descending order, by default False
+        """
+        if key is None:
+            order = np.argsort(
+                self.rows, order=list(self.dtype.names), kind="stable"
+            )
+        else:
+            keys = [key(row) for row in self]
+            order = sorted(range(self.length), key=keys.__getitem__)
+        order = np.asarray(order, dtype=np.intp)
+        if reverse:
+            order = order[::-1]
+        self.data[: self.length] = self.rows[order]
+
+    def find(self, id_: int) -> Optional[int]:
+        """
+        Returns the position of the last row of a cell
+
+        The last row is checked first, so finding the row of the most
+        recently included cell does not scan the table.
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+
+        Returns
+        -------
+        int or None
+            Position of the row, None if the cell has no row
+        """
+        ids = self.column("id")
+        if self.length and ids[-1] == id_:
+            return self.length - 1
+        positions = np.flatnonzero(ids == id_)
+        return int(positions[-1]) if len(positions) else None
@@ -0,0 +1,192 @@
+import logging
+import numpy as np
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# amount of cells following the displayed one that are prefetched
+PREFETCH_DEPTH = 3
+
+# id, bounding box, pixel count and centroid of an indexed cell
+IndexEntry = Tuple[int, Tuple[slice, ...], int, Tuple[float, ...]]
+
+
+class PrefetchedCell:
+    """Bounding box, mask and centroid of a cell read ahead of time"""
+
+    def __init__(
+        self,
+        region: Tuple[slice, ...],
+        mask: np.ndarray,
+        centroid: Tuple[float, ...],
+    ):
+        self.region = region  # bounding box of the cell
+        self.mask = mask  # boolean mask of the cell inside the bounding box
+        self.centroid = centroid  # centroid of the cell
+
+
+class CellPrefetcher:
+    """
+    Reads the cells following the displayed one on a worker thread
+
+    While a cell is evaluated, the masks of the next cells in navigation
+    order are read from the label image, so displaying the next cell does
+    not wait for the label image. Cells whose bounding box intersects an
+    edited region are dropped, results of reads that overlapped an edit are
+    discarded, so only masks matching the current label image are handed
+    out. The index entries of the cells are taken on the thread scheduling
+    the prefetch, the worker thread only reads the label image.
+    """
+
+    def __init__(self, session, depth: int = PREFETCH_DEPTH):
+        self.logger = logging.getLogger(__name__)
+        self.session = session  # session the cells are read from
+        self.depth = depth  # amount of cells read ahead
+        self.cells: Dict[int, PrefetchedCell] = {}  # prefetched cells by id
+        self.generation = 0  # amount of edits, reads during an edit are void
+        self.lock = threading.Lock()  # guards cells and generation
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        )  # worker thread reading the cells
+        self.future: Optional[Future] = None  # running prefetch
+
+    def candidates(self, current_id: int) -> List[int]:
+        """
+        Returns the ids following a cell in navigation order
+
+        Parameters
+        ----------
+        current_id : int
+            Id of the displayed cell
+
+        Returns
+        -------
+        list of int
+            Up to `depth` remaining ids after the cell, wrapping around to
+            the lowest id
+        """
+        remaining = self.session.remaining
+        ids = []
+        id_ = current_id
+        while len(ids) < self.depth:
+            id_ = remaining.next_higher(id_)
+            if id_ is None:
+                id_ = remaining.lowest()
+            if id_ is None or id_ == current_id or id_ in ids:
+                break
+            ids.append(id_)
+        return ids
+
+    def entries(self, ids: List[int]) -> List[IndexEntry]:
+        """
+        Returns the index entries of cells
+
+        Must be called on the thread editing the session, so the entries
+        are consistent with each other while the index is changed.
+
+        Parameters
+        ----------
+        ids : list of int
+            Ids of the cells, ids missing from the index are left out
+
+        Returns
+        -------
+        list of tuple
+            Id, bounding box, pixel count and centroid of each indexed cell
+        """
+        index = self.session.label_index
+        # unindexed cells are searched by get_cell_mask
+        return [
+            (id_, index.bbox(id_), index.count(id_), index.centroid(id_))
+            for id_ in ids
+            if id_ in index
+        ]
+
+    def schedule(self, current_id: int):
+        """
+        Starts reading the cells following a cell in the background
+
+        Parameters
+        ----------
+        current_id : int
+            Id of the displayed cell
+        """
+        ids = self.candidates(current_id)
+        with self.lock:
+            for id_ in list(self.cells):
+                if id_ not in ids:
+                    del self.cells[id_]
+            ids = [id_ for id_ in ids if id_ not in self.cells]
+            generation = self.generation
+        entries = self.entries(ids)
+        if entries:
+            self.future = self.executor.submit(
+                self.prefetch, entries, generation
+            )
+
+    def prefetch(self, entries: List[IndexEntry], generation: int):
+        """
+        Reads cells and stores them unless the label image changed meanwhile
+
+        Parameters
+        ----------
+        entries : list of tuple
+            Index entries of the cells, see `entries`
+        generation : int
+            Generation the entries were taken at
+        """
+        labels = self.session.labels
+        for id_, region, count, centroid in entries:
+            if self.generation != generation:
+                return
+            mask = np.asarray(labels[region]) == id_
+            if np.count_nonzero(mask) != count:
+                continue
+            with self.lock:
+                if self.generation != generation:
+                    return
+                self.cells[id_] = PrefetchedCell(region, mask, centroid)
+
+    def take(self, cell_id: int) -> Optional[PrefetchedCell]:
+        """
+        Returns and forgets a prefetched cell
+
+        Parameters
+        ----------
+        cell_id : int
+            Id of the cell
+
+        Returns
+        -------
+        PrefetchedCell or None
+            The cell, None if it was not prefetched
+        """
+        with self.lock:
+            return self.cells.pop(cell_id, None)
+
+    def invalidate(self, region: Optional[Tuple[slice, ...]] = None):
+        """
+        Drops prefetched cells after the label image was edited
+
+        Parameters
+        ----------
+        region : tuple of slice, optional
+            Edited region, cells intersecting it are dropped, by default
+            all cells are dropped
+        """
+        with self.lock:
+            self.generation += 1
+            if region is None:
+                self.cells.clear()
+                return
+            for id_, cell in list(self.cells.items()):
+                if all(
+                    a.start < b.stop and b.start < a.stop
+                    for a, b in zip(cell.region, region)
+                ):
+                    del self.cells[id_]
+
+    def wait(self):
+        """Waits for the running prefetch to finish"""
+        if self.future is not None:
+            self.future.result()
@@ -1,8 +1,19 @@
 from qtpy.QtWidgets import QFileDialog
 import csv
+import gzip
+import io
+import numpy as np
+import pandas as pd
 from aicsimageio import AICSImage
 import json
 import zarr
+from pathlib import Path
+from typing import Iterable, Tuple
+
+from mmv_h4cells._metric_table import METRIC_COLUMNS, MetricTable
+from mmv_h4cells._undo import UndoStack
+from mmv_h4cells._writer import PARQUET_METRICS_KEY
+from mmv_h4cells._zarr_store import CopyOnWriteStore
 
 
 def open_dialog(parent, filetype="*.csv", directory="", dir: bool = False):
@@ -36,9 +47,9 @@ def open_dialog(parent, filetype="*.csv", directory="", dir: bool = False):
     return filepath
 
 
-def read(path):
+def read(path, **kwargs):
     reader = napari_get_reader(path)
-    return reader(path)
+    return reader(path, **kwargs)
 
 
 def napari_get_reader(path):
@@ -57,9 +68,12 @@ def napari_get_reader(path):
     """
 
     # if path.endswith(".csv"):
-    if path.suffix == ".csv":
+    if path.suffix == ".csv" or path.suffixes[-2:] == [".csv", ".gz"]:
         return read_csv
 
+    if path.suffix == ".parquet":
+        return read_parquet
+
     # if path.endswith(".tiff")
     if path.suffix == ".tiff" or path.suffix == ".tif":
         return read_tiff
@@ -70,71 +84,170 @@ def napari_get_reader(path):
     return None
 
 
-def read_csv(path):  # adjust if needed if metrics are added # unused
+def read_csv(path: Path) -> Tuple[MetricTable, tuple, pd.DataFrame]:
+    """
+    Reads an analysis csv written by `write_csv`
+
+    The cell rows are parsed column by column with pandas, the centroids
+    are split with vectorised string operations. Delimiter and decimal
+    separator are taken from the header, so files written on German
+    locales are read as well. Files ending in ".gz" are decompressed.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the csv file
+
+    Returns
+    -------
+    tuple
+        Metric data, metrics and the feature columns of the cells
+    """
+    path = Path(path)
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rt", newline=None) as file:
+        text = file.read()
+    header, _, text = text.partition("\n")
+    delimiter = ";" if header.startswith("ID;") else ","
+    decimal = "," if delimiter == ";" else "."
+    names = next(csv.reader([header], delimiter=delimiter))[:-1]
+    rows, _, metric_text = ("\n" + text).rpartition("\n\n")
+    if rows.strip():
+        df = pd.read_csv(
+            io.StringIO(rows),
+            sep=delimiter,
+            decimal=decimal,
+            header=None,
+            names=names,
+            usecols=range(len(names)),
+        )
+    else:
+        df = pd.DataFrame({name: [] for name in names})
+    centroids = (
+        df["Centroid"]
+        .astype(str)
+        .str.extract(r"\((-?\d+), (-?\d+)\)")
+        .to_numpy(dtype=np.int64)
+    )
+    data = MetricTable.from_array(
+        np.column_stack(
+            [
+                df["ID"].to_numpy(dtype=np.int64),
+                df["Size [px]"].to_numpy(dtype=np.int64),
+                centroids.reshape(-1, 2),
+            ]
+        )
+    )
+    metric_rows = csv.reader(metric_text.splitlines(), delimiter=delimiter)
+    metrics = tuple(_parse_number(value) for value in list(metric_rows)[1])
+    return data, metrics, df[names[3:]].reset_index(drop=True)
+
+
+def _parse_number(value: str):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def read_parquet(path: Path) -> Tuple[MetricTable, tuple, pd.DataFrame]:
+    """
+    Reads a result table written by `write_parquet`
+
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the parquet file
+
+    Returns
+    -------
+    tuple
+        Metric data, metrics and the feature columns of the cells, like
+        `read_csv`
+    """
+    from pyarrow import parquet
+
+    table = parquet.read_table(path)
+    metadata = table.schema.metadata or {}
+    metrics = tuple(json.loads(metadata.get(PARQUET_METRICS_KEY, b"[]")))
+    df = table.to_pandas()
+    data = MetricTable.from_array(df[list(METRIC_COLUMNS)].to_numpy())
+    features = df.drop(columns=list(METRIC_COLUMNS)).reset_index(drop=True)
+    return data, metrics, features
+
+
+def read_results(paths: Iterable[Path]) -> pd.DataFrame:
     """
-    Reads data from a CSV file and processes each row.
+    Reads the cells of many result tables into one table
+
+    Parquet files are read with pyarrow, csv files with `read_csv`.
 
-    Parameters:
-    - path (str): The file path to the CSV file.
+    Parameters
+    ----------
+    paths : iterable of Path
+        Paths of parquet or csv result tables
 
-    Returns:
-    - tuple: A tuple containing a list of data and a tuple representing the last row read.
-      The list of data contains tuples for rows where the first element is an integer.
-      The last row is returned separately if its first element is a float.
+    Returns
+    -------
+    pd.DataFrame
+        Columns id, size, y, x and the features of all cells, the column
+        file holds the path each cell was read from
     """
-    data = (
-        []
-    )  # List to store tuples of rows with the first element as an integer
-    metrics = ()  # Tuple to store the metrics if its first element is a float
-
-    with open(path, "r") as file:
-        csv_reader = csv.reader(file)
-
-        for row in csv_reader:
-            for i in range(len(row)):
-                try:
-                    number = float(row[i])
-                    if number.is_integer():
-                        row[i] = int(number)
-                    else:
-                        row[i] = number
-                except ValueError:
-                    pass
-            # Skip empty rows
-            if len(row) == 0:
-                continue
-
-            if isinstance(row[0], str):
-                if row[0].startswith("ID"):
-                    undo_stack = json.loads(row[4])
-                continue
-
-            # Check the type of the first element in the row
-            if isinstance(row[1], int):
-                data.append(tuple(row))
-            elif isinstance(row[1], float):
-                # If the second element is a float, store the row separately
-                metrics = tuple(row[0:2])
-
-    if metrics == ():
-        # If the metric values happen to all be integers, they are now the last row of the data
-        metrics = data.pop(-1)
-
-    return data, metrics, undo_stack
+    tables = []
+    for path in paths:
+        reader = read_parquet if Path(path).suffix == ".parquet" else read_csv
+        data, _, features = reader(path)
+        table = pd.DataFrame(data.to_array(), columns=list(METRIC_COLUMNS))
+        table = pd.concat([table, features], axis=1)
+        table.insert(0, "file", str(path))
+        tables.append(table)
+    if not tables:
+        return pd.DataFrame(columns=["file", *METRIC_COLUMNS])
+    return pd.concat(tables, ignore_index=True)
 
 
 def read_tiff(path): # unused
     data = AICSImage(path).get_image_data("YX")
     return data.astype("int32")
 
-def read_zarr(path):
-    zarr_file = zarr.open(path, mode="r")
-    data_to_evaluate = zarr_file["data_to_valuate"][:]
-    accepted_cells = zarr_file["accepted_cells"][:]
-    rejected_cells = zarr_file["rejected_cells"][:]
-    flattened_data = zarr_file["data"][:]
-    data = [(int(id_), int(amount), (int(y), int(x))) for id_, amount, y, x in flattened_data]
+def read_zarr(path, lazy: bool = False):
+    """
+    Reads a session written by `write_zarr`
+
+    Parameters
+    ----------
+    path : Path
+        Path of the zarr directory
+    lazy : bool, optional
+        Whether to open the label images as zarr arrays that only read the
+        chunks that are accessed, by default False. Changes to lazily opened
+        label images are kept in memory, see CopyOnWriteStore.
+
+    Returns
+    -------
+    tuple
+        Label image to evaluate, accepted and rejected cells, metric data,
+        metrics, undo stack and lower bound of self drawn ids
+    """
+    if not Path(path).exists():
+        raise FileNotFoundError(path)
+    zarr_file = zarr.open(str(path), mode="r")
+    if lazy:
+        labels = zarr.open_group(
+            CopyOnWriteStore(zarr_file.store), mode="r+"
+        )
+        data_to_evaluate = labels["data_to_valuate"]
+        accepted_cells = labels["accepted_cells"]
+        rejected_cells = labels["rejected_cells"]
+    else:
+        data_to_evaluate = zarr_file["data_to_valuate"][:]
+        accepted_cells = zarr_file["accepted_cells"][:]
+        rejected_cells = zarr_file["rejected_cells"][:]
+    data = MetricTable.from_array(zarr_file["data"][:])
     metrics = zarr_file["metrics"][:]
-    undo_stack = zarr_file["undo_stack"][:]
+    if "journal" in zarr_file:
+        undo_stack = UndoStack.from_zarr(zarr_file["journal"])
+    else:
+        undo_stack = zarr_file["undo_stack"][:]
     selfdrawn_lower_bound = zarr_file.attrs["selfdrawn_lower_bound"]
     return data_to_evaluate, accepted_cells, rejected_cells, data, metrics, undo_stack, selfdrawn_lower_bound
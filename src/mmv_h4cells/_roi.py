@@ -1,8 +1,274 @@
 import numpy as np
 import pandas as pd
-from typing import Tuple
+from typing import Iterator, Optional, Sequence, Tuple
 from napari.qt.threading import thread_worker
 
+from mmv_h4cells._label_index import compact_labels
+from mmv_h4cells._writer import TIFF_TILE_SIZE, label_dtype, write_tiff_tiles
+
+# optional per-cell features and the names of their columns
+ROI_FEATURES = {
+    "area": "area [px]",
+    "perimeter": "perimeter [px]",
+    "eccentricity": "eccentricity",
+    "mean_intensity": "mean intensity",
+}
+
+# columns that are always exported for each cell
+ROI_COLUMNS = ["id", "count [px]", "centroid (y,x)"]
+
+
+def _perimeter_pixels(labels: np.ndarray) -> np.ndarray:
+    """
+    Marks label pixels that have a 4-neighbour with a different label
+
+    Pixels at the border of the array count as boundary pixels.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        2D label image
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the boundary pixels
+    """
+    boundary = np.zeros(labels.shape, dtype=bool)
+    boundary[0, :] = boundary[-1, :] = True
+    boundary[:, 0] = boundary[:, -1] = True
+    vertical = labels[1:, :] != labels[:-1, :]
+    horizontal = labels[:, 1:] != labels[:, :-1]
+    boundary[1:, :] |= vertical
+    boundary[:-1, :] |= vertical
+    boundary[:, 1:] |= horizontal
+    boundary[:, :-1] |= horizontal
+    return boundary & (labels != 0)
+
+
+def label_statistics(
+    labels: np.ndarray,
+    offset: Tuple[int, int] = (0, 0),
+    features: Sequence[str] = (),
+    image: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    """
+    Computes per-cell statistics of a 2D label image in a single pass
+
+    All statistics are accumulated with np.bincount over the nonzero pixels,
+    so the cost does not depend on the amount of labels.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        2D label image
+    offset : tuple of int, optional
+        Position of the label image in the full image, added to centroids
+        and bounding boxes, by default (0, 0)
+    features : sequence of str, optional
+        Extra features to compute, keys of ROI_FEATURES, by default none
+    image : np.ndarray, optional
+        Intensity image of the same shape as labels, required for the mean
+        intensity
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per label sorted by id with the columns id, count [px],
+        centroid (y,x), bbox (y0,x0,y1,x1) and the requested features
+    """
+    unknown = set(features) - set(ROI_FEATURES)
+    if unknown:
+        raise ValueError(f"Unknown features: {sorted(unknown)}")
+    if "mean_intensity" in features and image is None:
+        raise ValueError("The mean intensity requires an image.")
+    labels = np.asarray(labels)
+    flat_labels = labels.ravel()
+    pixels = np.flatnonzero(flat_labels)
+    columns = ROI_COLUMNS + ["bbox (y0,x0,y1,x1)"]
+    columns += [ROI_FEATURES[feature] for feature in features]
+    if len(pixels) == 0:
+        return pd.DataFrame({column: [] for column in columns})
+
+    ids, bins = compact_labels(flat_labels[pixels].astype(np.int64))
+    n = len(ids)
+    y, x = np.unravel_index(pixels, labels.shape)
+    counts = np.bincount(bins, minlength=n)
+    sum_y = np.bincount(bins, weights=y, minlength=n)
+    sum_x = np.bincount(bins, weights=x, minlength=n)
+    # integer floor of the mean, like int(np.mean(...)) for positive values
+    centroid_y = (sum_y.astype(np.int64) // counts) + offset[0]
+    centroid_x = (sum_x.astype(np.int64) // counts) + offset[1]
+
+    lower_y = np.full(n, labels.shape[0], dtype=np.int64)
+    lower_x = np.full(n, labels.shape[1], dtype=np.int64)
+    upper_y = np.zeros(n, dtype=np.int64)
+    upper_x = np.zeros(n, dtype=np.int64)
+    np.minimum.at(lower_y, bins, y)
+    np.minimum.at(lower_x, bins, x)
+    np.maximum.at(upper_y, bins, y + 1)
+    np.maximum.at(upper_x, bins, x + 1)
+
+    df = pd.DataFrame(
+        {
+            "id": ids,
+            "count [px]": counts,
+            "centroid (y,x)": list(
+                zip(centroid_y.tolist(), centroid_x.tolist())
+            ),
+            "bbox (y0,x0,y1,x1)": list(
+                zip(
+                    (lower_y + offset[0]).tolist(),
+                    (lower_x + offset[1]).tolist(),
+                    (upper_y + offset[0]).tolist(),
+                    (upper_x + offset[1]).tolist(),
+                )
+            ),
+        }
+    )
+    if "area" in features:
+        df[ROI_FEATURES["area"]] = counts
+    if "perimeter" in features:
+        boundary = _perimeter_pixels(labels).ravel()[pixels]
+        df[ROI_FEATURES["perimeter"]] = np.bincount(
+            bins, weights=boundary, minlength=n
+        ).astype(np.int64)
+    if "eccentricity" in features:
+        mean_y = sum_y / counts
+        mean_x = sum_x / counts
+        cov_yy = np.bincount(bins, weights=y * y, minlength=n) / counts
+        cov_xx = np.bincount(bins, weights=x * x, minlength=n) / counts
+        cov_xy = np.bincount(bins, weights=y * x, minlength=n) / counts
+        cov_yy -= mean_y**2
+        cov_xx -= mean_x**2
+        cov_xy -= mean_y * mean_x
+        # eigenvalues of the covariance matrix of each label
+        half_trace = (cov_yy + cov_xx) / 2
+        root = np.sqrt(((cov_yy - cov_xx) / 2) ** 2 + cov_xy**2)
+        major = half_trace + root
+        minor = np.maximum(half_trace - root, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eccentricity = np.where(major > 0, np.sqrt(1 - minor / major), 0.0)
+        df[ROI_FEATURES["eccentricity"]] = np.round(eccentricity, 3)
+    if "mean_intensity" in features:
+        intensities = np.asarray(image).ravel()[pixels].astype(np.float64)
+        df[ROI_FEATURES["mean_intensity"]] = np.round(
+            np.bincount(bins, weights=intensities, minlength=n) / counts, 3
+        )
+    return df
+
+
+def iter_roi_tiles(
+    labels: np.ndarray, ids: np.ndarray, tile_size: int
+) -> Iterator[np.ndarray]:
+    """
+    Yields the tiles of a label image that only keep the given ids
+
+    The tiles are produced in row-major order as expected by tiled TIFF
+    writers. Only one tile is held in memory at a time and the label image
+    itself is never modified.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        2D label image, usually a view of the ROI in the full image
+    ids : np.ndarray
+        Ids of the labels to keep
+    tile_size : int
+        Edge length of the tiles, tiles at the border may be smaller
+
+    Yields
+    ------
+    np.ndarray
+        Filtered copy of the next tile
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    keep = None
+    if len(ids) and ids.max() < 2**24:
+        keep = np.zeros(int(ids.max()) + 2, dtype=bool)
+        keep[ids] = True
+    for y in range(0, labels.shape[0], tile_size):
+        for x in range(0, labels.shape[1], tile_size):
+            tile = np.array(labels[y : y + tile_size, x : x + tile_size])
+            if keep is None:
+                tile[~np.isin(tile, ids)] = 0
+            else:
+                # ids beyond the lookup table are mapped to its last entry
+                index = np.minimum(tile, len(keep) - 1)
+                tile[~keep[index]] = 0
+            yield tile
+
+
+def roi_statistics(
+    data: np.ndarray,
+    y: Tuple[int, int],
+    x: Tuple[int, int],
+    size_threshold: int,
+    features: Sequence[str] = (),
+    image: Optional[np.ndarray] = None,
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Computes the statistics of all cells in a ROI above a size threshold
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D label image, it is only read
+    y : tuple of int
+        Lower and upper row of the ROI
+    x : tuple of int
+        Lower and upper column of the ROI
+    size_threshold : int
+        Cells with at most this amount of pixels are left out
+    features : sequence of str, optional
+        Extra features to compute, keys of ROI_FEATURES, by default none
+    image : np.ndarray, optional
+        Intensity image of the same shape as data, by default None
+
+    Returns
+    -------
+    tuple
+        Statistics of the kept cells with the columns ROI_COLUMNS and the
+        requested features, and a view of the ROI in the label image
+    """
+    # view of the ROI, the label image itself is only read
+    cropped_mask = data[y[0] : y[1], x[0] : x[1]]
+    cropped_image = None
+    if image is not None:
+        cropped_image = image[y[0] : y[1], x[0] : x[1]]
+
+    # Get ids, counts, centroids and requested features of all cells
+    df = label_statistics(cropped_mask, (y[0], x[0]), features, cropped_image)
+    df = df[ROI_COLUMNS + [ROI_FEATURES[feature] for feature in features]]
+
+    # Filter ids by size threshold
+    return df[df["count [px]"] > size_threshold], cropped_mask
+
+
+def roi_metrics(
+    df: pd.DataFrame, size_threshold: int
+) -> Tuple[float, float, int]:
+    """
+    Returns the metrics row of a ROI export
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Statistics of the kept cells, see roi_statistics
+    size_threshold : int
+        Size threshold the cells were filtered by
+
+    Returns
+    -------
+    tuple
+        Mean and standard deviation of the cell sizes and the threshold
+    """
+    return (
+        np.round(df["count [px]"].mean(), 3),
+        np.round(df["count [px]"].std(), 3),
+        size_threshold,
+    )
+
 
 @thread_worker
 def analyse_roi(
@@ -11,41 +277,17 @@ def analyse_roi(
     x: Tuple[int, int],
     size_threshold: int,
     paths: Tuple[str, str],
+    features: Sequence[str] = (),
+    image: Optional[np.ndarray] = None,
 ):
-    cropped_mask = data[y[0]:y[1], x[0]:x[1]]
-    
-    # Get unique ids and counts
-    ids, counts = np.unique(cropped_mask, return_counts=True)
-
-    if ids[0] == 0: # Remove background
-        ids = ids[1:]
-        counts = counts[1:]    
-
-    # Get centroids
-    centroids = []
-    for id in ids:
-        mask_id = cropped_mask == id
-        y_id, x_id = np.where(mask_id)
-        centroid = (int(np.mean(y_id)) + y[0], int(np.mean(x_id)) + x[0]) 
-        centroids.append(centroid)     
-
-    # Create dataframe
-    df = pd.DataFrame({
-        'id': ids,
-        'count [px]': counts,
-        'centroid (y,x)': centroids
-    })
-
-    # Filter ids by size threshold
-    df = df[df['count [px]'] > size_threshold]
-
-    # Get full mask and ignore labels outside ROI
-    mask_outside_range = np.ones_like(data, dtype=bool)
-    mask_outside_range[y[0]:y[1], x[0]:x[1]] = False
-    data[mask_outside_range] = 0
+    df, cropped_mask = roi_statistics(
+        data, y, x, size_threshold, features, image
+    )
 
-    # Filter mask based on size_threshold
-    filtered_mask = np.isin(data, df[df['count [px]'] > size_threshold]['id'])
-    data[~filtered_mask] = 0
+    # Write the labels of the kept cells within the ROI tile by tile
+    ids = df["id"].to_numpy()
+    tiles = iter_roi_tiles(cropped_mask, ids, TIFF_TILE_SIZE)
+    dtype = label_dtype(int(ids.max(initial=0)))
+    write_tiff_tiles(paths[1], cropped_mask.shape, dtype, tiles)
 
-    return data, df, paths, size_threshold
\ No newline at end of file
+    return df, paths, size_threshold
@@ -0,0 +1,389 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from napari.qt.threading import thread_worker
+from skimage.draw import polygon2mask
+
+from mmv_h4cells._roi import (
+    ROI_COLUMNS,
+    ROI_FEATURES,
+    iter_roi_tiles,
+    label_statistics,
+    roi_metrics,
+)
+from mmv_h4cells._writer import (
+    TIFF_TILE_SIZE,
+    label_dtype,
+    write_csv,
+    write_table_csv,
+    write_tiff_tiles,
+)
+
+# start method of the worker processes, forking the multi-threaded napari
+# process can deadlock the workers
+POOL_START_METHOD = "spawn"
+
+# shape types of napari Shapes layers that can be used as ROIs
+ROI_SHAPE_TYPES = ("rectangle", "polygon")
+
+# columns of the summary table of a batch export
+SUMMARY_COLUMNS = [
+    "roi",
+    "cells",
+    "pixels [px]",
+    "mean size [px]",
+    "std size [px]",
+    "bbox (y0,x0,y1,x1)",
+    "seconds",
+]
+
+# arrays shared with the worker processes, filled by _attach_arrays
+_shared_arrays: Dict[str, Tuple[SharedMemory, np.ndarray]] = {}
+
+
+class Roi:
+    """
+    Rectangular or polygonal region of interest in a 2D image
+    """
+
+    def __init__(
+        self, name: str, vertices: np.ndarray, shape_type: str = "polygon"
+    ):
+        if shape_type not in ROI_SHAPE_TYPES:
+            raise ValueError(f"Unsupported ROI shape type: {shape_type}")
+        self.name = str(name)  # used in the names of the exported files
+        self.vertices = np.asarray(vertices, dtype=np.float64)[
+            :, -2:
+        ]  # (y, x) corners, leading axes of napari shapes dropped
+        self.shape_type = shape_type  # one of ROI_SHAPE_TYPES
+
+    def bbox(self, shape: Tuple[int, int]) -> Tuple[slice, slice]:
+        """
+        Returns the bounding box of the ROI clipped to an image
+
+        Parameters
+        ----------
+        shape : tuple of int
+            Shape of the image
+
+        Returns
+        -------
+        tuple of slice
+            Slices of the bounding box, empty if the ROI is outside the image
+        """
+        lower = np.floor(self.vertices.min(axis=0)).astype(int)
+        upper = np.ceil(self.vertices.max(axis=0)).astype(int)
+        if self.shape_type == "polygon":
+            upper += 1
+        lower = np.clip(lower, 0, shape)
+        upper = np.clip(upper, lower, shape)
+        return tuple(slice(int(lo), int(up)) for lo, up in zip(lower, upper))
+
+    def mask(self, region: Tuple[slice, slice]) -> Optional[np.ndarray]:
+        """
+        Returns the mask of the ROI within its bounding box
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Bounding box of the ROI, see bbox
+
+        Returns
+        -------
+        np.ndarray or None
+            Boolean mask of the pixels inside the polygon, None for
+            rectangles as all pixels of their bounding box are inside
+        """
+        if self.shape_type == "rectangle":
+            return None
+        shape = tuple(s.stop - s.start for s in region)
+        offset = np.array([s.start for s in region])
+        return polygon2mask(shape, self.vertices - offset)
+
+
+def rois_from_shapes(data: List[np.ndarray], shape_types: List[str]):
+    """
+    Creates ROIs from the shapes of a napari Shapes layer
+
+    Parameters
+    ----------
+    data : list of np.ndarray
+        Vertices of each shape, `Shapes.data`
+    shape_types : list of str
+        Type of each shape, `Shapes.shape_type`
+
+    Returns
+    -------
+    list of Roi
+        One ROI per shape, named by the index of the shape
+    """
+    unsupported = set(shape_types) - set(ROI_SHAPE_TYPES)
+    if unsupported:
+        raise ValueError(
+            f"Only rectangles and polygons can be used as ROIs, "
+            f"found {sorted(unsupported)}"
+        )
+    return [
+        Roi(str(i), vertices, shape_type)
+        for i, (vertices, shape_type) in enumerate(zip(data, shape_types))
+    ]
+
+
+def read_roi_csv(path: Path) -> List[Roi]:
+    """
+    Reads ROIs from a CSV file
+
+    Two layouts are supported: the CSV export of a napari Shapes layer with
+    the columns index, shape-type, vertex-index, axis-0 and axis-1, or one
+    rectangle per row with the columns y0, x0, y1, x1 and an optional name.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the CSV file
+
+    Returns
+    -------
+    list of Roi
+        ROIs in the order of the file
+    """
+    df = pd.read_csv(path)
+    df.columns = [str(column).strip() for column in df.columns]
+    axes = [column for column in df.columns if column.startswith("axis-")]
+    if axes:
+        axes = sorted(axes, key=lambda column: int(column.split("-")[1]))
+        return [
+            Roi(
+                str(index),
+                group.sort_values("vertex-index")[axes].to_numpy(),
+                group["shape-type"].iloc[0],
+            )
+            for index, group in df.groupby("index", sort=False)
+        ]
+    if not {"y0", "x0", "y1", "x1"} <= set(df.columns):
+        raise ValueError(
+            "ROI CSV needs the columns y0, x0, y1, x1 or the columns of a "
+            "napari Shapes layer export"
+        )
+    names = df["name"] if "name" in df.columns else df.index
+    return [
+        Roi(
+            str(name),
+            [
+                [row.y0, row.x0],
+                [row.y0, row.x1],
+                [row.y1, row.x1],
+                [row.y1, row.x0],
+            ],
+            "rectangle",
+        )
+        for name, row in zip(names, df.itertuples(index=False))
+    ]
+
+
+def _share_array(data: np.ndarray) -> Tuple[SharedMemory, np.ndarray]:
+    """Copies an array into a new shared memory block"""
+    shm = SharedMemory(create=True, size=max(data.nbytes, 1))
+    shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+    shared[...] = data
+    return shm, shared
+
+
+def _open_shared_memory(name: str) -> SharedMemory:
+    """Attaches to a shared memory block owned by the parent process"""
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    shm = SharedMemory(name=name)
+    # the parent unlinks the block, the worker must not track it as well
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _attach_arrays(specs: Dict[str, Tuple[str, tuple, str]]):
+    """Initializer of the worker processes, maps the shared arrays"""
+    for key, (name, shape, dtype) in specs.items():
+        shm = _open_shared_memory(name)
+        _shared_arrays[key] = (
+            shm,
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+        )
+
+
+def _analyse_roi_job(
+    roi: Roi,
+    size_threshold: int,
+    features: Sequence[str],
+    paths: Tuple[Path, Path],
+) -> dict:
+    """
+    Analyses a single ROI of the shared label image and writes its files
+
+    Parameters
+    ----------
+    roi : Roi
+        ROI to analyse
+    size_threshold : int
+        Cells with at most this amount of pixels are left out
+    features : sequence of str
+        Extra features to compute, keys of ROI_FEATURES
+    paths : tuple of Path
+        Paths of the CSV and TIFF file of the ROI
+
+    Returns
+    -------
+    dict
+        Row of the summary table
+    """
+    start = time.perf_counter()
+    labels = _shared_arrays["labels"][1]
+    region = roi.bbox(labels.shape)
+    cropped = labels[region]
+    mask = roi.mask(region)
+    if mask is not None:
+        cropped = np.where(mask, cropped, 0)
+    image = None
+    if "image" in _shared_arrays:
+        image = _shared_arrays["image"][1][region]
+
+    offset = tuple(s.start for s in region)
+    df = label_statistics(cropped, offset, features, image)
+    df = df[ROI_COLUMNS + [ROI_FEATURES[feature] for feature in features]]
+    df = df[df["count [px]"] > size_threshold]
+
+    metrics = roi_metrics(df, size_threshold)
+    write_csv(paths[0], df, metrics, list(df.columns[3:]))
+    ids = df["id"].to_numpy()
+    tiles = iter_roi_tiles(cropped, ids, TIFF_TILE_SIZE)
+    dtype = label_dtype(int(ids.max(initial=0)))
+    write_tiff_tiles(paths[1], cropped.shape, dtype, tiles)
+    return {
+        "roi": roi.name,
+        "cells": len(df),
+        "pixels [px]": int(cropped.size if mask is None else mask.sum()),
+        "mean size [px]": metrics[0],
+        "std size [px]": metrics[1],
+        "bbox (y0,x0,y1,x1)": (
+            region[0].start,
+            region[1].start,
+            region[0].stop,
+            region[1].stop,
+        ),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def analyse_rois(
+    labels: np.ndarray,
+    rois: List[Roi],
+    size_threshold: int,
+    summary_path: Path,
+    features: Sequence[str] = (),
+    image: Optional[np.ndarray] = None,
+    max_workers: Optional[int] = None,
+    progress: Callable[[int, int], None] = None,
+) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """
+    Analyses many ROIs of a label image on a process pool
+
+    The label image (and the intensity image) are copied once into shared
+    memory which all worker processes map, so no process receives a pickled
+    copy of the image. Every ROI gets a CSV and a TIFF file named after the
+    summary file and the ROI, e.g. `summary_roi3.csv`.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        2D label image, it is only read
+    rois : list of Roi
+        ROIs to analyse
+    size_threshold : int
+        Cells with at most this amount of pixels are left out
+    summary_path : Path
+        Path of the CSV file holding one summary row per ROI
+    features : sequence of str, optional
+        Extra features to compute, keys of ROI_FEATURES, by default none
+    image : np.ndarray, optional
+        Intensity image for the mean intensity, by default None
+    max_workers : int, optional
+        Amount of worker processes, by default the amount of CPUs
+    progress : callable, optional
+        Called with the amount of finished and total ROIs
+
+    Returns
+    -------
+    tuple
+        Summary table and throughput (rois, seconds, rois/s, Mpx/s)
+    """
+    summary_path = Path(summary_path)
+    names = [roi.name for roi in rois]
+    if len(set(names)) != len(names):
+        raise ValueError("ROI names must be unique")
+    start = time.perf_counter()
+    shared = {"labels": _share_array(np.asarray(labels))}
+    if image is not None:
+        shared["image"] = _share_array(np.asarray(image))
+    specs = {
+        key: (shm.name, array.shape, array.dtype.str)
+        for key, (shm, array) in shared.items()
+    }
+    rows = [None] * len(rois)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(POOL_START_METHOD),
+            initializer=_attach_arrays,
+            initargs=(specs,),
+        ) as executor:
+            futures = {}
+            for i, roi in enumerate(rois):
+                stem = f"{summary_path.stem}_roi{roi.name}"
+                paths = (
+                    summary_path.with_name(stem + ".csv"),
+                    summary_path.with_name(stem + ".tiff"),
+                )
+                future = executor.submit(
+                    _analyse_roi_job, roi, size_threshold, features, paths
+                )
+                futures[future] = i
+            for done, future in enumerate(as_completed(futures), 1):
+                rows[futures[future]] = future.result()
+                if progress is not None:
+                    progress(done, len(rois))
+    finally:
+        for shm, _ in shared.values():
+            shm.close()
+            shm.unlink()
+
+    summary = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+    write_table_csv(summary_path, summary)
+    seconds = time.perf_counter() - start
+    pixels = float(summary["pixels [px]"].sum()) if len(summary) else 0.0
+    throughput = {
+        "rois": len(rois),
+        "seconds": round(seconds, 3),
+        "rois/s": round(len(rois) / seconds, 3) if seconds else 0.0,
+        "Mpx/s": round(pixels / 1e6 / seconds, 3) if seconds else 0.0,
+    }
+    return summary, throughput
+
+
+@thread_worker
+def analyse_roi_batch(
+    labels: np.ndarray,
+    rois: List[Roi],
+    size_threshold: int,
+    summary_path: Path,
+    features: Sequence[str] = (),
+    image: Optional[np.ndarray] = None,
+):
+    summary, throughput = analyse_rois(
+        labels, rois, size_threshold, summary_path, features, image
+    )
+    return summary, throughput, summary_path
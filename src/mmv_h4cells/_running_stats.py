@@ -0,0 +1,149 @@
+import math
+import numpy as np
+from typing import Optional
+
+
+class RunningStats:
+    """
+    Count, mean, standard deviation, minimum and maximum of a series
+
+    Values can be added and removed one at a time in O(1) with Welford's
+    algorithm, so statistics of the included cells stay current without
+    summing over all cells after every decision. Removing the current
+    minimum or maximum marks it as unknown, it is recomputed from the
+    values on the next request.
+    """
+
+    def __init__(self):
+        self.count = 0  # amount of values
+        self.mean = 0.0  # mean of the values
+        self.m2 = 0.0  # sum of the squared differences from the mean
+        self.minimum: Optional[float] = None  # smallest value, None if unknown
+        self.maximum: Optional[float] = None  # largest value, None if unknown
+
+    @classmethod
+    def from_values(cls, values: np.ndarray) -> "RunningStats":
+        """
+        Computes the statistics of all values at once
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Values of the series
+
+        Returns
+        -------
+        RunningStats
+            Statistics of the values
+        """
+        stats = cls()
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return stats
+        stats.count = len(values)
+        stats.mean = float(np.mean(values))
+        stats.m2 = float(np.sum((values - stats.mean) ** 2))
+        stats.minimum = float(np.min(values))
+        stats.maximum = float(np.max(values))
+        return stats
+
+    def add(self, value: float):
+        """Adds a value to the series"""
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.count == 1:
+            self.minimum = self.maximum = value
+        else:
+            if self.minimum is not None and value < self.minimum:
+                self.minimum = value
+            if self.maximum is not None and value > self.maximum:
+                self.maximum = value
+
+    def merge(self, other: "RunningStats"):
+        """
+        Adds all values of another series at once
+
+        The statistics are combined with the parallel variant of Welford's
+        algorithm, so adding many values costs as much as adding one.
+
+        Parameters
+        ----------
+        other : RunningStats
+            Statistics of the values to add
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.minimum, self.maximum = other.minimum, other.maximum
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        # extrema unknown on either side stay unknown
+        if self.minimum is not None and other.minimum is not None:
+            self.minimum = min(self.minimum, other.minimum)
+        else:
+            self.minimum = None
+        if self.maximum is not None and other.maximum is not None:
+            self.maximum = max(self.maximum, other.maximum)
+        else:
+            self.maximum = None
+
+    def remove(self, value: float):
+        """Removes a value that was added to the series"""
+        value = float(value)
+        if self.count <= 1:
+            self.__init__()
+            return
+        mean = (self.count * self.mean - value) / (self.count - 1)
+        self.m2 = max(self.m2 - (value - self.mean) * (value - mean), 0.0)
+        self.mean = mean
+        self.count -= 1
+        if value == self.minimum:
+            self.minimum = None
+        if value == self.maximum:
+            self.maximum = None
+
+    def variance(self, ddof: int = 0) -> float:
+        """
+        Returns the variance of the series
+
+        Parameters
+        ----------
+        ddof : int, optional
+            Delta degrees of freedom, by default 0 like np.var
+
+        Returns
+        -------
+        float
+            Variance, 0 if there are not more values than ddof
+        """
+        if self.count <= ddof:
+            return 0.0
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof: int = 0) -> float:
+        """Returns the standard deviation of the series, see variance"""
+        return math.sqrt(self.variance(ddof))
+
+    def update_extrema(self, values: np.ndarray):
+        """
+        Recomputes unknown extrema from all values of the series
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Current values of the series
+        """
+        if self.count == 0:
+            return
+        if self.minimum is None:
+            self.minimum = float(np.min(values))
+        if self.maximum is None:
+            self.maximum = float(np.max(values))
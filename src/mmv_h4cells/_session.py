@@ -0,0 +1,1216 @@
+import logging
+import numpy as np
+import pandas as pd
+import threading
+import zarr
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from scipy import ndimage
+
+from mmv_h4cells._autosave import SessionChanges, SessionUpdate
+from mmv_h4cells._cell_store import CellStore
+from mmv_h4cells._export import SessionExport
+from mmv_h4cells._id_queue import IdQueue
+from mmv_h4cells._metric_table import MetricTable
+from mmv_h4cells._prefetch import CellPrefetcher
+from mmv_h4cells._label_index import (
+    LabelIndex,
+    crop_region,
+    full_region,
+    store_region,
+)
+from mmv_h4cells._undo import JOURNAL_ARRAYS, PixelDiff, UndoEntry, UndoStack
+from mmv_h4cells._zarr_store import CopyOnWriteStore, open_lazy_labels
+from mmv_h4cells._writer import (
+    ZARR_COMPRESSOR,
+    ZARR_LABEL_IMAGES,
+    update_zarr,
+    zarr_chunks,
+)
+
+
+class AnalysisSession:
+    """
+    Decision state of a cell evaluation without any user interface
+
+    The session holds the label image, the accepted and rejected cells,
+    the remaining ids, the metric data and the undo journal. All steps of
+    an evaluation (include, exclude, undo, redo, choosing the next cell and
+    exporting) are plain NumPy operations, so evaluations can be scripted,
+    replayed and profiled without a viewer or event loop. The widget keeps
+    a session and only adds dialogs and layers on top of it.
+    """
+
+    def __init__(self, labels: np.ndarray = None):
+        self.logger = logging.getLogger(__name__)
+        self.labels: np.ndarray = (
+            None  # label image with remaining and included cells
+        )
+        self.accepted_store: CellStore = (
+            None  # label image esque for all accepted cells
+        )
+        self.rejected_store: CellStore = (
+            None  # label image esque for all rejected cells
+        )
+        self.metric_table: MetricTable = (
+            MetricTable()
+        )  # cell-id and metric data of all included cells
+        self.mean_size: float = 0  # mean size of all selected cells
+        self.std_size: float = (
+            0  # standard deviation of size of all selected cells
+        )
+        self.remaining_queue: IdQueue = (
+            IdQueue()
+        )  # sorted ids of all remaining cells
+        self.included: Set[int] = set()  # set of all included cell ids
+        self.excluded: Set[int] = set()  # set of all excluded cell ids
+        self.undo_entries: UndoStack = (
+            UndoStack()
+        )  # stack of evaluation steps to undo
+        self.label_index: LabelIndex = (
+            None  # bounding boxes, sizes and centroids of all labels
+        )
+        self.next_id: int = None  # computed id of the next cell to evaluate
+        self.selfdrawn_lower_bound: int = (
+            None  # lower bound of self drawn cell id
+        )
+        self.changes: SessionChanges = (
+            None  # parts of the session changed since it was last saved
+        )
+        self.save_path: Path = (
+            None  # zarr session the changes are saved to, set by export
+        )
+        self.save_generation: int = (
+            0  # amount of exports, updates of older exports are dropped
+        )
+        self.save_lock = threading.Lock()  # serializes writes of the session
+        self.running_export: SessionExport = (
+            None  # export being written, see start_export
+        )
+        self.prefetcher = CellPrefetcher(
+            self
+        )  # reads the cells following the displayed one ahead of time
+        if labels is not None:
+            self.set_labels(labels)
+
+    @property
+    def remaining(self) -> IdQueue:
+        """Sorted set of all remaining cell ids"""
+        return self.remaining_queue
+
+    @remaining.setter
+    def remaining(self, ids: Set[int]):
+        self.remaining_queue = (
+            ids if isinstance(ids, IdQueue) else IdQueue(ids)
+        )
+
+    @property
+    def metric_data(self) -> MetricTable:
+        """Table of the cell-ids and metric data of all included cells"""
+        return self.metric_table
+
+    @metric_data.setter
+    def metric_data(self, rows: Iterable[Tuple[int, int, Tuple[int, int]]]):
+        self.metric_table = (
+            rows if isinstance(rows, MetricTable) else MetricTable(rows)
+        )
+
+    @property
+    def undo_stack(self) -> UndoStack:
+        """Stack of evaluated cell ids that can be undone"""
+        return self.undo_entries
+
+    @undo_stack.setter
+    def undo_stack(self, entries: List[int]):
+        self.undo_entries = (
+            entries if isinstance(entries, UndoStack) else UndoStack(entries)
+        )
+
+    @property
+    def accepted_cells(self) -> np.ndarray:
+        """Label image of all accepted cells"""
+        if self.accepted_store is None:
+            return None
+        return self.accepted_store.data
+
+    @accepted_cells.setter
+    def accepted_cells(self, data: np.ndarray):
+        self.accepted_store = CellStore.from_array(data)
+
+    @property
+    def rejected_cells(self) -> np.ndarray:
+        """Label image of all rejected cells"""
+        if self.rejected_store is None:
+            return None
+        return self.rejected_store.data
+
+    @rejected_cells.setter
+    def rejected_cells(self, data: np.ndarray):
+        self.rejected_store = CellStore.from_array(data)
+
+    def set_labels(self, labels: np.ndarray):
+        """
+        Sets the label image to evaluate and indexes its cells.
+
+        Without metric data the accepted and rejected cells are reset and
+        all cells of the label image become remaining.
+
+        Label images that are not NumPy arrays, like zarr or dask arrays,
+        are never loaded as a whole. They are indexed chunk by chunk, edits
+        go to a zarr array reading unchanged chunks from the original, see
+        open_lazy_labels, and the accepted and rejected cells are kept in
+        compressed in-memory zarr arrays of the same chunk shape.
+
+        Parameters
+        ----------
+        labels : np.ndarray
+            Label image, it is modified in place during the evaluation
+        """
+        labels = open_lazy_labels(labels, zarr_chunks(labels.shape))
+        self.prefetcher.invalidate()
+        self.labels = labels
+        self.label_index = LabelIndex.from_array(labels)
+        if self.selfdrawn_lower_bound is None:
+            self.selfdrawn_lower_bound = self.label_index.max_id + 1
+        if len(self.metric_data) == 0:
+            self.accepted_store = CellStore(self.empty_labels())
+            self.rejected_store = CellStore(self.empty_labels())
+            self.remaining = set(self.label_index.ids.tolist())
+        self.next_id = self.remaining.lowest()
+        self.save_path = None
+        self.reset_changes()
+
+    def empty_labels(self) -> np.ndarray:
+        """
+        Returns an empty label image of the shape of the evaluated one
+
+        Returns
+        -------
+        np.ndarray or zarr.Array
+            NumPy array for NumPy label images, otherwise an in-memory zarr
+            array whose chunks are only allocated once they are written
+        """
+        if isinstance(self.labels, np.ndarray):
+            return np.zeros(self.labels.shape, dtype=self.labels.dtype)
+        return zarr.zeros(
+            self.labels.shape,
+            chunks=zarr_chunks(self.labels.shape),
+            dtype=self.labels.dtype,
+            compressor=ZARR_COMPRESSOR,
+        )
+
+    def load(
+        self,
+        labels: np.ndarray,
+        accepted_cells: np.ndarray,
+        rejected_cells: np.ndarray,
+        metric_data: List[Tuple[int, int, Tuple[int, int]]],
+        metrics: Tuple[float, float],
+        undo_stack: Union[UndoStack, List[int]],
+        selfdrawn_lower_bound: int,
+    ):
+        """
+        Restores a session as returned by `read` for a zarr file.
+
+        Parameters
+        ----------
+        labels : np.ndarray
+            Label image with the remaining and included cells
+        accepted_cells : np.ndarray
+            Label image of the accepted cells
+        rejected_cells : np.ndarray
+            Label image of the rejected cells
+        metric_data : list of tuple
+            Metric data rows of the included cells
+        metrics : tuple of float
+            Mean and standard deviation of the cell sizes
+        undo_stack : UndoStack or list of int
+            Journal or evaluated cell ids in order of evaluation
+        selfdrawn_lower_bound : int
+            Lowest id of self drawn cells
+        """
+        self.selfdrawn_lower_bound = selfdrawn_lower_bound
+        self.metric_data = metric_data
+        self.set_labels(labels)
+        self.accepted_cells = accepted_cells
+        self.rejected_cells = rejected_cells
+        self.mean_size, self.std_size = metrics
+        self.included = set(self.accepted_store.regions)
+        self.excluded = set(self.rejected_store.regions)
+        if not isinstance(undo_stack, UndoStack):
+            undo_stack = np.asarray(undo_stack).tolist()
+        self.undo_stack = self.restore_undo_entries(undo_stack)
+        self.remaining = set(self.label_index.ids.tolist()) - (
+            self.included | self.excluded
+        )
+        self.next_id = self.remaining.lowest()
+        self.reset_changes()
+
+    def export(self, csv_filepath: Path):
+        """
+        Writes the analysis csv, the accepted cells and the session.
+
+        The tiff and zarr files are written next to the csv file. Later
+        changes can be saved to the zarr file with `save_changes`. See
+        `start_export` for exporting on another thread.
+
+        Parameters
+        ----------
+        csv_filepath : Path
+            Path of the csv file
+        """
+        export = self.start_export()
+        try:
+            export.write(csv_filepath)
+        except BaseException:
+            self.abort_export(export)
+            raise
+        self.finish_export(export)
+
+    def start_export(self) -> SessionExport:
+        """
+        Takes a snapshot of the session for writing it on another thread.
+
+        Nothing is copied but the metric data and the undo journal. Chunks
+        of the label images are copied when they are edited while the
+        export is running, so the evaluation can go on. Autosaving is paused
+        until `finish_export` or `abort_export` is called.
+
+        Returns
+        -------
+        SessionExport
+            Snapshot to write with `SessionExport.run`
+
+        Raises
+        ------
+        RuntimeError
+            If an export is already running
+        """
+        if self.running_export is not None:
+            raise RuntimeError("An export is already running")
+        self.metric_data.sort()
+        changes = self.changes
+        self.reset_changes()
+        self.running_export = SessionExport(
+            self.labels,
+            self.accepted_cells,
+            self.rejected_cells,
+            self.metric_data,
+            (self.mean_size, self.std_size),
+            self.undo_stack,
+            self.selfdrawn_lower_bound,
+            changes,
+        )
+        return self.running_export
+
+    def finish_export(self, export: SessionExport):
+        """
+        Moves the written files of an export into place.
+
+        The exported zarr session becomes the target of `save_changes`,
+        changes made while the export was running are saved by the next
+        autosave.
+
+        Parameters
+        ----------
+        export : SessionExport
+            Export returned by `start_export` that was written completely
+        """
+        zarr_path = export.csv_filepath.with_suffix(".zarr")
+        with self.save_lock:
+            for data in self.journal_arrays().values():
+                # lazily opened label images still read from the session that
+                # is about to be replaced
+                store = getattr(data, "store", None)
+                if isinstance(store, CopyOnWriteStore) and store.is_based_on(
+                    zarr_path
+                ):
+                    store.detach()
+            export.commit()
+            self.save_path = zarr_path
+            self.save_generation += 1
+        self.running_export = None
+        self.logger.debug(f"Exported session to {zarr_path}")
+
+    def abort_export(self, export: SessionExport):
+        """
+        Removes the files of a cancelled or failed export.
+
+        The changes the export would have saved are marked as unsaved again.
+
+        Parameters
+        ----------
+        export : SessionExport
+            Export returned by `start_export`
+        """
+        export.discard()
+        self.changes.merge(export.changes)
+        # the metric data was sorted for the export, the saved session holds
+        # the previous order
+        self.changes.mark_metric(0)
+        self.running_export = None
+
+    def cancel_export(self):
+        """Stops the running export, see `SessionExport.cancel`"""
+        if self.running_export is not None:
+            self.running_export.cancel()
+
+    def reset_changes(self):
+        """Marks the current state of the session as saved."""
+        self.changes = SessionChanges(
+            zarr_chunks(self.labels.shape),
+            len(self.undo_stack),
+            len(self.metric_data),
+        )
+
+    def has_unsaved_changes(self) -> bool:
+        """
+        Returns whether the exported session lacks changes.
+
+        Returns
+        -------
+        bool
+            Whether the session was exported and changed since then, False
+            while an export is running
+        """
+        if self.save_path is None or self.running_export is not None:
+            return False
+        return self.changes.pending(
+            len(self.undo_stack), len(self.metric_data)
+        )
+
+    def snapshot_changes(self) -> Optional[SessionUpdate]:
+        """
+        Takes the changes since the last save for `save_changes`.
+
+        Only the changed chunks of the label images are copied. The changes
+        are marked as saved, `restore_changes` marks them again if saving
+        fails.
+
+        Returns
+        -------
+        SessionUpdate or None
+            Changes to save, None if there are none
+        """
+        if not self.has_unsaved_changes():
+            return None
+        changes = self.changes
+        self.reset_changes()
+        arrays = dict(
+            zip(
+                ZARR_LABEL_IMAGES,
+                (self.labels, self.accepted_cells, self.rejected_cells),
+            )
+        )
+        label_chunks = {name: [] for name in arrays}
+        for chunk in sorted(changes.chunks):
+            region = changes.chunk_region(chunk, self.labels.shape)
+            for name, data in arrays.items():
+                label_chunks[name].append((region, np.array(data[region])))
+        return SessionUpdate(
+            changes,
+            label_chunks,
+            self.metric_data[changes.metric_start :],
+            (self.mean_size, self.std_size),
+            self.undo_stack.entries[changes.undo_start :],
+            list(self.undo_stack.redo_entries),
+            self.selfdrawn_lower_bound,
+            self.save_generation,
+        )
+
+    def save_changes(self, update: SessionUpdate) -> bool:
+        """
+        Writes changes into the exported zarr session.
+
+        Can be called from another thread than the evaluation. Changes taken
+        before the last export are dropped, that export already holds them.
+
+        Parameters
+        ----------
+        update : SessionUpdate
+            Changes returned by `snapshot_changes`
+
+        Returns
+        -------
+        bool
+            Whether the changes were written
+        """
+        with self.save_lock:
+            if update.generation != self.save_generation:
+                return False
+            update_zarr(self.save_path, update)
+        self.logger.debug(
+            f"Saved {len(update.changes.chunks)} changed chunks to "
+            f"{self.save_path}"
+        )
+        return True
+
+    def restore_changes(self, update: SessionUpdate):
+        """
+        Marks the changes of an update that could not be saved again.
+
+        Parameters
+        ----------
+        update : SessionUpdate
+            Changes returned by `snapshot_changes`
+        """
+        self.changes.merge(update.changes)
+
+    def get_cell_mask(
+        self, cell_id: int, prefetched: bool = False
+    ) -> Tuple[Tuple[slice, ...], np.ndarray]:
+        """
+        Returns the bounding box of a cell and its mask within that box.
+
+        Cells missing from the label index, or whose pixels no longer match
+        the index because the label image was edited, are searched in the
+        whole label image block by block and (re-)added to the index.
+
+        Parameters
+        ----------
+        cell_id : int
+            Id of the cell
+        prefetched : bool, optional
+            Whether a cell read ahead by `prefetch` may be returned without
+            reading the label image, by default False
+
+        Returns
+        -------
+        tuple
+            Slices of the bounding box and boolean mask of the cell inside it
+        """
+        if prefetched:
+            cell = self.prefetcher.take(cell_id)
+            if cell is not None:
+                return cell.region, cell.mask
+        data = self.labels
+        if cell_id in self.label_index:
+            region, mask = self.label_index.mask(data, cell_id)
+            if np.count_nonzero(mask) == self.label_index.count(cell_id):
+                return region, mask
+        self.logger.debug(f"Cell {cell_id} not indexed, searching image")
+        self.label_index.search(data, cell_id)
+        return self.label_index.mask(data, cell_id)
+
+    def prefetch(self, cell_id: int):
+        """
+        Reads the cells following a cell in the background.
+
+        The next PREFETCH_DEPTH remaining ids in navigation order are read
+        on a worker thread, `get_cell_mask` with `prefetched` then returns
+        them at once.
+
+        Parameters
+        ----------
+        cell_id : int
+            Id of the displayed cell
+        """
+        self.prefetcher.schedule(cell_id)
+
+    def preserve_region(self, region: Optional[Tuple[slice, ...]]):
+        """
+        Keeps a region for the running export before it is edited.
+
+        Parameters
+        ----------
+        region : tuple of slice or None
+            Region about to be edited, None if nothing is edited
+        """
+        if self.running_export is not None:
+            self.running_export.preserve(region)
+
+    def mark_changed(self, region: Optional[Tuple[slice, ...]]):
+        """
+        Records an edit of the label images.
+
+        The region is saved by the next autosave and prefetched cells
+        intersecting it are read again.
+
+        Parameters
+        ----------
+        region : tuple of slice or None
+            Edited region, None if nothing was written
+        """
+        self.changes.mark_region(region)
+        if region is not None:
+            self.prefetcher.invalidate(region)
+
+    def labels_edited(self, region: Optional[Tuple[slice, ...]]):
+        """
+        Updates the session after the label image was edited outside of it.
+
+        Painting into the label layer changes the label image directly. The
+        labels within the edited region are indexed again without reading
+        the rest of the image, cells painted over completely are no longer
+        remaining and new labels become remaining. Excluded cells keep their
+        index entries so undoing their exclusion does not search the whole
+        image. The region is saved by the next autosave.
+
+        Parameters
+        ----------
+        region : tuple of slice or None
+            Region containing all edited pixels, None if nothing was edited
+        """
+        if region is None:
+            return
+        added, removed = self.label_index.update_region(
+            self.labels, region, self.excluded
+        )
+        for id_ in removed:
+            self.remaining.discard(id_)
+        for id_ in added:
+            if id_ not in self.included and id_ not in self.excluded:
+                self.remaining.add(id_)
+        self.mark_changed(region)
+
+    def start(self, start_id: int) -> int:
+        """
+        Chooses the first cell of an evaluation.
+
+        Parameters
+        ----------
+        start_id : int
+            Requested id, replaced by the next lower or the lowest remaining
+            id if it is not remaining
+
+        Returns
+        -------
+        int
+            Id of the first cell
+        """
+        if start_id not in self.remaining:
+            self.logger.warning("Start id not in remaining ids")
+            lower_id = self.remaining.next_lower(start_id)
+            start_id = (
+                lower_id if lower_id is not None else self.remaining.lowest()
+            )
+        self.next_id = self.remaining.next_higher(start_id)
+        return start_id
+
+    def choose_next_id(
+        self, given_id: Optional[int] = None, ignore_jump_back: bool = False
+    ) -> Tuple[int, bool]:
+        """
+        Chooses the next cell to evaluate.
+
+        Parameters
+        ----------
+        given_id : int, optional
+            Id requested by the user, by default the computed next id
+        ignore_jump_back : bool, optional
+            Whether jumping back to lower ids is expected, by default False
+
+        Returns
+        -------
+        tuple
+            Id of the next cell and whether the evaluation jumped back to
+            lower ids as no higher id is remaining
+        """
+        last_evaluated_id = (
+            self.undo_stack[-1] if len(self.undo_stack) > 0 else 0
+        )
+        self.logger.debug(f"Last evaluated id: {last_evaluated_id}")
+        next_lower = next_higher = None
+        if given_id is not None:
+            next_lower = self.remaining.next_lower(given_id)
+            next_higher = self.remaining.next_higher(given_id)
+        computed_id = self.next_id
+        jumped_back = False
+
+        if given_id is None:
+            # no valid id given
+            next_id = computed_id
+        elif given_id == computed_id:
+            # id was not changed
+            if computed_id < last_evaluated_id and not ignore_jump_back:
+                # jump back to lowest unprocessed id
+                self.logger.debug("No higher id remaining")
+                jumped_back = True
+            next_id = computed_id
+        elif given_id != computed_id and given_id in self.remaining:
+            # id was changed and is in remaining
+            next_id = given_id
+        elif given_id > computed_id:
+            # id was increased and is not in remaining
+            next_id = next_lower
+        else:
+            # given_id < computed_id -> id was decreased and is not in remaining
+            if given_id > last_evaluated_id:
+                # maybe others < last < given < computed
+                next_id = next_lower if next_lower is not None else computed_id
+            elif computed_id < last_evaluated_id and not ignore_jump_back:
+                # given < computed (smallest existing) < maybe others < last
+                next_id = computed_id
+            else:
+                # others? < given < others? < computed < last (self drawn)
+                # others? < given < others? < last < computed
+                next_id = next_lower if next_lower is not None else next_higher
+        return next_id, jumped_back
+
+    def advance(self, current_id: int) -> Optional[int]:
+        """
+        Computes the id following the displayed cell.
+
+        Parameters
+        ----------
+        current_id : int
+            Id of the displayed cell
+
+        Returns
+        -------
+        int or None
+            Next id, wrapping around to the lowest id, None if no other cell
+            is remaining
+        """
+        if len(self.remaining) > 1:
+            self.next_id = self.remaining.next_higher(current_id)
+            if self.next_id is None:
+                self.next_id = self.remaining.lowest()
+        else:
+            self.next_id = None
+        return self.next_id
+
+    def include_cell(
+        self,
+        id_: int,
+        cell: np.ndarray = None,
+        region: Tuple[slice, ...] = None,
+        self_drawn: bool = False,
+    ):
+        """
+        Includes a cell and records the step for undo.
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+        cell : np.ndarray, optional
+            Labels of the cell within the region, by default the cell of the
+            label image
+        region : tuple of slice, optional
+            Region of the image covered by cell, by default the bounding box
+            of the cell
+        self_drawn : bool, optional
+            Whether the cell was drawn by the user and has to be added to the
+            label image, by default False
+
+        Returns
+        -------
+        tuple
+            Row of the metric data added for the cell
+        """
+        if cell is None:
+            region, mask = self.get_cell_mask(id_)
+            cell = mask * id_
+        cropped = crop_region(region, cell)
+        before = None
+        if cropped is not None:
+            region, cell = cropped
+            before = self.copy_region(region)
+        metric = self.include(id_, cell, not self_drawn, region)
+        if self_drawn:
+            evaluate = self.labels[region]
+            evaluate += cell
+            store_region(self.labels, region, evaluate)
+            self.label_index.add(id_, region, cell == id_)
+        self.mark_changed(region)
+        self.undo_stack.push(
+            UndoEntry(
+                id_,
+                UndoEntry.INCLUDE,
+                region,
+                metric,
+                self.diff_region(region, before),
+            )
+        )
+        return metric
+
+    def exclude_cell(
+        self,
+        id_: int,
+        mask: np.ndarray = None,
+        region: Tuple[slice, ...] = None,
+    ):
+        """
+        Excludes a cell and records the step for undo.
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+        mask : np.ndarray, optional
+            Mask of the cell within the region, by default the cell of the
+            label image
+        region : tuple of slice, optional
+            Region of the image covered by mask, by default the bounding box
+            of the cell
+        """
+        if mask is None:
+            region, mask = self.get_cell_mask(id_)
+        self.excluded.add(id_)
+        self.remaining.remove(id_)
+
+        cropped = crop_region(region, mask)
+        region = before = None
+        if cropped is not None:
+            region, mask = cropped
+            before = self.copy_region(region)
+            self.rejected_store.add(id_, region, mask)
+            evaluate = self.labels[region]
+            evaluate[mask] = 0
+            store_region(self.labels, region, evaluate)
+        self.mark_changed(region)
+        self.undo_stack.push(
+            UndoEntry(
+                id_,
+                UndoEntry.EXCLUDE,
+                region,
+                diffs=self.diff_region(region, before),
+            )
+        )
+
+    def include_multiple(
+        self, ids: Iterable[int]
+    ) -> Tuple[Set[int], Set[int], Set[int], Set[int]]:
+        """
+        Includes several remaining cells at once.
+
+        All ids are validated against the label index in one step. The
+        masks of the valid cells are read and checked for overlap with the
+        accepted cells, the cells that do not overlap are then written to
+        the accepted cells with their undo entries, while the metric data
+        and statistics are updated once for all of them.
+
+        Parameters
+        ----------
+        ids : iterable of int
+            Ids of the cells, cells are included in the given order
+
+        Returns
+        -------
+        tuple of set
+            Included ids, ids that were already evaluated, ids overlapping
+            accepted cells and ids that do not exist
+        """
+        self.logger.debug("Including multiple cells...")
+        ids = pd.unique(np.asarray(list(ids), dtype=np.int64))
+        ids = ids[ids != 0]
+        # excluded cells are no longer part of the label image
+        known = np.isin(ids, self.label_index.ids) & ~np.isin(
+            ids, np.fromiter(self.excluded, np.int64, len(self.excluded))
+        )
+        faulty = set(ids[~known].tolist())
+        ids = ids[known]
+        remaining = np.fromiter(
+            (id_ in self.remaining for id_ in ids.tolist()), bool, len(ids)
+        )
+        ignored = set(ids[~remaining].tolist())
+        overlapped = set()
+        cells = []
+        for id_ in ids[remaining].tolist():
+            try:
+                region, mask = self.get_cell_mask(id_)
+            except KeyError:
+                faulty.add(id_)
+                continue
+            if np.any(self.accepted_cells[region][mask]):
+                overlapped.add(id_)
+                continue
+            cells.append((id_, region, mask))
+
+        # the masks match the index, so sizes and centroids are read from it
+        positions = np.searchsorted(
+            self.label_index.ids, [id_ for id_, _, _ in cells]
+        ).astype(np.intp)
+        sizes = self.label_index.counts[positions].tolist()
+        centroids = self.label_index.centroids[positions].astype(np.int64)
+        metrics = []
+        for (id_, region, mask), size, centroid in zip(
+            cells, sizes, centroids.tolist()
+        ):
+            self.preserve_region(region)
+            self.accepted_store.add(id_, region, mask, crop=False)
+            self.remaining.remove(id_)
+            self.included.add(id_)
+            metric = (id_, size, tuple(centroid))
+            metrics.append(metric)
+            self.mark_changed(region)
+            diff = PixelDiff.from_mask(region, mask, 0, id_)
+            self.undo_stack.push(
+                UndoEntry(
+                    id_,
+                    UndoEntry.INCLUDE,
+                    region,
+                    metric,
+                    {} if diff is None else {"accepted_cells": diff},
+                )
+            )
+        self.metric_data.extend(metrics)
+        self.calculate_metrics()
+        self.logger.debug("Multiple cells evaluated")
+        return {id_ for id_, _, _ in cells}, ignored, overlapped, faulty
+
+    def include(
+        self,
+        id_: int,
+        data_array: np.ndarray,
+        remove_from_remaining: bool = True,
+        region: Tuple[slice, ...] = None,
+    ):
+        """
+        Includes a cell in the accepted cells.
+
+        Parameters
+        ----------
+        id_ : int
+            Id of the cell
+        data_array : np.ndarray
+            Labels of the cell within the region
+        remove_from_remaining : bool, optional
+            Whether to remove the cell from the remaining cells, by default True
+        region : tuple of slice, optional
+            Region of the image covered by data_array, by default the whole image
+
+        Returns
+        -------
+        tuple
+            Row of the metric data added for the cell
+        """
+        if region is None:
+            region = full_region(data_array.shape)
+        cropped = crop_region(region, data_array)
+        if cropped is not None:
+            region, data_array = cropped
+            self.accepted_store.add(id_, region, data_array != 0)
+        if remove_from_remaining:
+            self.remaining.remove(id_)
+        self.included.add(id_)
+
+        return self.add_cell_to_accepted(id_, data_array, region)
+
+    def add_cell_to_accepted(
+        self,
+        cell_id: int,
+        data: np.ndarray,
+        region: Tuple[slice, ...] = None,
+    ):
+        """
+        Adds the metric data row of an accepted cell.
+
+        Parameters
+        ----------
+        cell_id : int
+            Id of the cell
+        data : np.ndarray
+            Labels of the cell within the region
+        region : tuple of slice, optional
+            Region of the image covered by data, by default the whole image
+
+        Returns
+        -------
+        tuple
+            Row of the metric data
+        """
+        self.included.add(cell_id)
+        if region is None:
+            region = full_region(data.shape)
+        centroid = ndimage.center_of_mass(data)
+        centroid = tuple(
+            int(value + s.start) for value, s in zip(centroid, region)
+        )
+        metric = (
+            cell_id,
+            np.count_nonzero(data),
+            centroid,
+        )
+        self.metric_data.append(metric)
+
+        self.calculate_metrics()
+        return metric
+
+    def calculate_metrics(self):
+        """
+        Updates mean and standard deviation of the included cell sizes.
+
+        Reads the running statistics of the metric data, so the cost does
+        not depend on the amount of included cells.
+        """
+        stats = self.metric_data.statistics["size"]
+        if stats.count:
+            self.mean_size = round(stats.mean, 3)
+            self.std_size = round(stats.std(), 3)
+        else:
+            self.mean_size = 0
+            self.std_size = 0
+
+    def undo(self) -> Optional[UndoEntry]:
+        """
+        Reverts the last evaluation step.
+
+        Returns
+        -------
+        UndoEntry or None
+            Reverted entry, None if there is nothing to undo
+        """
+        if len(self.undo_stack) == 0:
+            return None
+        entry = self.undo_stack.pop_entry()
+        last_evaluated = entry.cell_id
+        if entry.action is None:
+            entry.action = (
+                UndoEntry.INCLUDE
+                if last_evaluated in self.accepted_store
+                else UndoEntry.EXCLUDE
+            )
+        if last_evaluated < self.selfdrawn_lower_bound:
+            self.logger.debug("Adding cell back to remaining")
+            self.remaining.add(last_evaluated)
+        if entry.diffs is not None:
+            self.logger.debug("Reverting pixel diffs")
+            self.apply_diffs(entry, reverse=True)
+        if entry.action == UndoEntry.INCLUDE:
+            self.logger.debug("Removing cell from accepted")
+            self.remove_metric(entry)
+            self.included.remove(last_evaluated)
+            if entry.diffs is None:
+                self.revert_without_diffs(entry, self.accepted_store)
+            else:
+                self.accepted_store.regions.pop(last_evaluated, None)
+            if last_evaluated >= self.selfdrawn_lower_bound:
+                self.label_index.remove(last_evaluated)
+        else:
+            self.excluded.remove(last_evaluated)
+            if entry.diffs is None:
+                self.revert_without_diffs(entry, self.rejected_store)
+            else:
+                self.rejected_store.regions.pop(last_evaluated, None)
+        self.undo_stack.push_redo(entry)
+        self.mark_changed(entry.region)
+        self.changes.mark_undo(len(self.undo_stack))
+        self.calculate_metrics()
+        return entry
+
+    def redo(self) -> Optional[UndoEntry]:
+        """
+        Repeats the last undone evaluation step.
+
+        Returns
+        -------
+        UndoEntry or None
+            Repeated entry, None if there is nothing to redo
+        """
+        entry = self.undo_stack.pop_redo()
+        if entry is None:
+            return None
+        redone = entry.cell_id
+        self.apply_diffs(entry)
+        self.remaining.discard(redone)
+        if entry.action == UndoEntry.INCLUDE:
+            if entry.region is not None:
+                self.accepted_store.regions[redone] = entry.region
+                if redone >= self.selfdrawn_lower_bound:
+                    self.label_index.add(
+                        redone,
+                        entry.region,
+                        self.labels[entry.region] == redone,
+                    )
+                cell = self.accepted_cells[entry.region]
+                entry.metric = self.add_cell_to_accepted(
+                    redone, np.where(cell == redone, cell, 0), entry.region
+                )
+            else:
+                self.included.add(redone)
+        else:
+            if entry.region is not None:
+                self.rejected_store.regions[redone] = entry.region
+            self.excluded.add(redone)
+        self.undo_stack.push(entry, keep_redo=True)
+        self.mark_changed(entry.region)
+        self.calculate_metrics()
+        return entry
+
+    def journal_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Returns the label images whose changes are recorded for undo/redo.
+
+        Returns
+        -------
+        dict
+            Label images by name, see JOURNAL_ARRAYS
+        """
+        return dict(
+            zip(
+                JOURNAL_ARRAYS,
+                (self.labels, self.accepted_cells, self.rejected_cells),
+            )
+        )
+
+    def copy_region(self, region: Tuple[slice, ...]) -> Dict[str, np.ndarray]:
+        """
+        Copies a region of all journaled label images.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the image
+
+        Returns
+        -------
+        dict
+            Copies of the region by label image name
+        """
+        self.preserve_region(region)
+        return {
+            name: np.array(data[region])
+            for name, data in self.journal_arrays().items()
+        }
+
+    def diff_region(
+        self,
+        region: Tuple[slice, ...],
+        before: Dict[str, np.ndarray],
+        after: Dict[str, np.ndarray] = None,
+    ) -> Dict[str, PixelDiff]:
+        """
+        Encodes the changes of all journaled label images within a region.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the image, None if nothing was changed
+        before : dict
+            Copies of the region before the change, see copy_region
+        after : dict, optional
+            Copies of the region after the change, by default the current
+            label images
+
+        Returns
+        -------
+        dict
+            Pixel diffs by label image name, unchanged images are left out
+        """
+        diffs = {}
+        if region is None:
+            return diffs
+        if after is None:
+            after = {
+                name: data[region]
+                for name, data in self.journal_arrays().items()
+            }
+        for name, old in before.items():
+            diff = PixelDiff.between(region, old, after[name])
+            if diff is not None:
+                diffs[name] = diff
+        return diffs
+
+    def apply_diffs(self, entry: UndoEntry, reverse: bool = False):
+        """
+        Writes the pixel diffs of an undo entry into the label images.
+
+        Parameters
+        ----------
+        entry : UndoEntry
+            Entry holding the diffs
+        reverse : bool, optional
+            Whether to revert the diffs instead, by default False
+        """
+        if entry.diffs is None:
+            return
+        self.preserve_region(entry.region)
+        arrays = self.journal_arrays()
+        for name, diff in entry.diffs.items():
+            diff.apply(arrays[name], reverse)
+
+    def revert_without_diffs(self, entry: UndoEntry, store: CellStore):
+        """
+        Reverts an entry whose diffs are unknown through a cell store.
+
+        The diffs of the reverted step are recorded on the entry so that it
+        can be redone.
+
+        Parameters
+        ----------
+        entry : UndoEntry
+            Entry to revert, its action decides the store
+        store : CellStore
+            Store holding the cell of the entry
+        """
+        cell_id = entry.cell_id
+        region = store.regions.get(cell_id)
+        if region is None:
+            entry.diffs = {}
+            return
+        after = self.copy_region(region)
+        _, mask = store.remove(cell_id)
+        evaluate = self.labels[region]
+        if entry.action == UndoEntry.EXCLUDE:
+            evaluate[mask] = cell_id
+        elif cell_id >= self.selfdrawn_lower_bound:
+            evaluate[mask] = 0
+        store_region(self.labels, region, evaluate)
+        entry.region = region
+        entry.diffs = self.diff_region(region, self.copy_region(region), after)
+
+    def remove_metric(self, entry: UndoEntry):
+        """
+        Removes the metric data row recorded in an undo entry.
+
+        The row is matched by cell id, which also holds after the metric
+        data was sorted for export. The last row is checked first, so
+        removing the row of the most recent step does not scan the table.
+
+        Parameters
+        ----------
+        entry : UndoEntry
+            Undo entry of an included cell
+        """
+        i = self.metric_data.find(entry.cell_id)
+        if i is not None:
+            del self.metric_data[i]
+            self.changes.mark_metric(i)
+            return
+        self.logger.warning(f"No metric data found for cell {entry.cell_id}")
+
+    def restore_undo_entries(
+        self, undo_stack: Union[UndoStack, List[int]]
+    ) -> UndoStack:
+        """
+        Completes the undo entries of an imported session.
+
+        Sessions saved without a journal only hold the evaluated ids, their
+        entries are rebuilt from the cell stores. Journals read from a
+        session get the metric rows of their included cells back.
+
+        Parameters
+        ----------
+        undo_stack : UndoStack or list of int
+            Journal or evaluated cell ids in order of evaluation
+
+        Returns
+        -------
+        UndoStack
+            Undo entries of the cells
+        """
+        metrics = {row[0]: row for row in self.metric_data}
+        if isinstance(undo_stack, UndoStack):
+            for entry in undo_stack.entries:
+                if entry.action == UndoEntry.INCLUDE:
+                    entry.metric = metrics.get(entry.cell_id)
+            return undo_stack
+        entries = UndoStack()
+        for id_ in undo_stack:
+            if id_ in self.accepted_store:
+                entry = UndoEntry(
+                    id_,
+                    UndoEntry.INCLUDE,
+                    self.accepted_store.regions[id_],
+                    metrics.get(id_),
+                )
+            else:
+                entry = UndoEntry(
+                    id_,
+                    UndoEntry.EXCLUDE,
+                    self.rejected_store.regions.get(id_),
+                )
+            entries.push(entry)
+        return entries
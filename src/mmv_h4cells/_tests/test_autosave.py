@@ -0,0 +1,31 @@
+"""Tests for the change tracking of autosaves"""
+
+from mmv_h4cells._autosave import SessionChanges
+
+
+def test_mark_region():
+    changes = SessionChanges((512, 512), 3, 2)
+    assert not changes.pending(3, 2)
+    changes.mark_region(None)
+    assert not changes.pending(3, 2)
+    changes.mark_region((slice(500, 1030), slice(0, 10)))
+    assert changes.chunks == {(0, 0), (1, 0), (2, 0)}
+    assert changes.pending(3, 2)
+    assert changes.chunk_region((2, 0), (1100, 300)) == (
+        slice(1024, 1100),
+        slice(0, 300),
+    )
+
+
+def test_mark_rows():
+    changes = SessionChanges((512, 512), 3, 2)
+    assert changes.pending(4, 2)
+    changes.mark_undo(1)
+    changes.mark_undo(2)
+    changes.mark_metric(1)
+    assert (changes.undo_start, changes.metric_start) == (1, 1)
+    other = SessionChanges((512, 512), 0, 2)
+    other.mark_region((slice(0, 1), slice(0, 1)))
+    changes.merge(other)
+    assert changes.chunks == {(0, 0)}
+    assert (changes.undo_start, changes.metric_start) == (0, 1)
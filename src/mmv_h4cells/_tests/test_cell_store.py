@@ -0,0 +1,48 @@
+"""Tests for cell store"""
+
+import numpy as np
+
+from mmv_h4cells._cell_store import CellStore
+
+
+def test_from_array():
+    data = np.zeros((10, 10), dtype=np.int32)
+    data[1:3, 1:3] = 1
+    data[5:7, 6:9] = 4
+    store = CellStore.from_array(data)
+    assert len(store) == 2
+    assert 1 in store and 4 in store and 2 not in store
+    assert store.regions[4] == (slice(5, 7), slice(6, 9))
+
+
+def test_add_get_remove():
+    store = CellStore(np.zeros((10, 10), dtype=np.int32))
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[1:3, 2] = True
+    store.add(3, (slice(4, 8), slice(0, 4)), mask)
+    assert 3 in store
+    assert store.regions[3] == (slice(5, 7), slice(2, 3))
+    assert np.count_nonzero(store.data == 3) == 2
+    region, cell = store.get(3)
+    assert region == (slice(5, 7), slice(2, 3))
+    assert cell.all()
+    region, cell = store.remove(3)
+    assert 3 not in store
+    assert not store.data.any()
+    assert store.get(3) is None
+    assert store.remove(3) is None
+
+
+def test_add_empty_mask():
+    store = CellStore(np.zeros((4, 4), dtype=np.int32))
+    store.add(1, (slice(0, 4), slice(0, 4)), np.zeros((4, 4), dtype=bool))
+    assert 1 not in store
+
+
+def test_add_merges_regions():
+    store = CellStore(np.zeros((10, 10), dtype=np.int32))
+    store.add(2, (slice(0, 1), slice(0, 1)), np.ones((1, 1), dtype=bool))
+    store.add(2, (slice(8, 9), slice(5, 6)), np.ones((1, 1), dtype=bool))
+    assert store.regions[2] == (slice(0, 9), slice(0, 6))
+    store.remove(2)
+    assert not store.data.any()
@@ -0,0 +1,101 @@
+"""Tests for the command line interface"""
+
+import pytest
+
+import numpy as np
+import tifffile
+from pathlib import Path
+from aicsimageio import AICSImage
+
+from mmv_h4cells._cli import find_label_files, main
+from mmv_h4cells._reader import read
+from mmv_h4cells._roi import label_statistics
+
+PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def label_dir(tmp_path):
+    file = Path(PATH / "ex-seg.tiff")
+    segmentation = AICSImage(file).get_image_data("YX").astype(np.uint16)
+    directory = tmp_path / "labels"
+    directory.mkdir()
+    tifffile.imwrite(directory / "a.tiff", segmentation)
+    tifffile.imwrite(directory / "b.tif", segmentation[::-1])
+    (directory / "notes.txt").write_text("not an image")
+    yield directory
+
+
+def test_find_label_files(label_dir):
+    files = [label_dir / "a.tiff", label_dir / "b.tif"]
+    assert find_label_files([str(label_dir)]) == files
+    assert find_label_files([str(label_dir / "*.tif*")]) == files
+    assert find_label_files([str(label_dir / "a.tiff")]) == files[:1]
+    (label_dir / "a_analysis.tiff").write_bytes(b"")
+    assert find_label_files([str(label_dir)]) == files
+
+
+@pytest.mark.parametrize("jobs, workers", [(1, 1), (8, 2)])
+def test_analyse(label_dir, tmp_path, capsys, jobs, workers):
+    output = tmp_path / "out"
+    code = main(
+        [
+            "analyse",
+            str(label_dir),
+            "-o",
+            str(output),
+            "--jobs",
+            str(jobs),
+            "--threshold",
+            "10",
+            "--zarr",
+        ]
+    )
+    assert code == 0
+    out = capsys.readouterr().out
+    assert "2 files" in out and f"{workers} jobs)" in out
+
+    labels = tifffile.imread(label_dir / "a.tiff")
+    expected = label_statistics(labels)
+    expected = expected[expected["count [px]"] > 10]
+    lines = (output / "a_analysis.csv").read_text().splitlines()
+    assert len(lines) == len(expected) + 4
+    kept = np.isin(labels, expected["id"].to_numpy())
+    tiff = tifffile.imread(output / "a_analysis.tiff")
+    assert np.array_equal(tiff, np.where(kept, labels, 0))
+
+    _, accepted, _, data, _, undo_stack, _ = read(output / "a_analysis.zarr")
+    assert np.array_equal(accepted, tiff)
+    assert [row[0] for row in data] == expected["id"].tolist()
+    assert list(undo_stack) == expected["id"].tolist()
+
+
+def test_analyse_roi(label_dir, tmp_path):
+    output = tmp_path / "out"
+    code = main(
+        [
+            "analyse",
+            str(label_dir / "a.tiff"),
+            "-o",
+            str(output),
+            "--roi",
+            "10",
+            "-1",
+            "20",
+            "120",
+            "--features",
+            "area",
+        ]
+    )
+    assert code == 0
+    labels = tifffile.imread(label_dir / "a.tiff")
+    tiff = tifffile.imread(output / "a_analysis.tiff")
+    assert tiff.shape == labels[10:, 20:120].shape
+    header = (output / "a_analysis.csv").read_text().splitlines()[0]
+    assert header.startswith("ID,Size [px],Centroid,area [px]")
+    assert not (output / "a_analysis.zarr").exists()
+
+
+def test_no_files(tmp_path, capsys):
+    assert main(["analyse", str(tmp_path)]) == 1
+    assert "No label images" in capsys.readouterr().err
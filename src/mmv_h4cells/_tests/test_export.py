@@ -0,0 +1,31 @@
+"""Tests for exporting sessions in the background"""
+
+import pytest
+
+import numpy as np
+import zarr
+
+from mmv_h4cells._export import ArraySnapshot
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_array_snapshot(chunked):
+    data = np.arange(100 * 70, dtype=np.int32).reshape(100, 70)
+    original = data.copy()
+    if chunked:
+        data = zarr.array(data, chunks=(32, 32))
+    read = []
+    snapshot = ArraySnapshot(data, (32, 32), read.append)
+    assert snapshot.shape == (100, 70) and snapshot.ndim == 2
+
+    snapshot.preserve((slice(10, 40), slice(60, 70)))
+    data[10:40, 60:70] = -1
+    snapshot.preserve((slice(90, 100), slice(0, 5)))
+    data[90:100, 0:5] = -2
+    assert len(snapshot.saved) == 6
+    assert np.array_equal(snapshot[:], original)
+    assert np.array_equal(snapshot[5:50], original[5:50])
+    assert np.array_equal(snapshot[20:95, 3:65], original[20:95, 3:65])
+    assert read == [100 * 70, 45 * 70, 75 * 62]
+    with pytest.raises(TypeError):
+        snapshot[::2]
@@ -0,0 +1,41 @@
+"""Tests for id queue"""
+
+import pytest
+
+from mmv_h4cells._id_queue import IdQueue
+
+
+def test_set_behaviour():
+    queue = IdQueue([5, 1, 3, 3])
+    assert list(queue) == [1, 3, 5]
+    assert queue == {1, 3, 5}
+    assert {1, 3, 5} == queue
+    assert 3 in queue and 2 not in queue and None not in queue
+    queue.add(2)
+    queue.add(2)
+    assert list(queue) == [1, 2, 3, 5]
+    queue.remove(1)
+    queue.discard(10)
+    assert list(queue) == [2, 3, 5]
+    with pytest.raises(KeyError):
+        queue.remove(1)
+    assert queue | {0} == {0, 2, 3, 5}
+
+
+@pytest.mark.parametrize(
+    "id_, lower, higher",
+    [(0, None, 2), (2, None, 4), (3, 2, 4), (4, 2, 9), (9, 4, None)],
+)
+def test_neighbours(id_, lower, higher):
+    queue = IdQueue({2, 4, 9})
+    assert queue.next_lower(id_) == lower
+    assert queue.next_higher(id_) == higher
+
+
+def test_empty():
+    queue = IdQueue()
+    assert len(queue) == 0
+    assert queue.lowest() is None
+    assert queue.highest() is None
+    assert queue.next_higher(1) is None
+    assert queue.next_lower(1) is None
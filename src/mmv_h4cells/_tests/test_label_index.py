@@ -0,0 +1,198 @@
+"""Tests for label index"""
+
+import pytest
+
+import dask.array as da
+import numpy as np
+import zarr
+from collections import namedtuple
+from pathlib import Path
+from aicsimageio import AICSImage
+from scipy import ndimage
+
+from mmv_h4cells import _label_index
+from mmv_h4cells._label_index import (
+    LabelIndex,
+    compact_labels,
+    crop_region,
+    edited_region,
+    full_region,
+    mask_bbox,
+    remaining_labels,
+)
+
+PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def segmentation():
+    file = Path(PATH / "ex-seg.tiff")
+    yield AICSImage(file).get_image_data("YX")
+
+
+@pytest.mark.parametrize("block_pixels", [2**24, 100])
+def test_from_array(segmentation, block_pixels, monkeypatch):
+    monkeypatch.setattr(_label_index, "BLOCK_PIXELS", block_pixels)
+    index = LabelIndex.from_array(segmentation)
+    ids = np.unique(segmentation)[1:]
+    assert np.array_equal(index.ids, ids)
+    slices = ndimage.find_objects(segmentation)
+    for id_ in ids:
+        assert index.bbox(id_) == slices[id_ - 1]
+        assert index.count(id_) == np.count_nonzero(segmentation == id_)
+        assert np.allclose(
+            index.centroid(id_),
+            ndimage.center_of_mass(segmentation == id_),
+        )
+
+
+@pytest.mark.parametrize("kind", ["zarr", "dask"])
+def test_from_chunked_array(segmentation, kind, monkeypatch):
+    monkeypatch.setattr(_label_index, "BLOCK_PIXELS", 2**12)
+    if kind == "zarr":
+        data = zarr.array(segmentation, chunks=(32, 48))
+    else:
+        data = da.from_array(segmentation, chunks=(32, 48))
+    index = LabelIndex.from_array(data)
+    expected = LabelIndex.from_array(segmentation)
+    assert np.array_equal(index.ids, expected.ids)
+    assert np.array_equal(index.lower, expected.lower)
+    assert np.array_equal(index.upper, expected.upper)
+    assert np.array_equal(index.counts, expected.counts)
+    assert np.allclose(index.centroids, expected.centroids)
+
+
+@pytest.mark.parametrize("kind", ["numpy", "zarr"])
+def test_search(segmentation, kind, monkeypatch):
+    monkeypatch.setattr(_label_index, "BLOCK_PIXELS", 2**12)
+    data = segmentation.copy()
+    if kind == "zarr":
+        data = zarr.array(data, chunks=(32, 48))
+    expected = LabelIndex.from_array(segmentation)
+    index = LabelIndex.from_array(data)
+    index.remove(3)
+    index.lower[index.ids == 4] = 0
+    reads = []
+    read = _label_index._read_label_statistics
+    monkeypatch.setattr(
+        _label_index,
+        "_read_label_statistics",
+        lambda *args: reads.append(args[1]) or read(*args),
+    )
+    for id_ in (3, 4):
+        index.search(data, id_)
+        assert index.bbox(id_) == expected.bbox(id_)
+        assert index.count(id_) == expected.count(id_)
+        assert np.allclose(index.centroid(id_), expected.centroid(id_))
+    index.search(data, 10**6)
+    assert 10**6 not in index
+    # the image is only read in blocks
+    assert len(reads) > 1
+    assert full_region(segmentation.shape) not in reads
+
+
+def test_from_array_sparse_ids(segmentation):
+    # ids far apart are factorized instead of counted over their range
+    sparse = segmentation.astype(np.int64) * 10**9
+    index = LabelIndex.from_array(sparse)
+    expected = LabelIndex.from_array(segmentation)
+    assert np.array_equal(index.ids, expected.ids * 10**9)
+    assert np.array_equal(index.lower, expected.lower)
+    assert np.array_equal(index.upper, expected.upper)
+    assert np.array_equal(index.counts, expected.counts)
+    assert np.allclose(index.centroids, expected.centroids)
+
+
+@pytest.mark.parametrize("ids", [[3, 5, 9], [3, 10**9, 2**40]])
+def test_compact_labels(ids):
+    labels = np.array(ids * 2 + [ids[1]], dtype=np.int64)
+    unique, bins = compact_labels(labels)
+    assert unique.tolist() == ids
+    assert np.array_equal(unique[bins], labels)
+    assert bins.max() == len(ids) - 1
+
+
+def test_remaining_labels(segmentation):
+    ids = [1, 5, 7]
+    expected = np.where(np.isin(segmentation, ids), segmentation, 0)
+    assert np.array_equal(remaining_labels(segmentation, ids), expected)
+    chunked = remaining_labels(zarr.array(segmentation, chunks=64), ids)
+    assert isinstance(chunked, da.Array)
+    assert np.array_equal(chunked.compute(), expected)
+
+
+def test_from_array_empty():
+    index = LabelIndex.from_array(np.zeros((5, 5), dtype=np.int32))
+    assert len(index) == 0
+    assert index.max_id == 0
+    assert 1 not in index
+
+
+def test_mask(segmentation):
+    index = LabelIndex.from_array(segmentation)
+    slices, mask = index.mask(segmentation, 3)
+    expected = np.zeros_like(segmentation, dtype=bool)
+    expected[slices] = mask
+    assert np.array_equal(expected, segmentation == 3)
+
+
+def test_add_and_remove():
+    data = np.zeros((10, 10), dtype=np.int32)
+    data[1:3, 1:3] = 1
+    data[5:7, 6:9] = 4
+    index = LabelIndex.from_array(data)
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[1:3, 2] = True
+    index.add(2, (slice(4, 8), slice(0, 4)), mask)
+    assert list(index.ids) == [1, 2, 4]
+    assert index.bbox(2) == (slice(5, 7), slice(2, 3))
+    assert index.count(2) == 2
+    assert index.centroid(2) == (5.5, 2.0)
+    index.remove(2)
+    assert list(index.ids) == [1, 4]
+    with pytest.raises(KeyError):
+        index.bbox(2)
+
+
+def assert_same_index(index, expected):
+    assert np.array_equal(index.ids, expected.ids)
+    assert np.array_equal(index.lower, expected.lower)
+    assert np.array_equal(index.upper, expected.upper)
+    assert np.array_equal(index.counts, expected.counts)
+    assert np.allclose(index.centroids, expected.centroids)
+
+
+def test_update_region(segmentation):
+    data = segmentation.copy()
+    index = LabelIndex.from_array(data)
+    # grow cell 1, paint over cell 2 and draw a new label
+    y, x = (int(c) for c in index.centroid(2))
+    region = (slice(y - 20, y + 20), slice(x - 20, x + 20))
+    data[region] = np.where(data[region] == 2, 1, data[region])
+    data[y - 2 : y + 2, x - 2 : x + 2] = 500
+    added, removed = index.update_region(data, region)
+    assert added == [500]
+    assert removed == [2]
+    assert_same_index(index, LabelIndex.from_array(data))
+
+
+def test_edited_region():
+    atoms = [
+        ((np.array([3, 5]), np.array([7, 2])), np.array([0, 0]), 1),
+        ((np.array([], dtype=int), np.array([], dtype=int)), [], 1),
+    ]
+    assert edited_region(atoms, (10, 10)) == (slice(3, 6), slice(2, 8))
+    masked = namedtuple("Atom", "slice_key mask old_values new_value")
+    atoms.append(masked((slice(-2, 4), slice(8, 12)), None, None, 1))
+    assert edited_region(atoms, (10, 10)) == (slice(0, 6), slice(2, 10))
+    assert edited_region([], (10, 10)) is None
+
+
+def test_crop_region():
+    data = np.zeros((4, 4), dtype=np.int32)
+    data[1, 2] = 5
+    region, cropped = crop_region((slice(10, 14), slice(20, 24)), data)
+    assert region == (slice(11, 12), slice(22, 23))
+    assert np.array_equal(cropped, [[5]])
+    assert crop_region(full_region((4, 4)), np.zeros((4, 4))) is None
+    assert mask_bbox(np.zeros((2, 2))) is None
@@ -0,0 +1,91 @@
+"""Tests for the columnar metric data"""
+
+import pytest
+
+import numpy as np
+
+from mmv_h4cells._metric_table import INITIAL_CAPACITY, MetricTable
+
+
+@pytest.fixture
+def table():
+    yield MetricTable([(3, 30, (1, 2)), (1, 10, (3, 4)), (2, 20, (5, 6))])
+
+
+def test_sequence(table):
+    assert len(table) == 3
+    assert table[0] == (3, 30, (1, 2))
+    assert table[-1] == (2, 20, (5, 6))
+    assert table[1:] == [(1, 10, (3, 4)), (2, 20, (5, 6))]
+    assert table == [(3, 30, (1, 2)), (1, 10, (3, 4)), (2, 20, (5, 6))]
+    assert type(table[0][0]) is int
+    with pytest.raises(IndexError):
+        table[3]
+
+    table.append((4, 40, (7, 8)))
+    assert table.pop() == (4, 40, (7, 8))
+    del table[0]
+    assert [row[0] for row in table] == [1, 2]
+    table.insert(0, (5, 50, (9, 9)))
+    assert [row[0] for row in table] == [5, 1, 2]
+
+
+def test_growth():
+    table = MetricTable()
+    for i in range(INITIAL_CAPACITY * 3):
+        table.append((i, i, (i, i)))
+    assert len(table) == INITIAL_CAPACITY * 3
+    assert len(table.data) == INITIAL_CAPACITY * 4
+    assert table[-1] == (len(table) - 1,) * 2 + ((len(table) - 1,) * 2,)
+
+
+def test_sort(table):
+    table.sort()
+    assert [row[0] for row in table] == [1, 2, 3]
+    table.sort(key=lambda row: row[2][1], reverse=True)
+    assert [row[0] for row in table] == [2, 1, 3]
+
+
+def test_columns(table):
+    sizes = table.column("size")
+    assert sizes.tolist() == [30, 10, 20]
+    assert np.shares_memory(sizes, table.data)
+    array = table.to_array()
+    assert array.tolist() == [[3, 30, 1, 2], [1, 10, 3, 4], [2, 20, 5, 6]]
+    assert np.shares_memory(array, table.data)
+    assert MetricTable.from_array(array.astype(np.int32)) == table
+
+
+def test_find(table):
+    assert table.find(2) == 2
+    assert table.find(3) == 0
+    assert table.find(7) is None
+
+
+def test_statistics(table):
+    stats = table.statistics["size"]
+    assert stats.count == 3 and stats.mean == pytest.approx(20)
+    table.append((4, 40, (7, 8)))
+    table[0] = (3, 50, (1, 2))
+    del table[1]
+    sizes = table.column("size")
+    assert stats.mean == pytest.approx(np.mean(sizes))
+    assert stats.std() == pytest.approx(np.std(sizes))
+    assert table.stats("size").maximum == 50
+    del table[:]
+    assert table.statistics["size"].count == 0
+
+
+def test_extend(table):
+    rows = [
+        (id_, id_ * 10, (id_, id_)) for id_ in range(4, 4 + INITIAL_CAPACITY)
+    ]
+    table.extend(rows)
+    assert len(table) == 3 + INITIAL_CAPACITY
+    assert table[3:] == rows
+    sizes = table.column("size")
+    stats = table.stats("size")
+    assert stats.count == len(sizes)
+    assert stats.mean == pytest.approx(np.mean(sizes))
+    assert stats.std() == pytest.approx(np.std(sizes))
+    assert stats.maximum == sizes.max()
@@ -0,0 +1,69 @@
+"""Tests for prefetching the next cells"""
+
+import pytest
+
+import numpy as np
+from pathlib import Path
+from aicsimageio import AICSImage
+
+from mmv_h4cells._session import AnalysisSession
+
+PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def session():
+    file = Path(PATH / "ex-seg.tiff")
+    yield AnalysisSession(AICSImage(file).get_image_data("YX").copy())
+
+
+def test_candidates(session):
+    prefetcher = session.prefetcher
+    ids = sorted(session.remaining)
+    assert prefetcher.candidates(ids[0]) == ids[1:4]
+    assert prefetcher.candidates(ids[-1]) == ids[:3]
+    session.remaining = {ids[0], ids[1]}
+    assert prefetcher.candidates(ids[0]) == [ids[1]]
+
+
+def test_prefetch(session):
+    session.prefetch(1)
+    session.prefetcher.wait()
+    assert set(session.prefetcher.cells) == {2, 3, 4}
+    cell = session.prefetcher.cells[2]
+    region, mask = session.get_cell_mask(2)
+    assert cell.region == region
+    assert np.array_equal(cell.mask, mask)
+    assert cell.centroid == session.label_index.centroid(2)
+
+    assert session.get_cell_mask(2, prefetched=True)[0] == region
+    assert 2 not in session.prefetcher.cells
+    # without prefetched the cell is always read from the label image
+    assert session.get_cell_mask(3)[0] == session.label_index.bbox(3)
+    assert 3 in session.prefetcher.cells
+
+
+def test_invalidate(session):
+    session.prefetch(1)
+    session.prefetcher.wait()
+    session.exclude_cell(3)
+    assert 3 not in session.prefetcher.cells
+    assert 4 in session.prefetcher.cells
+
+    generation = session.prefetcher.generation
+    entries = session.prefetcher.entries([4])
+    session.prefetcher.invalidate()
+    assert session.prefetcher.cells == {}
+    # reads started before an edit are discarded
+    session.prefetcher.prefetch(entries, generation)
+    assert session.prefetcher.cells == {}
+
+
+def test_entries(session):
+    entries = session.prefetcher.entries([2, 10**6])
+    index = session.label_index
+    assert entries == [(2, index.bbox(2), index.count(2), index.centroid(2))]
+    # cells no longer matching their entry are not stored
+    session.exclude_cell(2)
+    session.prefetcher.prefetch(entries, session.prefetcher.generation)
+    assert 2 not in session.prefetcher.cells
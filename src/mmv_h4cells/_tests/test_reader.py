@@ -1,9 +1,22 @@
+import pytest
+
 import numpy as np
+import pandas as pd
+import zarr
 
 from pathlib import Path
 import csv
 from aicsimageio.writers import OmeTiffWriter
-from mmv_h4cells._reader import napari_get_reader
+from unittest.mock import patch
+from mmv_h4cells._metric_table import MetricTable
+from mmv_h4cells._reader import (
+    napari_get_reader,
+    read_csv,
+    read_parquet,
+    read_results,
+    read_zarr,
+)
+from mmv_h4cells._writer import write_csv, write_parquet, write_zarr
 
 
 # tmp_path is a pytest fixture
@@ -34,3 +47,99 @@ def test_get_reader_pass():
     no_file = Path("fake.file")
     reader = napari_get_reader(no_file)
     assert reader is None
+
+
+def test_read_zarr_lazy(tmp_path):
+    labels = np.zeros((1200, 1200), dtype=np.int32)
+    labels[10:20, 10:20] = 1
+    labels[1100:1150, 1100:1150] = 2
+    path = tmp_path / "session.zarr"
+    rows = [(1, 100, (14, 14))]
+    write_zarr(path, labels, labels, labels, rows, (100, 0), [1], 3)
+
+    data, accepted, rejected, *session_data = read_zarr(path, lazy=True)
+    assert isinstance(data, zarr.Array)
+    assert session_data[0] == rows
+    assert session_data[-1] == 3
+
+    base = data.store.base
+    accessed = []
+
+    class RecordingStore(dict):
+        def __contains__(self, key):
+            return key in base
+
+        def __getitem__(self, key):
+            accessed.append(key)
+            return base[key]
+
+    data.store.base = RecordingStore()
+    assert np.array_equal(data[10:20, 10:20], labels[10:20, 10:20])
+    assert accessed == ["data_to_valuate/0.0"]
+
+    data.store.base = base
+    data[10:20, 10:20] = 0
+    assert not np.any(data[10:20, 10:20])
+    assert np.array_equal(read_zarr(path)[0], labels)
+
+
+def test_read_zarr_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_zarr(tmp_path / "missing.zarr")
+
+
+@pytest.mark.parametrize(
+    "filename,csv_format",
+    [("a.csv", (",", ".")), ("a.csv", (";", ",")), ("a.csv.gz", (",", "."))],
+)
+def test_read_csv(tmp_path, filename, csv_format):
+    path = tmp_path / filename
+    rows = [(1, 20, (3, 4), 0.5), (12, 7, (10, 11), 1.25)]
+    with patch("mmv_h4cells._writer.csv_format", return_value=csv_format):
+        write_csv(path, rows, (13.5, 6.5, 0), ["eccentricity"])
+    assert napari_get_reader(path) == read_csv
+    data, metrics, features = read_csv(path)
+    assert isinstance(data, MetricTable)
+    assert data == [row[:3] for row in rows]
+    assert metrics == (13.5, 6.5, 0)
+    assert features["eccentricity"].tolist() == [0.5, 1.25]
+
+
+def test_read_csv_empty(tmp_path):
+    path = tmp_path / "a.csv"
+    write_csv(path, MetricTable(), (0, 0, 0))
+    data, metrics, features = read_csv(path)
+    assert len(data) == 0
+    assert metrics == (0, 0, 0)
+    assert features.empty
+
+
+def test_read_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    rows = [(1, 20, (3, 4), 0.5), (12, 7, (10, 11), 1.25)]
+    write_parquet(tmp_path / "a.parquet", rows, (13.5, 6.5, 0), ["ecc"])
+    data, metrics, features = read_parquet(tmp_path / "a.parquet")
+    assert data == [row[:3] for row in rows]
+    assert metrics == (13.5, 6.5, 0)
+    assert features["ecc"].tolist() == [0.5, 1.25]
+
+    write_csv(tmp_path / "b.csv", rows[:1], (20.0, 0.0, 0), ["ecc"])
+    results = read_results([tmp_path / "a.parquet", tmp_path / "b.csv"])
+    assert results["id"].tolist() == [1, 12, 1]
+    assert results["file"].tolist()[-1] == str(tmp_path / "b.csv")
+
+
+def test_read_results(tmp_path):
+    write_csv(tmp_path / "a.csv", [(1, 20, (3, 4))], (20.0, 0.0, 0))
+    write_csv(tmp_path / "b.csv", [(2, 7, (5, 6))], (7.0, 0.0, 0))
+    results = read_results([tmp_path / "a.csv", tmp_path / "b.csv"])
+    expected = pd.DataFrame(
+        {
+            "file": [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")],
+            "id": [1, 2],
+            "size": [20, 7],
+            "y": [3, 5],
+            "x": [4, 6],
+        }
+    )
+    pd.testing.assert_frame_equal(results, expected)
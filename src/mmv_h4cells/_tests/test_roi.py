@@ -0,0 +1,125 @@
+"""Tests for ROI analysis"""
+
+import pytest
+
+import numpy as np
+import tifffile
+from pathlib import Path
+from aicsimageio import AICSImage
+from skimage.measure import regionprops
+
+from mmv_h4cells._roi import analyse_roi, iter_roi_tiles, label_statistics
+
+PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def segmentation():
+    file = Path(PATH / "ex-seg.tiff")
+    yield AICSImage(file).get_image_data("YX")
+
+
+def test_label_statistics(segmentation):
+    crop = segmentation[10:200, 5:300]
+    df = label_statistics(crop, (10, 5))
+    assert df["id"].tolist() == sorted(set(np.unique(crop)) - {0})
+    for row in df.itertuples(index=False):
+        y, x = np.where(crop == row[0])
+        assert row[1] == len(y)
+        assert row[2] == (int(np.mean(y)) + 10, int(np.mean(x)) + 5)
+        assert row[3] == (y.min() + 10, x.min() + 5, y.max() + 11, x.max() + 6)
+
+
+def test_label_statistics_features(segmentation):
+    image = np.random.default_rng(0).random(segmentation.shape)
+    df = label_statistics(
+        segmentation,
+        features=["area", "perimeter", "eccentricity", "mean_intensity"],
+        image=image,
+    )
+    for props in regionprops(segmentation, intensity_image=image):
+        row = df[df["id"] == props.label].iloc[0]
+        assert row["area [px]"] == props.area
+        assert row["eccentricity"] == pytest.approx(
+            props.eccentricity, abs=1e-3
+        )
+        assert row["mean intensity"] == pytest.approx(
+            props.intensity_mean, abs=1e-3
+        )
+        assert 0 < row["perimeter [px]"] < props.area
+
+
+def test_label_statistics_perimeter():
+    labels = np.zeros((6, 6), dtype=np.int32)
+    labels[1:5, 1:5] = 3
+    df = label_statistics(labels, features=["perimeter"])
+    assert df["perimeter [px]"].tolist() == [12]
+
+
+def test_label_statistics_sparse_ids():
+    labels = np.zeros((4, 4), dtype=np.int64)
+    labels[0, 0] = 10**12
+    labels[3, 3] = 5
+    df = label_statistics(labels)
+    assert df["id"].tolist() == [5, 10**12]
+    assert df["centroid (y,x)"].tolist() == [(3, 3), (0, 0)]
+
+
+def test_label_statistics_invalid():
+    labels = np.ones((2, 2), dtype=np.int32)
+    assert len(label_statistics(np.zeros((2, 2), dtype=np.int32))) == 0
+    with pytest.raises(ValueError):
+        label_statistics(labels, features=["volume"])
+    with pytest.raises(ValueError):
+        label_statistics(labels, features=["mean_intensity"])
+
+
+def test_iter_roi_tiles():
+    labels = np.arange(30, dtype=np.int32).reshape(5, 6)
+    for ids in ([3, 14, 29], [3, 14, 10**9]):
+        tiles = list(iter_roi_tiles(labels, np.array(ids), 4))
+        assert [tile.shape for tile in tiles] == [
+            (4, 4),
+            (4, 2),
+            (1, 4),
+            (1, 2),
+        ]
+        image = np.block([tiles[:2], tiles[2:]])
+        expected = np.where(np.isin(labels, ids), labels, 0)
+        assert np.array_equal(image, expected)
+    assert labels[0, 1] == 1
+
+
+def test_analyse_roi(segmentation, tmp_path):
+    data = segmentation.copy()
+    paths = (tmp_path / "a.csv", tmp_path / "a.tiff")
+    df, returned_paths, threshold = analyse_roi.__wrapped__(
+        data, (0, 100), (10, 150), 10, paths, ["area"]
+    )
+    assert returned_paths == paths and threshold == 10
+    assert list(df.columns) == [
+        "id",
+        "count [px]",
+        "centroid (y,x)",
+        "area [px]",
+    ]
+    assert (df["count [px]"] > 10).all()
+    assert np.array_equal(data, segmentation)
+    image = tifffile.imread(paths[1])
+    assert image.shape == (100, 140)
+    assert set(np.unique(image)) - {0} == set(df["id"])
+    crop = segmentation[:100, 10:150]
+    kept = np.isin(crop, df["id"])
+    assert np.array_equal(image, np.where(kept, crop, 0))
+
+
+def test_analyse_roi_large_ids(tmp_path):
+    data = np.zeros((40, 40), dtype=np.uint32)
+    data[5:15, 5:15] = 70000
+    data[20:30, 20:30] = 3
+    paths = (tmp_path / "a.csv", tmp_path / "a.tiff")
+    df, _, _ = analyse_roi.__wrapped__(data, (0, 40), (0, 40), 10, paths)
+    assert set(df["id"]) == {3, 70000}
+    image = tifffile.imread(paths[1])
+    assert image.dtype == np.uint32
+    assert np.array_equal(image, data)
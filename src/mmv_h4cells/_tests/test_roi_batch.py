@@ -0,0 +1,129 @@
+"""Tests for batch ROI analysis"""
+
+import pytest
+
+import numpy as np
+import pandas as pd
+import tifffile
+from pathlib import Path
+from unittest.mock import patch
+from aicsimageio import AICSImage
+
+from mmv_h4cells._roi import label_statistics
+from mmv_h4cells._roi_batch import (
+    ProcessPoolExecutor,
+    Roi,
+    analyse_rois,
+    read_roi_csv,
+    rois_from_shapes,
+)
+from mmv_h4cells._writer import label_dtype
+
+PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def segmentation():
+    file = Path(PATH / "ex-seg.tiff")
+    yield AICSImage(file).get_image_data("YX")
+
+
+def test_roi_bbox_and_mask():
+    rectangle = Roi("r", [[10, 20], [10, 50], [40, 50], [40, 20]], "rectangle")
+    assert rectangle.bbox((100, 100)) == (slice(10, 40), slice(20, 50))
+    assert rectangle.mask(rectangle.bbox((100, 100))) is None
+    assert rectangle.bbox((30, 30)) == (slice(10, 30), slice(20, 30))
+
+    triangle = Roi("t", [[0, 0], [0, 10], [10, 0]])
+    region = triangle.bbox((100, 100))
+    mask = triangle.mask(region)
+    assert mask.shape == (11, 11)
+    assert mask[1, 1] and not mask[9, 9]
+
+    with pytest.raises(ValueError):
+        Roi("e", [[0, 0], [5, 5]], "ellipse")
+
+
+def test_rois_from_shapes():
+    data = [np.array([[0, 0], [0, 5], [5, 5], [5, 0]])] * 2
+    rois = rois_from_shapes(data, ["rectangle", "polygon"])
+    assert [roi.name for roi in rois] == ["0", "1"]
+    assert [roi.shape_type for roi in rois] == ["rectangle", "polygon"]
+    with pytest.raises(ValueError):
+        rois_from_shapes(data, ["rectangle", "line"])
+
+
+def test_read_roi_csv(tmp_path):
+    rectangles = tmp_path / "rectangles.csv"
+    rectangles.write_text("name,y0,x0,y1,x1\na,0,0,10,20\nb,5,5,15,15\n")
+    rois = read_roi_csv(rectangles)
+    assert [roi.name for roi in rois] == ["a", "b"]
+    assert rois[0].bbox((100, 100)) == (slice(0, 10), slice(0, 20))
+
+    shapes = tmp_path / "shapes.csv"
+    shapes.write_text(
+        "index,shape-type,vertex-index,axis-0,axis-1\n"
+        "0,polygon,0,0,0\n0,polygon,1,0,10\n0,polygon,2,10,0\n"
+        "1,rectangle,0,2,2\n1,rectangle,1,2,8\n"
+        "1,rectangle,2,8,8\n1,rectangle,3,8,2\n"
+    )
+    rois = read_roi_csv(shapes)
+    assert [roi.shape_type for roi in rois] == ["polygon", "rectangle"]
+    assert rois[1].bbox((100, 100)) == (slice(2, 8), slice(2, 8))
+
+    invalid = tmp_path / "invalid.csv"
+    invalid.write_text("a,b\n1,2\n")
+    with pytest.raises(ValueError):
+        read_roi_csv(invalid)
+
+
+def test_analyse_rois(segmentation, tmp_path):
+    rois = [
+        Roi("a", [[0, 0], [0, 120], [100, 120], [100, 0]], "rectangle"),
+        Roi("b", [[50, 100], [50, 250], [190, 250], [190, 100]], "rectangle"),
+        Roi("c", [[0, 0], [0, 250], [190, 0]], "polygon"),
+    ]
+    summary_path = tmp_path / "summary.csv"
+    labels = segmentation.copy()
+    with patch(
+        "mmv_h4cells._roi_batch.ProcessPoolExecutor",
+        wraps=ProcessPoolExecutor,
+    ) as pool:
+        summary, throughput = analyse_rois(
+            labels, rois, 10, summary_path, ["area"], max_workers=2
+        )
+    # workers are not forked from the multi-threaded napari process
+    context = pool.call_args.kwargs["mp_context"]
+    assert context.get_start_method() == "spawn"
+    assert np.array_equal(labels, segmentation)
+    assert summary["roi"].tolist() == ["a", "b", "c"]
+    assert throughput["rois"] == 3
+    assert pd.read_csv(summary_path)["cells"].tolist() == (
+        summary["cells"].tolist()
+    )
+
+    for roi, row in zip(rois, summary.itertuples(index=False)):
+        region = roi.bbox(segmentation.shape)
+        crop = segmentation[region]
+        mask = roi.mask(region)
+        if mask is not None:
+            crop = np.where(mask, crop, 0)
+        expected = label_statistics(crop)
+        expected = expected[expected["count [px]"] > 10]
+        assert row.cells == len(expected)
+
+        tiff = tifffile.imread(tmp_path / f"summary_roi{roi.name}.tiff")
+        assert tiff.dtype == label_dtype(int(expected["id"].max()))
+        kept = np.isin(crop, expected["id"].to_numpy())
+        assert np.array_equal(tiff, np.where(kept, crop, 0))
+
+        lines = (tmp_path / f"summary_roi{roi.name}.csv").read_text()
+        lines = lines.splitlines()
+        assert lines[0].startswith("ID,Size [px],Centroid,area [px]")
+        assert len(lines) == len(expected) + 4
+
+
+def test_analyse_rois_unique_names(segmentation, tmp_path):
+    rois = [Roi("a", [[0, 0], [0, 5], [5, 0]])] * 2
+    with pytest.raises(ValueError):
+        analyse_rois(segmentation, rois, 0, tmp_path / "summary.csv")
@@ -0,0 +1,59 @@
+"""Tests for the running statistics"""
+
+import pytest
+
+import numpy as np
+
+from mmv_h4cells._running_stats import RunningStats
+
+
+def test_add_remove():
+    rng = np.random.default_rng(0)
+    values = rng.integers(1, 1000, 50).astype(float)
+    stats = RunningStats()
+    for value in values:
+        stats.add(value)
+    assert stats.count == 50
+    assert stats.mean == pytest.approx(np.mean(values))
+    assert stats.std() == pytest.approx(np.std(values))
+    assert stats.std(ddof=1) == pytest.approx(np.std(values, ddof=1))
+
+    for value in values[:20]:
+        stats.remove(value)
+    rest = values[20:]
+    assert stats.count == 30
+    assert stats.mean == pytest.approx(np.mean(rest))
+    assert stats.std() == pytest.approx(np.std(rest))
+
+    for value in rest:
+        stats.remove(value)
+    assert stats.count == 0 and stats.mean == 0 and stats.std() == 0
+
+
+def test_extrema():
+    stats = RunningStats.from_values([4, 1, 7])
+    assert (stats.minimum, stats.maximum) == (1, 7)
+    stats.add(9)
+    assert stats.maximum == 9
+    stats.remove(9)
+    assert stats.maximum is None
+    stats.update_extrema(np.array([4, 1, 7]))
+    assert stats.maximum == 7
+
+
+def test_merge():
+    rng = np.random.default_rng(0)
+    values = rng.integers(1, 1000, 50).astype(float)
+    stats = RunningStats.from_values(values[:20])
+    stats.merge(RunningStats.from_values(values[20:]))
+    assert stats.count == 50
+    assert stats.mean == pytest.approx(np.mean(values))
+    assert stats.std() == pytest.approx(np.std(values))
+    assert stats.minimum == values.min() and stats.maximum == values.max()
+
+    stats = RunningStats()
+    stats.merge(RunningStats.from_values([4, 1, 7]))
+    assert (stats.count, stats.minimum, stats.maximum) == (3, 1, 7)
+    stats.remove(7)
+    stats.merge(RunningStats.from_values([2]))
+    assert stats.maximum is None and stats.minimum == 1
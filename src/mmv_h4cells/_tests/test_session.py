@@ -0,0 +1,405 @@
+"""Tests for the headless analysis session"""
+
+import pytest
+
+import dask.array as da
+import numpy as np
+import zarr
+from pathlib import Path
+from aicsimageio import AICSImage
+
+from mmv_h4cells._export import ExportCancelled
+from mmv_h4cells._reader import read
+from mmv_h4cells._session import AnalysisSession
+from mmv_h4cells._writer import write
+
+PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def segmentation():
+    file = Path(PATH / "ex-seg.tiff")
+    yield AICSImage(file).get_image_data("YX")
+
+
+@pytest.fixture
+def session(segmentation):
+    yield AnalysisSession(segmentation.copy())
+
+
+def test_initial_state(session, segmentation):
+    ids = set(np.unique(segmentation).tolist()) - {0}
+    assert session.remaining == ids
+    assert session.next_id == min(ids)
+    assert session.selfdrawn_lower_bound == max(ids) + 1
+    assert not np.any(session.accepted_cells)
+    assert session.mean_size == 0
+
+
+def test_include_exclude(session, segmentation):
+    session.include_cell(1)
+    session.exclude_cell(2)
+    assert session.included == {1} and session.excluded == {2}
+    assert 1 not in session.remaining and 2 not in session.remaining
+    assert np.array_equal(session.accepted_cells == 1, segmentation == 1)
+    assert np.array_equal(session.rejected_cells == 2, segmentation == 2)
+    assert not np.any(session.labels == 2)
+    assert session.metric_data[0][:2] == (
+        1,
+        np.count_nonzero(segmentation == 1),
+    )
+    assert session.mean_size == session.metric_data[0][1]
+    assert session.undo_stack == [1, 2]
+
+
+def test_undo_redo_replay(session):
+    labels = session.labels.copy()
+    session.include_cell(1)
+    session.exclude_cell(2)
+    session.include_multiple([3, 4])
+    after = (
+        session.labels.copy(),
+        session.accepted_cells.copy(),
+        session.rejected_cells.copy(),
+        list(session.metric_data),
+    )
+    while session.undo() is not None:
+        pass
+    assert np.array_equal(session.labels, labels)
+    assert not np.any(session.accepted_cells)
+    assert not np.any(session.rejected_cells)
+    assert session.metric_data == [] and session.mean_size == 0
+    while session.redo() is not None:
+        pass
+    assert session.undo_stack == [1, 2, 3, 4]
+    assert np.array_equal(session.labels, after[0])
+    assert np.array_equal(session.accepted_cells, after[1])
+    assert np.array_equal(session.rejected_cells, after[2])
+    assert sorted(session.metric_data) == sorted(after[3])
+
+
+def test_undo_without_diffs(session, segmentation):
+    # cells away from the origin, whose diffs cover an offset region
+    ids = [
+        id_
+        for id_ in sorted(session.remaining)
+        if all(s.start > 0 for s in session.label_index.bbox(id_))
+    ][:2]
+    session.include_cell(ids[0])
+    session.exclude_cell(ids[1])
+    after = (
+        session.labels.copy(),
+        session.accepted_cells.copy(),
+        session.rejected_cells.copy(),
+    )
+    max_bytes = session.undo_stack.max_bytes
+    session.undo_stack.max_bytes = 0
+    session.undo_stack.evict()
+    session.undo_stack.max_bytes = max_bytes
+    assert all(entry.diffs is None for entry in session.undo_stack.entries)
+    while session.undo() is not None:
+        pass
+    assert np.array_equal(session.labels, segmentation)
+    assert not np.any(session.accepted_cells)
+    assert not np.any(session.rejected_cells)
+    while session.redo() is not None:
+        pass
+    assert np.array_equal(session.labels, after[0])
+    assert np.array_equal(session.accepted_cells, after[1])
+    assert np.array_equal(session.rejected_cells, after[2])
+
+    # sessions saved without a journal only hold the evaluated ids
+    session.load(
+        *after,
+        list(session.metric_data),
+        (session.mean_size, session.std_size),
+        list(session.undo_stack),
+        session.selfdrawn_lower_bound,
+    )
+    while session.undo() is not None:
+        pass
+    assert np.array_equal(session.labels, segmentation)
+    assert not np.any(session.accepted_cells)
+    assert not np.any(session.rejected_cells)
+
+
+def test_self_drawn_cell(session):
+    id_ = session.selfdrawn_lower_bound
+    cell = np.zeros((3, 3), dtype=session.labels.dtype)
+    cell[1:, 1:] = id_
+    region = (slice(0, 3), slice(0, 3))
+    session.labels[region] = 0
+    session.include_cell(id_, cell, region, self_drawn=True)
+    assert id_ in session.included and id_ not in session.remaining
+    assert np.count_nonzero(session.labels == id_) == 4
+    session.undo()
+    assert not np.any(session.labels == id_)
+    assert id_ not in session.remaining
+
+
+def test_labels_edited(session, segmentation):
+    session.include_cell(1)
+    region = session.label_index.bbox(3)
+    session.labels[region] = np.where(
+        session.labels[region] == 3, 0, session.labels[region]
+    )
+    session.labels[region][0, 0] = 900
+    session.labels_edited(region)
+    assert 3 not in session.remaining and 3 not in session.label_index
+    assert 900 in session.remaining
+    assert session.label_index.bbox(900) == tuple(
+        slice(s.start, s.start + 1) for s in region
+    )
+    assert 1 not in session.remaining
+    assert session.changes.chunks
+
+    # excluded cells have no pixels but stay indexed for undo
+    session.exclude_cell(4)
+    bbox = session.label_index.bbox(4)
+    session.labels_edited(bbox)
+    assert session.label_index.bbox(4) == bbox
+    session.undo()
+    assert 4 in session.remaining
+    assert session.get_cell_mask(4)[0] == bbox
+
+
+def test_choose_next_id(session):
+    start = session.start(1)
+    assert start == 1 and session.next_id == 2
+    session.include_cell(start)
+    next_id, jumped_back = session.choose_next_id()
+    assert (next_id, jumped_back) == (2, False)
+    assert session.advance(next_id) == 3
+    assert session.choose_next_id(5) == (5, False)
+
+
+def test_export_round_trip(session, tmp_path):
+    session.include_cell(1)
+    session.exclude_cell(2)
+    session.export(tmp_path / "session.csv")
+    assert (tmp_path / "session.csv").exists()
+    assert (tmp_path / "session.tiff").exists()
+
+    restored = AnalysisSession()
+    restored.load(*read(tmp_path / "session.zarr"))
+    assert restored.included == {1} and restored.excluded == {2}
+    assert restored.remaining == session.remaining
+    assert restored.undo_stack == [1, 2]
+    assert np.array_equal(restored.accepted_cells, session.accepted_cells)
+    restored.undo()
+    assert 2 in restored.remaining
+    assert np.array_equal(restored.labels == 2, session.rejected_cells == 2)
+
+
+def test_lazy_session(session, tmp_path):
+    session.include_cell(1)
+    session.export(tmp_path / "session.csv")
+
+    lazy = AnalysisSession()
+    lazy.load(*read(tmp_path / "session.zarr", lazy=True))
+    lazy.exclude_cell(2)
+    lazy.include_cell(3)
+    lazy.undo()
+    assert not np.any(lazy.rejected_cells[:] == 1)
+    assert np.count_nonzero(lazy.rejected_cells[:] == 2) > 0
+    assert not np.any(lazy.labels[:] == 2)
+    assert not np.any(lazy.accepted_cells[:] == 3)
+
+    # the imported session is unchanged until it is exported again
+    saved = read(tmp_path / "session.zarr")
+    assert np.array_equal(saved[0], session.labels)
+    lazy.export(tmp_path / "session.csv")
+    saved = read(tmp_path / "session.zarr")
+    assert np.array_equal(saved[0], lazy.labels[:])
+    assert np.array_equal(saved[2], lazy.rejected_cells[:])
+    assert list(saved[5]) == [1, 2]
+
+
+def test_dask_session(segmentation, tmp_path):
+    labels = da.from_array(segmentation, chunks=(64, 64))
+    chunked = AnalysisSession(labels)
+    plain = AnalysisSession(segmentation.copy())
+    assert isinstance(chunked.labels, zarr.Array)
+    assert isinstance(chunked.accepted_cells, zarr.Array)
+    assert chunked.remaining == plain.remaining
+    for session in (chunked, plain):
+        session.include_cell(1)
+        session.exclude_cell(2)
+        session.undo()
+        session.exclude_cell(3)
+    assert np.array_equal(chunked.labels[:], plain.labels)
+    assert np.array_equal(chunked.accepted_cells[:], plain.accepted_cells)
+    assert np.array_equal(chunked.rejected_cells[:], plain.rejected_cells)
+    # edits stay in the session, the dask array is not changed
+    assert np.array_equal(labels.compute(), segmentation)
+
+    chunked.export(tmp_path / "chunked.csv")
+    plain.export(tmp_path / "plain.csv")
+    assert_same_session(tmp_path / "chunked.zarr", tmp_path / "plain.zarr")
+
+
+def assert_same_session(path, expected_path):
+    saved, expected = read(path), read(expected_path)
+    for saved_labels, expected_labels in zip(saved[:3], expected[:3]):
+        assert np.array_equal(saved_labels, expected_labels)
+    assert sorted(saved[3]) == sorted(expected[3])
+    assert np.array_equal(saved[4], expected[4])
+    assert saved[5] == expected[5]
+    for saved_entry, expected_entry in zip(
+        saved[5].all_entries(), expected[5].all_entries()
+    ):
+        assert saved_entry.action == expected_entry.action
+        assert saved_entry.region == expected_entry.region
+        assert saved_entry.diffs.keys() == expected_entry.diffs.keys()
+    assert saved[6] == expected[6]
+
+
+def test_save_changes(session, tmp_path):
+    assert session.snapshot_changes() is None
+    session.include_cell(1)
+    session.exclude_cell(2)
+    session.export(tmp_path / "session.csv")
+    assert not session.has_unsaved_changes()
+
+    session.undo()
+    session.undo()
+    session.redo()
+    session.include_multiple([3, 4])
+    session.undo()
+    session.undo()
+    session.include_cell(5)
+    session.exclude_cell(6)
+    session.undo()
+    assert session.has_unsaved_changes()
+    update = session.snapshot_changes()
+    assert session.save_changes(update)
+    assert not session.has_unsaved_changes()
+
+    expected = tmp_path / "expected.zarr"
+    write(
+        expected,
+        session.labels,
+        session.accepted_cells,
+        session.rejected_cells,
+        session.metric_data,
+        (session.mean_size, session.std_size),
+        session.undo_stack,
+        session.selfdrawn_lower_bound,
+    )
+    assert_same_session(tmp_path / "session.zarr", expected)
+
+    session.redo()
+    update = session.snapshot_changes()
+    session.export(tmp_path / "session.csv")
+    assert not session.save_changes(update)
+    assert update.changes.chunks
+
+
+def test_restore_changes(session, tmp_path):
+    session.export(tmp_path / "session.csv")
+    session.include_cell(1)
+    update = session.snapshot_changes()
+    assert not session.has_unsaved_changes()
+    session.restore_changes(update)
+    assert session.has_unsaved_changes()
+    assert session.changes.chunks == update.changes.chunks
+
+
+def test_background_export(session, tmp_path):
+    session.include_cell(1)
+    session.exclude_cell(2)
+    expected = tmp_path / "expected.zarr"
+    write(
+        expected,
+        session.labels.copy(),
+        session.accepted_cells.copy(),
+        session.rejected_cells.copy(),
+        session.metric_data,
+        (session.mean_size, session.std_size),
+        session.undo_stack,
+        session.selfdrawn_lower_bound,
+    )
+    export = session.start_export()
+    with pytest.raises(RuntimeError):
+        session.start_export()
+    # edits during the export are not part of it
+    session.undo()
+    session.include_multiple([3, 4])
+    session.exclude_cell(5)
+    assert not session.has_unsaved_changes()
+    progress = list(export.run(tmp_path / "session.csv"))
+    assert progress[-1] == 1.0
+    session.finish_export(export)
+    assert session.running_export is None
+    assert_same_session(tmp_path / "session.zarr", expected)
+
+    # and are saved by the next autosave
+    assert session.has_unsaved_changes()
+    assert session.save_changes(session.snapshot_changes())
+    write(
+        expected,
+        session.labels,
+        session.accepted_cells,
+        session.rejected_cells,
+        session.metric_data,
+        (session.mean_size, session.std_size),
+        session.undo_stack,
+        session.selfdrawn_lower_bound,
+    )
+    assert_same_session(tmp_path / "session.zarr", expected)
+
+
+def test_abort_export(session, tmp_path):
+    session.export(tmp_path / "session.csv")
+    saved = read(tmp_path / "session.zarr")
+    session.include_cell(1)
+    export = session.start_export()
+    session.exclude_cell(2)
+    export.cancel()
+    with pytest.raises(ExportCancelled):
+        export.write(tmp_path / "session.csv")
+    session.abort_export(export)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "session.csv",
+        "session.tiff",
+        "session.zarr",
+    ]
+    assert np.array_equal(read(tmp_path / "session.zarr")[1], saved[1])
+    # the previous export is updated with all changes since
+    assert session.has_unsaved_changes()
+    assert session.save_changes(session.snapshot_changes())
+    assert np.array_equal(
+        read(tmp_path / "session.zarr")[1], session.accepted_cells
+    )
+    assert np.array_equal(
+        read(tmp_path / "session.zarr")[2], session.rejected_cells
+    )
+
+
+def test_include_multiple(session, segmentation):
+    sequential = AnalysisSession(segmentation.copy())
+    session.include_cell(1)
+    session.exclude_cell(2)
+    sequential.include_cell(1)
+    sequential.exclude_cell(2)
+    ids = [7, 3, 0, 1, 2, 3, 5, 10**6]
+    included, ignored, overlapped, faulty = session.include_multiple(ids)
+    assert included == {3, 5, 7}
+    assert ignored == {1} and faulty == {2, 10**6} and not overlapped
+    assert session.undo_stack == [1, 2, 7, 3, 5]
+    for id_ in (7, 3, 5):
+        sequential.include_cell(id_)
+    assert np.array_equal(session.accepted_cells, sequential.accepted_cells)
+    assert list(session.metric_data) == list(sequential.metric_data)
+    assert (session.mean_size, session.std_size) == (
+        sequential.mean_size,
+        sequential.std_size,
+    )
+    for entry, expected in zip(
+        session.undo_stack.entries, sequential.undo_stack.entries
+    ):
+        assert entry.region == expected.region
+        assert entry.metric == expected.metric
+        assert entry.diffs.keys() == expected.diffs.keys()
+        for name, diff in entry.diffs.items():
+            assert diff.runs.tolist() == expected.diffs[name].runs.tolist()
@@ -0,0 +1,126 @@
+"""Tests for undo stack"""
+
+import numpy as np
+import zarr
+
+from mmv_h4cells._undo import PixelDiff, UndoEntry, UndoStack
+
+
+def test_behaves_like_id_list():
+    stack = UndoStack([3, UndoEntry(5, UndoEntry.EXCLUDE)])
+    assert stack == [3, 5]
+    assert stack[-1] == 5
+    assert 3 in stack and 4 not in stack
+    stack.append(7)
+    assert stack.pop(-1) == 7
+    assert len(stack) == 2
+    assert stack.entries[0].action is None
+
+
+def test_push_and_pop_entry():
+    stack = UndoStack()
+    assert stack.peek_entry() is None
+    metric = (4, 10, (1, 1))
+    entry = UndoEntry(4, UndoEntry.INCLUDE, (slice(0, 2), slice(0, 2)), metric)
+    stack.push(entry)
+    assert stack == [4]
+    assert stack.peek_entry() is entry
+    assert stack.pop_entry() is entry
+    assert stack == []
+
+
+def test_pixel_diff_round_trip():
+    before = np.zeros((6, 6), dtype=np.int32)
+    after = before.copy()
+    after[1:3, 1:4] = 5
+    after[4, 0] = 2
+    region = (slice(0, 6), slice(0, 6))
+    diff = PixelDiff.between(region, before, after)
+    assert diff.runs.tolist() == [[7, 3, 0, 5], [13, 3, 0, 5], [24, 1, 0, 2]]
+    data = np.zeros((10, 10), dtype=np.int32)
+    diff.apply(data)
+    assert np.array_equal(data[region], after)
+    diff.apply(data, reverse=True)
+    assert not data.any()
+    assert PixelDiff.between(region, before, before) is None
+
+
+def test_redo():
+    stack = UndoStack()
+    stack.push(UndoEntry(1, UndoEntry.INCLUDE))
+    stack.push(UndoEntry(2, UndoEntry.EXCLUDE))
+    stack.push_redo(stack.pop_entry())
+    assert stack == [1]
+    entry = stack.pop_redo()
+    assert entry.cell_id == 2
+    stack.push(entry, keep_redo=True)
+    stack.push_redo(stack.pop_entry())
+    stack.push(UndoEntry(3, UndoEntry.INCLUDE))
+    assert stack.pop_redo() is None
+
+
+def test_evict_oldest_diffs():
+    runs = np.zeros((1, 4), dtype=np.int64)
+    stack = UndoStack(max_bytes=2 * runs.nbytes)
+    region = (slice(0, 1), slice(0, 1))
+    for id_ in range(1, 4):
+        diff = PixelDiff(region, runs.copy())
+        stack.push(
+            UndoEntry(id_, UndoEntry.INCLUDE, region, None, {"a": diff})
+        )
+    assert stack == [1, 2, 3]
+    assert stack.entries[0].diffs is None
+    assert stack.entries[1].diffs is not None
+    assert stack.nbytes == 2 * runs.nbytes
+
+
+def test_evict_redo_entries():
+    runs = np.zeros((1, 4), dtype=np.int64)
+    stack = UndoStack(max_bytes=2 * runs.nbytes)
+    region = (slice(0, 1), slice(0, 1))
+    for id_ in range(1, 4):
+        diff = PixelDiff(region, runs.copy())
+        stack.push_redo(
+            UndoEntry(id_, UndoEntry.INCLUDE, region, None, {"a": diff})
+        )
+    # the entry undone first is redone last and is dropped
+    assert [entry.cell_id for entry in stack.redo_entries] == [2, 3]
+    assert stack.nbytes == 2 * runs.nbytes
+    stack.max_bytes = 0
+    stack.evict()
+    assert stack.redo_entries == [] and stack.nbytes == 0
+
+
+def test_zarr_round_trip():
+    region = (slice(2, 4), slice(1, 5))
+    diff = PixelDiff(region, np.array([[0, 3, 0, 4]], dtype=np.int64))
+    stack = UndoStack([9])
+    stack.push(UndoEntry(4, UndoEntry.INCLUDE, region, None, {}))
+    stack.entries[-1].diffs["accepted_cells"] = diff
+    stack.push(UndoEntry(6, UndoEntry.EXCLUDE, region, None, {}))
+    stack.push_redo(stack.pop_entry())
+    group = zarr.group()
+    stack.to_zarr(group.create_group("journal"))
+    restored = UndoStack.from_zarr(group["journal"])
+    assert restored == [9, 4]
+    assert restored.entries[0].action is None
+    assert restored.entries[0].diffs is None
+    entry = restored.entries[1]
+    assert entry.action == UndoEntry.INCLUDE
+    assert entry.region == region
+    assert list(entry.diffs) == ["accepted_cells"]
+    assert entry.diffs["accepted_cells"].region == region
+    assert entry.diffs["accepted_cells"].runs.tolist() == [[0, 3, 0, 4]]
+    redo = restored.pop_redo()
+    assert redo.cell_id == 6 and redo.diffs == {}
+
+
+def test_pixel_diff_from_mask():
+    mask = np.zeros((6, 6), dtype=bool)
+    mask[1:3, 1:4] = True
+    mask[2, 4:] = True
+    region = (slice(2, 8), slice(1, 7))
+    diff = PixelDiff.from_mask(region, mask, 0, 5)
+    expected = PixelDiff.between(region, np.zeros(mask.shape), mask * 5)
+    assert diff.runs.tolist() == expected.runs.tolist()
+    assert PixelDiff.from_mask(region, np.zeros_like(mask), 0, 5) is None
@@ -4,12 +4,19 @@ import pytest
 
 from unittest.mock import patch, call
 
+import dask.array as da
 import numpy as np
+import pandas as pd
+import threading
 from pathlib import Path
 from aicsimageio import AICSImage
 from qtpy.QtWidgets import QMessageBox
 
 from mmv_h4cells import CellAnalyzer
+from mmv_h4cells._export import ExportCancelled, SessionExport
+from mmv_h4cells._reader import read
+from mmv_h4cells._session import AnalysisSession
+from mmv_h4cells._writer import write
 
 PATH = Path(__file__).parent / "data"
 
@@ -103,6 +110,57 @@ def test_set_label_layer(create_widget):
     assert np.max(widget.accepted_cells) == 0
 
 
+def test_set_dask_label_layer(create_widget):
+    widget = create_widget
+    file = Path(PATH / "ex-seg.tiff")
+    segmentation = AICSImage(file).get_image_data("YX")
+
+    widget.viewer.layers.events.inserted.disconnect(widget.get_label_layer)
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    labels = da.from_array(segmentation, chunks=(64, 64))
+    layer = widget.viewer.add_labels(labels, name="segmentation")
+    widget.set_label_layer(layer)
+    assert layer.data is widget.session.labels
+    assert np.array_equal(layer.data[:], segmentation)
+    assert widget.checkbox_crop_current_cell.isChecked()
+    assert widget.remaining == set(np.unique(segmentation).tolist()) - {0}
+
+
+def test_paint_label_layer(create_widget, qtbot):
+    widget = create_widget
+    file = Path(PATH / "ex-seg.tiff")
+    segmentation = AICSImage(file).get_image_data("YX")
+
+    widget.viewer.layers.events.inserted.disconnect(widget.get_label_layer)
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    layer = widget.viewer.add_labels(segmentation, name="segmentation")
+    widget.set_label_layer(layer)
+    layer.data_setitem(np.nonzero(layer.data == 7), 0)
+    qtbot.waitUntil(lambda: not widget.painted_regions)
+    assert 7 not in widget.remaining
+    assert 7 not in widget.label_index
+    assert widget.label_amount_remaining.text() == "6"
+    layer.brush_size = 1
+    layer.paint((0, 0), 50)
+    qtbot.waitUntil(lambda: not widget.painted_regions)
+    assert layer.data[0, 0] == 50
+    assert 50 in widget.remaining
+    assert widget.label_index.bbox(50) == (slice(0, 1), slice(0, 1))
+
+    other = widget.viewer.add_labels(segmentation.copy(), name="other")
+    widget.set_label_layer(other)
+    widget.set_label_layer(other)
+    names = [
+        callback[1]
+        for callback in other.events.paint.callbacks
+        if isinstance(callback, tuple)
+    ]
+    assert names.count("slot_label_layer_painted") == 1
+    layer.paint((0, 0), 60)
+    assert not widget.painted_regions
+    assert 60 not in widget.remaining
+
+
 @pytest.mark.parametrize(
     "params",
     [
@@ -152,6 +210,72 @@ def test_start_analysis(create_widget):
     assert widget.lineedit_next_id.text() == "2"
 
 
+def test_start_analysis_cropped(create_widget):
+    widget = create_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    file = Path(PATH / "ex-seg.tiff")
+    segmentation = AICSImage(file).get_image_data("YX")
+
+    layer = widget.viewer.add_labels(segmentation, name="segmentation")
+    widget.checkbox_crop_current_cell.setChecked(True)
+    widget.start_analysis_on_click()
+    data = widget.current_cell_layer.data
+    assert data.size < layer.data.size
+    assert np.array_equal(np.unique(data), np.array([0, 1]))
+    offset = widget.current_cell_offset
+    assert tuple(widget.current_cell_layer.translate) == offset
+    full = np.zeros_like(layer.data)
+    region = tuple(
+        slice(start, start + size) for start, size in zip(offset, data.shape)
+    )
+    full[region] = data
+    assert np.array_equal(full == 1, layer.data == 1)
+
+
+@patch.object(QMessageBox, "exec_")
+def test_evaluate_cropped(mock_exec, create_widget):
+    widget = create_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    file = Path(PATH / "ex-seg.tiff")
+    segmentation = AICSImage(file).get_image_data("YX")
+    layer = widget.viewer.add_labels(segmentation.copy(), name="segmentation")
+    widget.checkbox_crop_current_cell.setChecked(True)
+    widget.start_analysis_on_click()
+    widget.include_on_click()
+    widget.exclude_on_click()
+    assert np.array_equal(widget.accepted_cells == 1, segmentation == 1)
+    assert np.array_equal(widget.rejected_cells == 2, segmentation == 2)
+    assert not np.any(layer.data == 2)
+    assert widget.metric_data[0][1] == np.count_nonzero(segmentation == 1)
+    widget.undo_on_click()
+    assert np.array_equal(layer.data == 2, segmentation == 2)
+    assert not np.any(widget.rejected_cells)
+    assert np.max(widget.current_cell_layer.data) == 2
+
+
+def test_include_overlap(create_started_widget):
+    widget = create_started_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    # paint the current cell over one pixel of another cell
+    indices = np.nonzero(widget.layer_to_evaluate.data == 3)
+    index = tuple(int(axis_indices[0]) for axis_indices in indices)
+    widget.current_cell_layer.data[index] = 1
+    widget.slot_current_cell_painted(None)
+
+    def check_overlap_layer():
+        overlap_layer = widget.viewer.layers["Overlap"]
+        assert overlap_layer.data.shape == (1,) * len(index)
+        assert tuple(overlap_layer.translate) == index
+
+    with patch.object(
+        QMessageBox, "exec_", side_effect=check_overlap_layer
+    ) as mock_exec:
+        assert not widget.include_on_click()
+        mock_exec.assert_called_once()
+    assert "Overlap" not in [layer.name for layer in widget.viewer.layers]
+    assert 1 in widget.remaining
+
+
 def test_display_cell(create_widget):
     widget = create_widget
     widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
@@ -339,57 +463,124 @@ def test_import_tiff_prompt(
     mock_update.called_once()
 
 
-@patch("mmv_h4cells._widget.save_dialog", return_value="test.csv")
-@patch("mmv_h4cells._widget.write")
-def test_export(
-    mock_write,
-    mock_save_dialog,
-    create_widget_in_analysis,
-):
+def test_export(create_widget_in_analysis, tmp_path, qtbot):
     widget = create_widget_in_analysis
     widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
-    widget.export_on_click()
+    widget.include_on_click()
+    accepted = widget.accepted_cells.copy()
+    metric_data = sorted(widget.metric_data)
+    with patch(
+        "mmv_h4cells._widget.save_dialog",
+        return_value=str(tmp_path / "test.csv"),
+    ) as mock_save_dialog:
+        widget.export_on_click()
+    mock_save_dialog.assert_called_once()
+    assert widget.export_worker is not None
+    assert widget.btn_export.text() == "Cancel export"
+    # the evaluation goes on while the export is written
+    widget.include_on_click()
+    qtbot.waitUntil(lambda: widget.export_worker is None)
+    assert widget.btn_export.text() == "Export"
+    assert widget.session.save_path == tmp_path / "test.zarr"
+    assert widget.session.has_unsaved_changes()
+    _, saved_accepted, _, data, _, _, _ = read(tmp_path / "test.zarr")
+    assert np.array_equal(saved_accepted, accepted)
+    assert sorted(data) == metric_data
+    assert (tmp_path / "test.csv").exists()
+    assert (tmp_path / "test.tiff").exists()
+    assert not list(tmp_path.glob("*.partial"))
+
+
+def test_export_cancel(create_widget_in_analysis, tmp_path, qtbot):
+    widget = create_widget_in_analysis
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+
+    def count_read(export, pixels):
+        # block the export until it is cancelled
+        assert export.cancelled.wait(10)
+        raise ExportCancelled("Export cancelled")
+
+    with patch.object(
+        SessionExport, "count_read", autospec=True, side_effect=count_read
+    ), patch(
+        "mmv_h4cells._widget.save_dialog",
+        return_value=str(tmp_path / "test.csv"),
+    ) as mock_save_dialog:
+        widget.export_on_click()
+        widget.export_on_click()
+        qtbot.waitUntil(lambda: widget.export_worker is None)
     mock_save_dialog.assert_called_once()
-    threshold = 0
+    assert widget.session.running_export is None
+    assert widget.session.save_path is None
+    assert not list(tmp_path.iterdir())
 
-    assert len(mock_write.call_args_list) == 3
-    mock_write.assert_has_calls(
-        [
-            call(
-                Path("test.csv"),
-                widget.metric_data,
-                (widget.mean_size, widget.std_size, threshold),
-                # (
-                #     float(conversion_rate) if conversion_rate else 1,
-                #     (
-                #         widget.combobox_conversion_unit.currentText()
-                #         if conversion_rate
-                #         else "pixel"
-                #     ),
-                # ),
-                # widget.excluded,
-                # widget.undo_stack,
-            ),
-            call(Path("test.tiff"), widget.accepted_cells),
-        ],
-        any_order=True,
-    )
+
+def test_export_locks_label_layer(create_widget_in_analysis, tmp_path, qtbot):
+    widget = create_widget_in_analysis
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    layer = widget.layer_to_evaluate
+    labels = np.array(layer.data)
+    release = threading.Event()
+
+    def count_read(export, pixels):
+        # hold the export until the layer was painted
+        assert release.wait(10)
+
+    with patch.object(
+        SessionExport, "count_read", autospec=True, side_effect=count_read
+    ), patch(
+        "mmv_h4cells._widget.save_dialog",
+        return_value=str(tmp_path / "test.csv"),
+    ):
+        widget.export_on_click()
+        assert not layer.editable
+        layer.mode = "paint"
+        assert layer.mode == "pan_zoom"
+        widget.include_on_click()
+        release.set()
+        qtbot.waitUntil(lambda: widget.export_worker is None)
+    assert layer.editable
+    layer.mode = "paint"
+    assert layer.mode == "paint"
+    saved_labels, *_ = read(tmp_path / "test.zarr")
+    assert np.array_equal(saved_labels, labels)
 
 
 @patch("mmv_h4cells._widget.save_dialog", return_value=".csv")
-@patch("mmv_h4cells._widget.write")
+@patch.object(AnalysisSession, "start_export")
 def test_export_no_file(
-    mock_write, mock_save_dialog, create_widget_in_analysis
+    mock_start_export, mock_save_dialog, create_widget_in_analysis
 ):
     widget = create_widget_in_analysis
     widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
     widget.export_on_click()
     mock_save_dialog.assert_called_once()
-    mock_write.assert_not_called()
+    mock_start_export.assert_not_called()
+
+
+def test_autosave(create_widget_in_analysis, tmp_path, qtbot):
+    widget = create_widget_in_analysis
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    widget.autosave()
+    assert widget.autosave_worker is None
+    with patch(
+        "mmv_h4cells._widget.save_dialog",
+        return_value=str(tmp_path / "session.csv"),
+    ):
+        widget.export_on_click()
+    qtbot.waitUntil(lambda: widget.export_worker is None)
+    widget.include_on_click()
+    widget.autosave()
+    assert widget.autosave_worker is not None
+    qtbot.waitUntil(lambda: widget.autosave_worker is None)
+    _, accepted, _, data, _, undo_stack, _ = read(tmp_path / "session.zarr")
+    assert np.array_equal(accepted, widget.accepted_cells)
+    assert sorted(data) == sorted(widget.metric_data)
+    assert undo_stack == widget.undo_stack
 
 
 @patch.object(CellAnalyzer, "check_for_overlap", return_value=False)
-@patch.object(CellAnalyzer, "include")
+@patch.object(AnalysisSession, "include")
 @patch.object(CellAnalyzer, "display_next_cell")
 @patch.object(QMessageBox, "exec_")
 @pytest.mark.parametrize("user_drawn", [True, False])
@@ -415,8 +606,12 @@ def test_include_on_click(
         mock_msg.assert_called_once()
         return
     mock_check.assert_called_once()
-    mock_include.assert_called_once_with(
-        1, widget.current_cell_layer.data, not user_drawn
+    mock_include.assert_called_once()
+    id_, data_array, remove, region = mock_include.call_args.args
+    assert id_ == 1
+    assert remove == (not user_drawn)
+    assert np.array_equal(
+        data_array, widget.current_cell_layer.data[region]
     )
 
     if remaining == {1, 2}:
@@ -427,7 +622,7 @@ def test_include_on_click(
 
 
 @patch.object(CellAnalyzer, "check_for_overlap", return_value=True)
-@patch.object(CellAnalyzer, "include")
+@patch.object(AnalysisSession, "include")
 @patch.object(CellAnalyzer, "display_next_cell")
 @patch.object(QMessageBox, "exec_")
 @pytest.mark.parametrize("remaining", [set(), {1}])
@@ -481,7 +676,7 @@ def test_exclude_on_click(
         mock_display.assert_called_once()
 
 
-@patch.object(CellAnalyzer, "calculate_metrics")
+@patch.object(AnalysisSession, "calculate_metrics")
 @patch.object(CellAnalyzer, "update_labels")
 @patch.object(CellAnalyzer, "display_next_cell")
 @patch.object(CellAnalyzer, "redisplay_current_cell")
@@ -588,7 +783,105 @@ def test_double_undo_next_ids(create_started_widget):
     assert widget.lineedit_next_id.text() == "2"
 
 
-@patch.object(CellAnalyzer, "calculate_metrics")
+def test_undo_after_sorted_metrics(create_started_widget):
+    widget = create_started_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    widget.include_on_click()
+    widget.include_on_click()
+    widget.metric_data.sort(key=lambda row: -row[0])
+    widget.undo_on_click()
+    assert [row[0] for row in widget.metric_data] == [1]
+    assert 2 not in widget.accepted_cells
+    assert 1 in widget.accepted_cells
+
+
+@pytest.mark.parametrize("operation", ["include", "exclude", "drawn"])
+def test_redo(create_started_widget, operation):
+    widget = create_started_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    if operation == "include":
+        widget.include_on_click()
+    elif operation == "exclude":
+        widget.exclude_on_click()
+    else:
+        widget.draw_own_cell()
+        widget.current_cell_layer.data[2:4, 2:4] = (
+            widget.current_cell_layer.selected_label
+        )
+        widget.draw_own_cell()
+    last_id = widget.undo_stack[-1]
+    state = [
+        widget.layer_to_evaluate.data.copy(),
+        widget.accepted_cells.copy(),
+        widget.rejected_cells.copy(),
+    ]
+    metric_data = list(widget.metric_data)
+    widget.undo_on_click()
+    assert last_id not in widget.undo_stack
+    widget.redo_on_click()
+    assert widget.undo_stack[-1] == last_id
+    assert np.array_equal(widget.layer_to_evaluate.data, state[0])
+    assert np.array_equal(widget.accepted_cells, state[1])
+    assert np.array_equal(widget.rejected_cells, state[2])
+    assert widget.metric_data == metric_data
+    assert last_id not in widget.remaining
+    if operation == "exclude":
+        assert last_id in widget.excluded
+    else:
+        assert last_id in widget.included
+    widget.undo_on_click()
+    assert last_id not in widget.accepted_cells
+    assert last_id not in widget.rejected_cells
+
+
+def test_redo_cleared_by_new_step(create_started_widget):
+    widget = create_started_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    widget.include_on_click()
+    widget.undo_on_click()
+    widget.exclude_on_click()
+    widget.redo_on_click()
+    assert widget.undo_stack == [1]
+    assert 1 in widget.excluded
+
+
+def test_session_round_trip(create_started_widget, tmp_path):
+    widget = create_started_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    widget.include_on_click()
+    widget.exclude_on_click()
+    widget.undo_on_click()
+    path = tmp_path / "session.zarr"
+    write(
+        path,
+        widget.layer_to_evaluate.data,
+        widget.accepted_cells,
+        widget.rejected_cells,
+        widget.metric_data,
+        (widget.mean_size, widget.std_size),
+        widget.undo_stack,
+        widget.selfdrawn_lower_bound,
+    )
+    undo_stack = read(path)[5]
+    assert undo_stack == [1]
+    assert undo_stack.entries[0].diffs.keys() == (
+        widget.undo_stack.entries[0].diffs.keys()
+    )
+    assert [entry.cell_id for entry in undo_stack.redo_entries] == [2]
+
+
+def test_undo_include_multiple(create_started_widget):
+    widget = create_started_widget
+    widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
+    widget.include_multiple([5, 3])
+    assert widget.undo_stack == [5, 3]
+    widget.undo_on_click()
+    assert [row[0] for row in widget.metric_data] == [5]
+    assert 3 in widget.remaining
+    assert 3 not in widget.accepted_cells
+
+
+@patch.object(AnalysisSession, "calculate_metrics")
 @patch.object(CellAnalyzer, "update_labels")
 @patch.object(CellAnalyzer, "display_next_cell")
 def test_undo_on_click_no_undo_stack(
@@ -815,7 +1108,7 @@ def test_get_ids_to_include_invalid_input(mock_exec, create_widget):
     mock_exec.assert_called_once()
 
 
-@patch.object(CellAnalyzer, "include")
+@patch.object(AnalysisSession, "include")
 @pytest.mark.parametrize("ids", [[], [1], [1, 2], [1, 2, 3], [1, 2, 3, 4]])
 def test_include_multiple(mock_include, create_widget_in_analysis, ids):
     widget = create_widget_in_analysis
@@ -973,7 +1266,7 @@ class TestDisplayNextCell:
             mock_set_text.assert_not_called()
 
 
-@patch.object(CellAnalyzer, "add_cell_to_accepted")
+@patch.object(AnalysisSession, "add_cell_to_accepted")
 @pytest.mark.parametrize("remove", [True, False])
 def test_include(mock_add, create_started_widget, remove):
     widget = create_started_widget
@@ -983,7 +1276,7 @@ def test_include(mock_add, create_started_widget, remove):
     data_array = np.zeros_like(widget.layer_to_evaluate.data)
     data_array[indices] = id_
     accepted_cells_sum = np.sum(widget.accepted_cells)
-    widget.include(id_, data_array, remove)
+    widget.session.include(id_, data_array, remove)
     assert np.sum(widget.accepted_cells) > accepted_cells_sum
     if remove:
         assert 1 not in widget.remaining
@@ -1014,45 +1307,38 @@ def test_check_for_overlap(
     else:
         assert not retval
 
-@pytest.mark.skip("Old test")
-# TODO: Update test
-@pytest.mark.parametrize("current_ids", [[4], [3, 4], [2, 3, 4]])
+@pytest.mark.parametrize("current_ids", [[1], [4], [1, 4], [2, 3, 4]])
 def test_get_overlap(create_started_widget, current_ids):
     widget = create_started_widget
     widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
     widget.current_cell_layer.data[:] = 0
     for id_ in current_ids:
         indices = np.where(widget.layer_to_evaluate.data == id_)
-        widget.current_cell_layer.data[indices] = 100
-    widget.accepted_cells[:] = 0
-    accepted_ids = [1, 2, 3]
-    for id_ in accepted_ids:
-        indices = np.where(widget.layer_to_evaluate.data == id_)
-        widget.accepted_cells[indices] = 101
-    overlap_ids = set(current_ids) & set(accepted_ids)
-    print(overlap_ids)
-    combined_layer = widget.current_cell_layer.data + widget.accepted_cells
-    expected_overlap = set(
-        map(tuple, np.transpose(np.where(combined_layer == 201)))
+        widget.current_cell_layer.data[indices] = 1
+    widget.slot_current_cell_painted(None)
+    # the displayed cell (id 1) is no overlap with itself
+    expected_overlap = np.flatnonzero(
+        (widget.current_cell_layer.data != 0)
+        & (widget.layer_to_evaluate.data != 0)
+        & (widget.layer_to_evaluate.data != 1)
     )
-    assert widget.get_overlap() == expected_overlap
+    overlap = widget.get_overlap()
+    assert np.array_equal(np.sort(overlap), expected_overlap)
 
 
-@patch.object(CellAnalyzer, "calculate_metrics")
-@patch.object(CellAnalyzer, "update_labels")
+@patch.object(AnalysisSession, "calculate_metrics")
 @pytest.mark.parametrize("cell_id", [1, 2])
 def test_add_cell_to_accepted(
-    mock_update_labels, mock_calculate_metrics, create_started_widget, cell_id
+    mock_calculate_metrics, create_started_widget, cell_id
 ):
     widget = create_started_widget
     widget.viewer.layers.events.removed.disconnect(widget.slot_layer_deleted)
     data = np.array([[0, 1, 1], [0, 1, 2], [0, 2, 1], [0, 2, 2]])
     assert cell_id not in widget.included
     metrics_len = len(widget.metric_data)
-    widget.add_cell_to_accepted(cell_id, data)
+    widget.session.add_cell_to_accepted(cell_id, data)
     assert cell_id in widget.included
     assert len(widget.metric_data) == metrics_len + 1
-    mock_update_labels.assert_called_once()
     mock_calculate_metrics.assert_called_once()
 
 
@@ -1117,13 +1403,57 @@ class TestCalculateMetrics:
         widget = create_widget
         widget.mean_size = 10
         widget.std_size = 10
-        widget.calculate_metrics()
+        widget.session.calculate_metrics()
         assert widget.mean_size == 0
         assert widget.std_size == 0
 
     def test_with_metrics(self, create_widget):
         widget = create_widget
         widget.metric_data = [(1, 100, (100, 100)), (2, 200, (200, 200))]
-        widget.calculate_metrics()
+        widget.session.calculate_metrics()
         assert widget.mean_size == 150
         assert widget.std_size == 50
+
+
+@patch("mmv_h4cells._widget.write")
+@patch.object(QMessageBox, "exec_")
+def test_call_export(mock_exec, mock_write, create_widget):
+    widget = create_widget
+    df = pd.DataFrame(
+        {
+            "id": [1, 2],
+            "count [px]": [10, 20],
+            "centroid (y,x)": [(1, 1), (2, 2)],
+            "area [px]": [10, 20],
+        }
+    )
+    paths = (Path("roi.csv"), Path("roi.tiff"))
+    widget.call_export((df, paths, 5))
+    mock_write.assert_called_once()
+    path, data, metrics, features = mock_write.call_args.args
+    assert path == Path("roi.csv")
+    assert data is df
+    assert metrics == (15.0, np.round(np.std([10, 20], ddof=1), 3), 5)
+    assert features == ["area [px]"]
+    mock_exec.assert_called_once()
+
+
+@patch.object(QMessageBox, "exec_")
+def test_get_rois(mock_exec, create_widget):
+    widget = create_widget
+    assert widget.combobox_roi_shapes.currentText() == "From CSV..."
+    rectangle = np.array([[0, 0], [0, 10], [10, 10], [10, 0]])
+    widget.viewer.add_shapes(
+        [rectangle, rectangle],
+        shape_type=["rectangle", "polygon"],
+        name="rois",
+    )
+    widget.combobox_roi_shapes.setCurrentText("rois")
+    rois = widget.get_rois()
+    assert [roi.shape_type for roi in rois] == ["rectangle", "polygon"]
+    mock_exec.assert_not_called()
+
+    widget.viewer.layers["rois"].add_ellipses(rectangle)
+    with pytest.raises(ValueError):
+        widget.get_rois()
+    mock_exec.assert_called_once()
@@ -2,18 +2,28 @@
 
 import pytest
 
+import csv
+import gzip
 import numpy as np
+import pandas as pd
+import tifffile
+import zarr
 
 from unittest.mock import patch, Mock, call, mock_open
 from pathlib import Path
 
 from qtpy.QtWidgets import QFileDialog
+from mmv_h4cells._metric_table import MetricTable
 from mmv_h4cells._writer import (
     save_dialog,
     write,
     get_writer,
+    label_dtype,
     write_csv,
+    write_table_csv,
     write_tiff,
+    write_zarr,
+    ZARR_CHUNK_SIZE,
 )
 
 
@@ -71,45 +81,117 @@ def test_get_writer(filename, expected):
     assert retval == expected
 
 
-@patch("csv.writer")
-def test_write_csv(mock_csv_writer):
-    path = Path("test.csv")
-    mock_file = mock_open()
-    mock_file.return_value.__enter__.return_value = "arbitrary_string"
-    mocked_writer = Mock()
-    mock_writerow = Mock()
-    mock_csv_writer.return_value = mocked_writer
-    mocked_writer.writerow = mock_writerow
-    data = [(1, 2, (3, 4))]
-    metrics = (5, 6)
-    # pixelsize = (7, "mm")
-    # excluded = {8}
-    # undo_stack = [9]
-    with patch("builtins.open", mock_file):
-        write_csv(path, data, metrics)
-    mock_file.assert_called_once_with(path, "w", newline="")
-    mock_csv_writer.assert_called_once_with("arbitrary_string", delimiter=",")
-    # mock_writerow.assert_has_calls(
-    #     [call(metrics), call(pixelsize)], any_order=True
-    # )
-    assert mock_writerow.call_count == 5
-
-
-@patch("aicsimageio.writers.OmeTiffWriter.save")
-def test_write_tiff(mock_save):
-    array = np.zeros((10, 10))
-
-    def mock_side_effect(data, _, dim_order_out):
-        assert isinstance(data[0, 0], np.uint16)
-        assert dim_order_out == "YX"
-
-    mock_save.side_effect = mock_side_effect
-    path = Path("test.tiff")
+def reference_csv(path, data, metrics, features, delimiter):
+    """Writes the analysis csv row by row with csv.writer"""
+    with open(path, "w", newline="") as file:
+        csv_writer = csv.writer(file, delimiter=delimiter)
+        csv_writer.writerow(["ID", "Size [px]", "Centroid", *features, ""])
+        for row in data:
+            csv_writer.writerow(row)
+        csv_writer.writerow([])
+        csv_writer.writerow(
+            ["Mean size [px]", "Std size [px]", "Threshold size [px]"]
+        )
+        csv_writer.writerow(metrics)
+
+
+@pytest.mark.parametrize("delimiter", [",", ";"])
+def test_write_csv(tmp_path, delimiter):
+    rows = [(1, 20, (3, 4), 0.5, "a,b"), (12, 7, (10, 11), 1e-5, 'say "x"')]
+    metrics = (13.5, 6.5, 0)
+    features = ["eccentricity", "note"]
+    path = tmp_path / "test.csv"
+    with patch(
+        "mmv_h4cells._writer.csv_format", return_value=(delimiter, ".")
+    ):
+        write_csv(path, iter(rows), metrics, features)
+    reference_csv(tmp_path / "ref.csv", rows, metrics, features, delimiter)
+    assert path.read_bytes() == (tmp_path / "ref.csv").read_bytes()
+
+    table = MetricTable([row[:3] for row in rows])
+    df = pd.DataFrame(rows, columns=["id", "size", "centroid", *features])
+    with patch("mmv_h4cells._writer.csv_format", return_value=(",", ".")):
+        write_csv(path, table, metrics)
+        reference_csv(tmp_path / "ref.csv", table, metrics, [], ",")
+        assert path.read_bytes() == (tmp_path / "ref.csv").read_bytes()
+        write_csv(path, df, metrics, features)
+        reference_csv(tmp_path / "ref.csv", rows, metrics, features, ",")
+        assert path.read_bytes() == (tmp_path / "ref.csv").read_bytes()
+        write_csv(path, MetricTable(), metrics)
+        assert path.read_text().splitlines()[1] == ""
+
+
+def test_write_csv_german(tmp_path):
+    path = tmp_path / "test.csv"
+    with patch("mmv_h4cells._writer.csv_format", return_value=(";", ",")):
+        write_csv(path, [(1, 20, (3, 4), 0.25)], (20.0, 0.0, 0), ["ecc"])
+    lines = path.read_text().splitlines()
+    assert lines[0] == "ID;Size [px];Centroid;ecc;"
+    assert lines[1] == "1;20;(3, 4);0,25"
+    assert lines[-1] == "20.0;0.0;0"
+
+
+def test_write_table_csv_german(tmp_path):
+    path = tmp_path / "summary.csv"
+    table = pd.DataFrame({"roi": ["a"], "seconds": [0.25], "bbox": [(1, 2)]})
+    with patch("mmv_h4cells._writer.csv_format", return_value=(";", ",")):
+        write_table_csv(path, table)
+    assert path.read_bytes() == b"roi;seconds;bbox\r\na;0,25;(1, 2)\r\n"
+
+
+def test_write_csv_gzip(tmp_path):
+    path = tmp_path / "test.csv.gz"
+    rows = [(1, 20, (3, 4))]
+    assert get_writer(path) == write_csv
+    write_csv(path, rows, (20.0, 0.0, 0))
+    write_csv(tmp_path / "test.csv", rows, (20.0, 0.0, 0))
+    with gzip.open(path, "rb") as file:
+        assert file.read() == (tmp_path / "test.csv").read_bytes()
+
+
+@pytest.mark.parametrize(
+    "max_label,dtype", [(10, np.uint8), (300, np.uint16), (70000, np.uint32)]
+)
+def test_write_tiff(tmp_path, max_label, dtype):
+    array = np.zeros((600, 300), dtype=np.int64)
+    array[10:20, 10:20] = max_label
+    array[500:, 280:] = 1
+    path = tmp_path / "test.tiff"
     write_tiff(path, array)
-    mock_save.assert_called_once()
-    args, arg3 = mock_save.call_args
-    dim_order_out = arg3["dim_order_out"]
-    arg1, arg2 = args
-    assert np.array_equal(arg1, array)
-    assert arg2 == path
-    assert dim_order_out == "YX"
+    with tifffile.TiffFile(path) as tiff:
+        page = tiff.pages[0]
+        assert tiff.is_ome
+        assert page.is_tiled
+        assert page.compression == tifffile.COMPRESSION.ADOBE_DEFLATE
+        assert page.dtype == dtype
+        assert np.array_equal(page.asarray(), array)
+
+
+def test_write_tiff_zarr(tmp_path):
+    array = zarr.zeros((600, 300), chunks=(256, 256), dtype=np.int32)
+    array[300:, 100:] = 5
+    write_tiff(tmp_path / "test.tiff", array)
+    assert np.array_equal(tifffile.imread(tmp_path / "test.tiff"), array[:])
+
+
+def test_label_dtype():
+    assert label_dtype(0) == np.uint8
+    assert label_dtype(65535) == np.uint16
+    assert label_dtype(65536) == np.uint32
+    assert label_dtype(2**32) == np.uint64
+
+
+def test_write_zarr(tmp_path):
+    labels = np.zeros((700, 300), dtype=np.int32)
+    labels[10:20, 10:20] = 1
+    labels[600:650, 200:250] = 2
+    path = tmp_path / "session.zarr"
+    write_zarr(path, labels, labels, np.zeros_like(labels), [], (0, 0), [], 3)
+    zarr_file = zarr.open(str(path), mode="r")
+    for name in ("data_to_valuate", "accepted_cells", "rejected_cells"):
+        array = zarr_file[name]
+        assert array.chunks == (ZARR_CHUNK_SIZE, 300)
+        assert array.compressor.cname == "zstd"
+        assert array.dtype == np.int32
+    assert np.array_equal(zarr_file["data_to_valuate"][:], labels)
+    assert zarr_file.attrs["selfdrawn_lower_bound"] == 3
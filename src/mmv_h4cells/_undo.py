@@ -0,0 +1,541 @@
+import numpy as np
+from collections.abc import MutableSequence
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from mmv_h4cells._label_index import store_region
+
+# default upper bound for the memory used by the pixel diffs of a journal
+JOURNAL_MAX_BYTES = 2**28
+
+# names of the label images an undo entry may hold pixel diffs for
+JOURNAL_ARRAYS = ("layer_to_evaluate", "accepted_cells", "rejected_cells")
+
+# codes used to store the action of an entry in a zarr group
+ACTION_CODES = {None: 0, "include": 1, "exclude": 2}
+
+
+class PixelDiff:
+    """
+    Run-length encoded change of a label image within a region
+
+    Every run covers consecutive pixels of the flattened region that changed
+    from the same value to the same value, so the diff of a cell costs a few
+    runs per image row instead of a copy of the region.
+    """
+
+    def __init__(self, region: Tuple[slice, ...], runs: np.ndarray):
+        self.region = region  # region of the label image the diff covers
+        self.runs = runs  # (start, length, before, after) of each run
+
+    @classmethod
+    def between(
+        cls,
+        region: Tuple[slice, ...],
+        before: np.ndarray,
+        after: np.ndarray,
+    ) -> Optional["PixelDiff"]:
+        """
+        Encodes the change between two versions of a region
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the label image both arrays cover
+        before : np.ndarray
+            Labels of the region before the change
+        after : np.ndarray
+            Labels of the region after the change
+
+        Returns
+        -------
+        PixelDiff or None
+            Diff of the region, None if nothing changed
+        """
+        before = np.asarray(before).ravel()
+        after = np.asarray(after).ravel()
+        changed = np.flatnonzero(before != after)
+        if len(changed) == 0:
+            return None
+        old = before[changed].astype(np.int64)
+        new = after[changed].astype(np.int64)
+        breaks = np.r_[
+            True,
+            (np.diff(changed) != 1)
+            | (old[1:] != old[:-1])
+            | (new[1:] != new[:-1]),
+        ]
+        starts = np.flatnonzero(breaks)
+        lengths = np.diff(np.r_[starts, len(changed)])
+        runs = np.stack(
+            [changed[starts], lengths, old[starts], new[starts]], axis=1
+        ).astype(np.int64)
+        return cls(region, runs)
+
+    @classmethod
+    def from_mask(
+        cls,
+        region: Tuple[slice, ...],
+        mask: np.ndarray,
+        before: int,
+        after: int,
+    ) -> Optional["PixelDiff"]:
+        """
+        Encodes the change of the pixels of a mask from one value to another
+
+        Equals `between` for a region whose masked pixels all changed from
+        `before` to `after`, without comparing two copies of the region.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the label image the mask covers
+        mask : np.ndarray
+            Boolean mask of the changed pixels within the region
+        before : int
+            Value of the masked pixels before the change
+        after : int
+            Value of the masked pixels after the change
+
+        Returns
+        -------
+        PixelDiff or None
+            Diff of the region, None if nothing changed
+        """
+        changed = np.flatnonzero(mask)
+        if len(changed) == 0 or before == after:
+            return None
+        starts = np.flatnonzero(np.r_[True, np.diff(changed) != 1])
+        lengths = np.diff(np.r_[starts, len(changed)])
+        runs = np.empty((len(starts), 4), dtype=np.int64)
+        runs[:, 0] = changed[starts]
+        runs[:, 1] = lengths
+        runs[:, 2] = before
+        runs[:, 3] = after
+        return cls(region, runs)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the runs"""
+        return self.runs.nbytes
+
+    def apply(self, data: np.ndarray, reverse: bool = False):
+        """
+        Writes the diff into a label image
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Label image the diff was taken from
+        reverse : bool, optional
+            Whether to restore the values from before the change, by default
+            False
+        """
+        starts, lengths, before, after = self.runs.T
+        total = int(lengths.sum())
+        offsets = np.arange(total) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        flat = np.repeat(starts, lengths) + offsets
+        values = np.repeat(before if reverse else after, lengths)
+        shape = tuple(s.stop - s.start for s in self.region)
+        view = data[self.region]
+        view[np.unravel_index(flat, shape)] = values
+        store_region(data, self.region, view)
+
+
+class UndoEntry:
+    """
+    Record of a single evaluation step that can be undone
+
+    Holds everything needed to revert the step without searching the label
+    images or the metric data for the cell.
+    """
+
+    INCLUDE = "include"
+    EXCLUDE = "exclude"
+
+    def __init__(
+        self,
+        cell_id: int,
+        action: Optional[str] = None,
+        region: Optional[Tuple[slice, ...]] = None,
+        metric: Optional[tuple] = None,
+        diffs: Optional[Dict[str, PixelDiff]] = None,
+    ):
+        self.cell_id = int(cell_id)  # id of the evaluated cell
+        self.action: Optional[str] = (
+            action  # INCLUDE or EXCLUDE, None if unknown
+        )
+        self.region: Optional[Tuple[slice, ...]] = (
+            region  # bounding box of the pixels written for the cell
+        )
+        self.metric: Optional[tuple] = (
+            metric  # row of the metric data added for the cell
+        )
+        self.diffs: Optional[Dict[str, PixelDiff]] = (
+            diffs  # pixel diffs of the step by label image, None if unknown
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the pixel diffs of the entry"""
+        if self.diffs is None:
+            return 0
+        return sum(diff.nbytes for diff in self.diffs.values())
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}({self.cell_id}, {self.action!r}, "
+            f"{self.region}, {self.metric})"
+        )
+
+
+class UndoStack(MutableSequence):
+    """
+    Undo/redo journal that behaves like a list of cell ids
+
+    Indexing, iteration and comparison use the cell ids of the undo entries
+    so the stack can be used wherever a list of evaluated ids is expected,
+    while `push` and `pop_entry` give access to the full entries. Plain ids
+    added to the stack are stored as entries with unknown action.
+
+    Undone entries are kept for redo until a new entry is pushed. When the
+    pixel diffs of all entries exceed `max_bytes`, the diffs of the oldest
+    entries are dropped; those entries can still be undone through the cell
+    stores, only their diffs are gone.
+    """
+
+    def __init__(
+        self,
+        entries: Iterable[Union[UndoEntry, int]] = (),
+        max_bytes: int = JOURNAL_MAX_BYTES,
+    ):
+        self.entries: List[UndoEntry] = [
+            self._to_entry(entry) for entry in entries
+        ]  # entries in order of evaluation
+        self.redo_entries: List[UndoEntry] = (
+            []
+        )  # undone entries, most recently undone last
+        self.max_bytes = max_bytes  # memory cap of all pixel diffs
+        self.nbytes = sum(
+            entry.nbytes for entry in self.entries
+        )  # memory used by all pixel diffs
+
+    @staticmethod
+    def _to_entry(value: Union[UndoEntry, int]) -> UndoEntry:
+        if isinstance(value, UndoEntry):
+            return value
+        return UndoEntry(value)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [entry.cell_id for entry in self.entries[index]]
+        return self.entries[index].cell_id
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self.entries[index] = [self._to_entry(item) for item in value]
+        else:
+            self.entries[index] = self._to_entry(value)
+        self.nbytes = sum(entry.nbytes for entry in self.all_entries())
+
+    def __delitem__(self, index):
+        del self.entries[index]
+        self.nbytes = sum(entry.nbytes for entry in self.all_entries())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (UndoStack, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)})"
+
+    def insert(self, index: int, value: Union[UndoEntry, int]):
+        entry = self._to_entry(value)
+        self.entries.insert(index, entry)
+        self.nbytes += entry.nbytes
+        self.evict()
+
+    def all_entries(self) -> List[UndoEntry]:
+        """Returns the undo entries followed by the redo entries"""
+        return self.entries + self.redo_entries
+
+    def push(self, entry: UndoEntry, keep_redo: bool = False):
+        """
+        Adds an entry on top of the stack
+
+        Parameters
+        ----------
+        entry : UndoEntry
+            Entry to add
+        keep_redo : bool, optional
+            Whether to keep the undone entries for redo, by default False
+        """
+        if not keep_redo:
+            for undone in self.redo_entries:
+                self.nbytes -= undone.nbytes
+            self.redo_entries = []
+        self.entries.append(entry)
+        self.nbytes += entry.nbytes
+        self.evict()
+
+    def peek_entry(self) -> Optional[UndoEntry]:
+        """Returns the entry on top of the stack, None if it is empty"""
+        return self.entries[-1] if self.entries else None
+
+    def pop_entry(self) -> UndoEntry:
+        """Removes and returns the entry on top of the stack"""
+        entry = self.entries.pop()
+        self.nbytes -= entry.nbytes
+        return entry
+
+    def push_redo(self, entry: UndoEntry):
+        """Keeps an undone entry so it can be redone"""
+        self.redo_entries.append(entry)
+        self.nbytes += entry.nbytes
+        self.evict()
+
+    def pop_redo(self) -> Optional[UndoEntry]:
+        """Removes and returns the most recently undone entry, if any"""
+        if not self.redo_entries:
+            return None
+        entry = self.redo_entries.pop()
+        self.nbytes -= entry.nbytes
+        return entry
+
+    def evict(self):
+        """
+        Drops diffs until the memory cap is met
+
+        The diffs of the oldest entries are dropped first, those entries
+        are undone through the cell stores. Redoing needs the diffs, so if
+        the cap is still exceeded the undone entries that would be redone
+        last are forgotten.
+        """
+        for entry in self.entries:
+            if self.nbytes <= self.max_bytes:
+                break
+            self.nbytes -= entry.nbytes
+            entry.diffs = None
+        while self.nbytes > self.max_bytes and self.redo_entries:
+            self.nbytes -= self.redo_entries.pop(0).nbytes
+
+    def to_zarr(self, group):
+        """
+        Writes the journal into a zarr group
+
+        Parameters
+        ----------
+        group : zarr.hierarchy.Group
+            Empty group to write the journal into
+        """
+        for name, entries in (
+            ("undo", self.entries),
+            ("redo", self.redo_entries),
+        ):
+            _entries_to_zarr(group.create_group(name), entries)
+        group.attrs["max_bytes"] = int(self.max_bytes)
+
+    @staticmethod
+    def update_zarr(
+        group,
+        start: int,
+        entries: List[UndoEntry],
+        redo_entries: List[UndoEntry],
+    ):
+        """
+        Updates a journal written by `to_zarr`
+
+        Parameters
+        ----------
+        group : zarr.hierarchy.Group
+            Group holding the journal
+        start : int
+            Amount of undo entries that are unchanged since the journal was
+            written
+        entries : list of UndoEntry
+            Undo entries following the unchanged ones
+        redo_entries : list of UndoEntry
+            All undone entries, they replace the written ones
+        """
+        _append_entries_to_zarr(group["undo"], entries, start)
+        del group["redo"]
+        _entries_to_zarr(group.create_group("redo"), redo_entries)
+
+    @classmethod
+    def from_zarr(cls, group) -> "UndoStack":
+        """
+        Reads a journal written by `to_zarr`
+
+        Parameters
+        ----------
+        group : zarr.hierarchy.Group
+            Group holding the journal
+
+        Returns
+        -------
+        UndoStack
+            Journal without metric rows, those are stored with the metrics
+        """
+        stack = cls(
+            _entries_from_zarr(group["undo"]),
+            group.attrs.get("max_bytes", JOURNAL_MAX_BYTES),
+        )
+        for entry in _entries_from_zarr(group["redo"]):
+            stack.push_redo(entry)
+        return stack
+
+
+def _entries_to_zarr(group, entries: List[UndoEntry]):
+    """Writes entries as flat arrays, runs of all diffs are concatenated"""
+    ndim = 0
+    for entry in entries:
+        if entry.region is not None:
+            ndim = len(entry.region)
+            break
+    arrays = _encode_entries(entries, ndim)
+    for name in ("ids", "actions", "regions"):
+        group.array(name, arrays[name])
+    for name in JOURNAL_ARRAYS:
+        diff_group = group.create_group(name)
+        for key, values in arrays[name].items():
+            diff_group.array(key, values)
+
+
+def _encode_entries(entries: List[UndoEntry], ndim: int) -> dict:
+    """Encodes entries as the flat arrays written by `_entries_to_zarr`"""
+    ids = np.array([entry.cell_id for entry in entries], dtype=np.int64)
+    actions = np.array(
+        [ACTION_CODES[entry.action] for entry in entries], dtype=np.int8
+    )
+    regions = np.full((len(entries), 2 * ndim), -1, dtype=np.int64)
+    for i, entry in enumerate(entries):
+        if entry.region is not None:
+            regions[i, :ndim] = [s.start for s in entry.region]
+            regions[i, ndim:] = [s.stop for s in entry.region]
+    arrays = {"ids": ids, "actions": actions, "regions": regions}
+    for name in JOURNAL_ARRAYS:
+        diffs = [
+            None if entry.diffs is None else entry.diffs.get(name)
+            for entry in entries
+        ]
+        # -1 marks entries without any diffs, 0 entries without this one
+        present = np.array(
+            [
+                -1 if entry.diffs is None else int(diff is not None)
+                for entry, diff in zip(entries, diffs)
+            ],
+            dtype=np.int8,
+        )
+        runs = [diff.runs for diff in diffs if diff is not None]
+        counts = np.array(
+            [0 if diff is None else len(diff.runs) for diff in diffs],
+            dtype=np.int64,
+        )
+        diff_regions = np.array(
+            [
+                [s.start for s in diff.region] + [s.stop for s in diff.region]
+                for diff in diffs
+                if diff is not None
+            ],
+            dtype=np.int64,
+        ).reshape(len(runs), 2 * ndim)
+        arrays[name] = {
+            "present": present,
+            "counts": counts,
+            "regions": diff_regions,
+            "runs": (
+                np.concatenate(runs)
+                if runs
+                else np.zeros((0, 4), dtype=np.int64)
+            ),
+        }
+    return arrays
+
+
+def _append_entries_to_zarr(group, entries: List[UndoEntry], start: int):
+    """
+    Replaces the entries written by `_entries_to_zarr` from `start` on
+
+    Only the arrays past the kept entries are rewritten, so the cost
+    depends on the amount of new entries instead of the whole journal.
+    """
+    ndim = group["regions"].shape[1] // 2
+    if any(
+        entry.region is not None and len(entry.region) != ndim
+        for entry in entries
+    ):
+        # the journal was written without any region
+        kept = _entries_from_zarr(group)[:start]
+        for name in list(group.keys()):
+            del group[name]
+        _entries_to_zarr(group, kept + list(entries))
+        return
+    arrays = _encode_entries(entries, ndim)
+    for name in JOURNAL_ARRAYS:
+        diff_group = group[name]
+        present = diff_group["present"][:start]
+        kept = {
+            "present": start,
+            "counts": start,
+            "regions": int(np.count_nonzero(present > 0)),
+            "runs": int(diff_group["counts"][:start].sum()),
+        }
+        for key, length in kept.items():
+            _truncate_and_append(diff_group[key], length, arrays[name][key])
+    for name in ("ids", "actions", "regions"):
+        _truncate_and_append(group[name], start, arrays[name])
+
+
+def _truncate_and_append(array, length: int, values: np.ndarray):
+    """Keeps the first `length` rows of a zarr array and appends values"""
+    array.resize((length,) + array.shape[1:])
+    if len(values):
+        array.append(values)
+
+
+def _entries_from_zarr(group) -> List[UndoEntry]:
+    """Reads entries written by `_entries_to_zarr`"""
+    actions = {code: action for action, code in ACTION_CODES.items()}
+    regions = group["regions"][:]
+    ndim = regions.shape[1] // 2
+    entries = []
+    for id_, action, region in zip(
+        group["ids"][:], group["actions"][:], regions
+    ):
+        entries.append(
+            UndoEntry(
+                int(id_),
+                actions[int(action)],
+                _to_slices(region, ndim) if ndim and region[0] >= 0 else None,
+            )
+        )
+    for name in JOURNAL_ARRAYS:
+        diff_group = group[name]
+        present = diff_group["present"][:]
+        counts = diff_group["counts"][:]
+        diff_regions = iter(diff_group["regions"][:])
+        runs = diff_group["runs"][:]
+        ends = np.cumsum(counts)
+        for entry, flag, end, count in zip(entries, present, ends, counts):
+            if flag < 0:
+                continue
+            if entry.diffs is None:
+                entry.diffs = {}
+            if flag > 0:
+                entry.diffs[name] = PixelDiff(
+                    _to_slices(next(diff_regions), ndim),
+                    runs[end - count : end],
+                )
+    return entries
+
+
+def _to_slices(bounds: np.ndarray, ndim: int) -> Tuple[slice, ...]:
+    return tuple(
+        slice(int(lower), int(upper))
+        for lower, upper in zip(bounds[:ndim], bounds[ndim:])
+    )
@@ -1,8 +1,8 @@
-import copy
 import logging
 from qtpy.QtWidgets import (
     QLabel,
     QGridLayout,
+    QHBoxLayout,
     QVBoxLayout,
     QPushButton,
     QWidget,
@@ -13,25 +13,84 @@ from qtpy.QtWidgets import (
     QMessageBox,
     QGroupBox,
     QDialog,
+    QCheckBox,
+    QProgressBar,
 )
-from qtpy.QtCore import QEvent
+from qtpy.QtCore import QEvent, QTimer
 
 import napari
 import numpy as np
 import pandas as pd
-from typing import List, Tuple, Set
+from typing import Dict, List, Optional, Tuple, Set
 from pathlib import Path
 from mmv_h4cells import __version__ as version
+from mmv_h4cells._autosave import AUTOSAVE_INTERVAL_MS, SessionUpdate
+from mmv_h4cells._export import ExportCancelled, SessionExport
+from mmv_h4cells._label_index import (
+    crop_region,
+    edited_region,
+    find_overlap,
+    full_region,
+    remaining_labels,
+)
 from mmv_h4cells._reader import open_dialog, read
-from mmv_h4cells._roi import analyse_roi
+from mmv_h4cells._roi import analyse_roi, roi_metrics
+from mmv_h4cells._roi_batch import (
+    analyse_roi_batch,
+    read_roi_csv,
+    rois_from_shapes,
+)
+from mmv_h4cells._session import AnalysisSession
 from mmv_h4cells._writer import save_dialog, write
+from napari.layers import Image, Shapes
 from napari.layers.labels.labels import Labels
+from napari.qt.threading import WorkerBase, create_worker
 from scipy import ndimage
 
 import time
 
+# images with at least this many pixels show the current cell cropped
+CROP_MIN_PIXELS = 4096 * 4096
+# pixels around a cell that are part of the cropped current cell layer
+CROP_MARGIN = 20
+# edge length of the cropped current cell layer when drawing own cells
+DRAW_TILE_SIZE = 512
+# entry of the ROI shapes combobox that reads the ROIs from a CSV file
+ROI_CSV_ENTRY = "From CSV..."
+
+
+class SessionAttribute:
+    """Attribute of the widget that is stored on its analysis session"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, widget, owner=None):
+        if widget is None:
+            return self
+        return getattr(widget.session, self.name)
+
+    def __set__(self, widget, value):
+        setattr(widget.session, self.name, value)
+
 
 class CellAnalyzer(QWidget):
+    # decision state of the evaluation, see AnalysisSession
+    accepted_store = SessionAttribute()
+    rejected_store = SessionAttribute()
+    accepted_cells = SessionAttribute()
+    rejected_cells = SessionAttribute()
+    metric_data = SessionAttribute()
+    mean_size = SessionAttribute()
+    std_size = SessionAttribute()
+    remaining = SessionAttribute()
+    included = SessionAttribute()
+    excluded = SessionAttribute()
+    undo_stack = SessionAttribute()
+    label_index = SessionAttribute()
+    next_id = SessionAttribute()
+    selfdrawn_lower_bound = SessionAttribute()
+
     def __init__(self, viewer: napari.viewer.Viewer):
         super().__init__()
         self.viewer = viewer
@@ -56,12 +115,6 @@ class CellAnalyzer(QWidget):
         self.layer_to_evaluate: Labels = (
             None  # label layer with remaining and included cells
         )
-        self.accepted_cells: (
-            np.ndarray
-        )  # label layer esque for all accepted cells
-        self.rejected_cells: np.ndarray = (
-            None  # label layer esque for all rejected cells
-        )
         self.current_cell_layer: Labels = (
             None  # label layer consisting of the current cell to evaluate
         )
@@ -70,27 +123,38 @@ class CellAnalyzer(QWidget):
         self.remaining_layer: Labels = (
             None  # label layer of all remaining cells
         )
-        self.metric_data: List[Tuple[int, int, Tuple[int, int]]] = (
-            []
-        )  # list of tuples holding cell-id and metric data (adjust if more metrics need to be saved)
-        self.mean_size: float = 0  # mean size of all selected cells
-        self.std_size: float = (
-            0  # standard deviation of size of all selected cells
-        )
         # self.metric_value: datatype = 0
-        self.remaining: Set[int] = set()  # set of all remaining cell ids
-        self.included: Set[int] = set()  # set of all included cell ids
-        self.excluded: Set[int] = set()  # set of all excluded cell ids
-        self.undo_stack: List[int] = []  # stack of cell ids to undo
-
-        self.next_id: int = None  # computed id of the next cell to evaluate
-
-        self.selfdrawn_lower_bound: int = (
-            None  # lower bound of self drawn cell id
+        self.session: AnalysisSession = (
+            AnalysisSession()
+        )  # decision state of the evaluation, see the session attributes
+        self.current_cell_region: Tuple[slice, ...] = (
+            None  # region of the current cell layer that may contain labels
+        )
+        self.current_cell_offset: Tuple[int, ...] = (
+            None  # position of the current cell layer in the image
+        )
+        self.current_cell_cropped: bool = (
+            False  # whether the current cell layer only holds a crop
+        )
+        self.autosave_worker: WorkerBase = (
+            None  # worker writing the running autosave
+        )
+        self.export_worker: WorkerBase = (
+            None  # worker writing the running export
+        )
+        self.painted_regions: List[Tuple[slice, ...]] = (
+            []
+        )  # regions painted into the label layer since the last update
+        self.export_locked_layer: Optional[Tuple[Labels, bool]] = (
+            None  # label layer locked during the export and its editability
         )
 
         self.initialize_ui()
 
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_timer.start(AUTOSAVE_INTERVAL_MS)
+
         # Hotkeys
 
         hotkeys = self.viewer.keymap.keys()
@@ -112,6 +176,11 @@ class CellAnalyzer(QWidget):
                 viewer.bind_key(*custom_bind)
 
         self.viewer.layers.events.inserted.connect(self.get_label_layer)
+        self.viewer.layers.events.inserted.connect(
+            self.update_intensity_images
+        )
+        self.viewer.layers.events.removed.connect(self.update_intensity_images)
+        self.update_intensity_images()
         for layer in self.viewer.layers:
             if isinstance(layer, Labels):
                 self.set_label_layer(layer)
@@ -124,17 +193,21 @@ class CellAnalyzer(QWidget):
         self.logger.info("Ready to use")
 
     def slot_layer_deleted(self, event):
-        def readd_layer(data, name):
+        def readd_layer(data, name, translate):
             self.logger.debug("Important layer removed")
             msg = QMessageBox()
             msg.setWindowTitle("napari")
             msg.setText("Please don't remove this layer, we need it.")
             msg.exec_()
-            return self.viewer.add_labels(data, name=name)
+            return self.viewer.add_labels(
+                data, name=name, translate=translate
+            )
 
         self.logger.debug("Layer deleted")
         if event.value in [self.current_cell_layer, self.layer_to_evaluate]:
-            layer = readd_layer(event.value.data, event.value.name)
+            layer = readd_layer(
+                event.value.data, event.value.name, event.value.translate
+            )
             if event.value.name == self.layer_to_evaluate.name:
                 self.layer_to_evaluate = layer
             else:
@@ -144,6 +217,12 @@ class CellAnalyzer(QWidget):
         if event.type() == QEvent.Hide:
             self.logger.debug("Disconnecting slots...")
             self.viewer.layers.events.inserted.disconnect(self.get_label_layer)
+            self.viewer.layers.events.inserted.disconnect(
+                self.update_intensity_images
+            )
+            self.viewer.layers.events.removed.disconnect(
+                self.update_intensity_images
+            )
             self.viewer.layers.events.removed.disconnect(
                 self.slot_layer_deleted
             )
@@ -202,6 +281,8 @@ class CellAnalyzer(QWidget):
             + "First value can be -1 to evaluate everything below the first value."
         )
         label_threshold_size = QLabel("Threshold size:")
+        label_intensity_image = QLabel("Intensity image:")
+        label_roi_shapes = QLabel("ROI shapes:")
 
         label_mean.setToolTip(
             "Only accounting for cells which have been included"
@@ -217,6 +298,7 @@ class CellAnalyzer(QWidget):
         self.btn_include = QPushButton("Include")
         self.btn_exclude = QPushButton("Exclude")
         self.btn_undo = QPushButton("Undo")
+        self.btn_redo = QPushButton("Redo")
         self.btn_cancel = QPushButton("Cancel")
         self.btn_show_included = QPushButton("Show Included")
         self.btn_show_excluded = QPushButton("Show Excluded")
@@ -224,6 +306,10 @@ class CellAnalyzer(QWidget):
         self.btn_segment = QPushButton("Draw own cell")
         self.btn_include_multiple = QPushButton("Include multiple")
         self.btn_export_roi = QPushButton("Export ROI")
+        self.btn_export_roi_batch = QPushButton("Export ROIs")
+        self.progress_export = QProgressBar()
+        self.progress_export.setRange(0, 100)
+        self.progress_export.setVisible(False)
 
         self.btn_start_analysis.clicked.connect(self.start_analysis_on_click)
         self.btn_export.clicked.connect(self.export_on_click)
@@ -231,6 +317,7 @@ class CellAnalyzer(QWidget):
         self.btn_include.clicked.connect(self.include_on_click)
         self.btn_exclude.clicked.connect(self.exclude_on_click)
         self.btn_undo.clicked.connect(self.undo_on_click)
+        self.btn_redo.clicked.connect(self.redo_on_click)
         self.btn_cancel.clicked.connect(self.cancel_on_click)
         self.btn_show_included.clicked.connect(self.show_included_on_click)
         self.btn_show_excluded.clicked.connect(self.show_excluded_on_click)
@@ -240,6 +327,9 @@ class CellAnalyzer(QWidget):
             self.include_multiple_on_click
         )
         self.btn_export_roi.clicked.connect(self.export_roi_on_click)
+        self.btn_export_roi_batch.clicked.connect(
+            self.export_roi_batch_on_click
+        )
 
         self.btn_export.setToolTip(
             "Export mask of included cells and analysis csv"
@@ -256,12 +346,14 @@ class CellAnalyzer(QWidget):
         self.btn_undo.setToolTip(
             'Undo last selection. Instead of clicking this button, you can also press the "H" key.'
         )
+        self.btn_redo.setToolTip("Redo last undone selection.")
 
         self.btn_start_analysis.setEnabled(False)
         self.btn_export.setEnabled(False)
         self.btn_include.setEnabled(False)
         self.btn_exclude.setEnabled(False)
         self.btn_undo.setEnabled(False)
+        self.btn_redo.setEnabled(False)
         self.btn_cancel.setVisible(False)
         self.btn_show_included.setEnabled(False)
         self.btn_show_excluded.setEnabled(False)
@@ -288,7 +380,37 @@ class CellAnalyzer(QWidget):
             "The ROI may split cells at the edge, this threshold allows cells with fewer pixels to be excluded"
         )
 
+        # Checkboxes
+        self.checkbox_crop_current_cell = QCheckBox("Crop current cell")
+        self.checkbox_crop_current_cell.setToolTip(
+            "Only hold the surroundings of the current cell in the current cell layer.\n"
+            + "Reduces memory usage and latency for large images.\n"
+            + "Labels can only be painted close to the current cell."
+        )
+
+        self.roi_feature_checkboxes: Dict[str, QCheckBox] = {
+            "area": QCheckBox("Area"),
+            "perimeter": QCheckBox("Perimeter"),
+            "eccentricity": QCheckBox("Eccentricity"),
+            "mean_intensity": QCheckBox("Mean intensity"),
+        }  # optional per-cell features of the ROI analysis
+        self.roi_feature_checkboxes["perimeter"].setToolTip(
+            "Amount of cell pixels touching another label or the background"
+        )
+        self.roi_feature_checkboxes["mean_intensity"].setToolTip(
+            "Mean value of the intensity image within each cell"
+        )
+
         # Comboboxes
+        self.combobox_intensity_image = QComboBox()
+        self.combobox_intensity_image.setToolTip(
+            "Image layer used for the mean intensity"
+        )
+        self.combobox_roi_shapes = QComboBox()
+        self.combobox_roi_shapes.setToolTip(
+            "Shapes layer or CSV file with the rectangles and polygons\n"
+            + "to be analysed by Export ROIs"
+        )
         # self.combobox_conversion_unit = QComboBox()
 
         # self.combobox_conversion_unit.addItems(["mm", "µm", "nm"])
@@ -344,7 +466,24 @@ class CellAnalyzer(QWidget):
             self.lineedit_threshold_size, 2, 1, 1, -1
         )
 
-        groupbox_roi.layout().addWidget(self.btn_export_roi, 3, 0, 1, -1)
+        for column, checkbox in enumerate(
+            self.roi_feature_checkboxes.values()
+        ):
+            groupbox_roi.layout().addWidget(checkbox, 3, column, 1, 1)
+
+        groupbox_roi.layout().addWidget(label_intensity_image, 4, 0, 1, 1)
+        groupbox_roi.layout().addWidget(
+            self.combobox_intensity_image, 4, 1, 1, -1
+        )
+
+        groupbox_roi.layout().addWidget(self.btn_export_roi, 5, 0, 1, -1)
+
+        groupbox_roi.layout().addWidget(label_roi_shapes, 6, 0, 1, 1)
+        groupbox_roi.layout().addWidget(self.combobox_roi_shapes, 6, 1, 1, -1)
+
+        groupbox_roi.layout().addWidget(
+            self.btn_export_roi_batch, 7, 0, 1, -1
+        )
 
         ### GUI
         content = QWidget()
@@ -355,7 +494,12 @@ class CellAnalyzer(QWidget):
 
         content.layout().addWidget(self.btn_import, 2, 0, 1, 1)
         content.layout().addWidget(self.btn_segment, 2, 1, 1, 1)
-        content.layout().addWidget(self.btn_export, 2, 2, 1, 1)
+        export = QWidget()
+        export.setLayout(QHBoxLayout())
+        export.layout().setContentsMargins(0, 0, 0, 0)
+        export.layout().addWidget(self.btn_export)
+        export.layout().addWidget(self.progress_export)
+        content.layout().addWidget(export, 2, 2, 1, 1)
 
         content.layout().addWidget(self.btn_start_analysis, 3, 0, 1, 1)
         content.layout().addWidget(self.label_next_id, 3, 1, 1, 1)
@@ -364,7 +508,12 @@ class CellAnalyzer(QWidget):
         content.layout().addWidget(line1, 4, 0, 1, -1)
 
         content.layout().addWidget(self.btn_exclude, 5, 0, 1, 1)
-        content.layout().addWidget(self.btn_undo, 5, 1, 1, 1)
+        undo_redo = QWidget()
+        undo_redo.setLayout(QHBoxLayout())
+        undo_redo.layout().setContentsMargins(0, 0, 0, 0)
+        undo_redo.layout().addWidget(self.btn_undo)
+        undo_redo.layout().addWidget(self.btn_redo)
+        content.layout().addWidget(undo_redo, 5, 1, 1, 1)
         content.layout().addWidget(self.btn_cancel, 5, 1, 1, 1)
         content.layout().addWidget(self.btn_include, 5, 2, 1, 1)
 
@@ -392,6 +541,9 @@ class CellAnalyzer(QWidget):
         content.layout().addWidget(self.lineedit_include, 12, 1, 1, 1)
         content.layout().addWidget(self.btn_include_multiple, 12, 2, 1, 1)
 
+        content.layout().addWidget(
+            self.checkbox_crop_current_cell, 13, 0, 1, -1
+        )
         # content.layout().addWidget(label_conversion, 13, 0, 1, 1)
         # content.layout().addWidget(self.lineedit_conversion_rate, 13, 1, 1, 1)
         # content.layout().addWidget(self.combobox_conversion_unit, 13, 2, 1, 1)
@@ -414,6 +566,23 @@ class CellAnalyzer(QWidget):
         endtime = time.time()
         self.logger.debug(f"Runtime UI initialization: {endtime - starttime}")
 
+    def update_intensity_images(self, event=None):
+        """Lists the image and shapes layers available for the ROIs."""
+        for combobox, layer_type, extra in [
+            (self.combobox_intensity_image, Image, []),
+            (self.combobox_roi_shapes, Shapes, [ROI_CSV_ENTRY]),
+        ]:
+            selected = combobox.currentText()
+            names = [
+                layer.name
+                for layer in self.viewer.layers
+                if isinstance(layer, layer_type)
+            ] + extra
+            combobox.clear()
+            combobox.addItems(names)
+            if selected in names:
+                combobox.setCurrentText(selected)
+
     def get_label_layer(self, event):
         self.logger.debug("New potential label layer detected...")
         if not self.layer_to_evaluate is None:
@@ -428,20 +597,29 @@ class CellAnalyzer(QWidget):
     def set_label_layer(self, layer):
         self.logger.debug("Setting label layer...")
         starttime = time.time()
+        if self.layer_to_evaluate is not None:
+            # paints into the previous layer do not belong to the new labels
+            self.layer_to_evaluate.events.paint.disconnect(
+                self.slot_label_layer_painted
+            )
+        self.painted_regions = []
         self.layer_to_evaluate = layer
         self.btn_start_analysis.setEnabled(True)
-        unique_ids = np.unique(self.layer_to_evaluate.data)
-        self.logger.debug(f"{len(unique_ids)} unique ids found")
-        if self.selfdrawn_lower_bound is None:
-            self.selfdrawn_lower_bound = max(unique_ids) + 1
-
-        if len(self.metric_data) == 0:
-            self.accepted_cells = np.zeros_like(self.layer_to_evaluate.data)
-            self.rejected_cells = np.zeros_like(self.layer_to_evaluate.data)
-            self.remaining = set(unique_ids) - {0}
-        next_id = str(min(self.remaining)) if len(self.remaining) > 0 else ""
+        if self.session.labels is not layer.data:
+            self.session.set_labels(layer.data)
+        if self.session.labels is not layer.data:
+            # dask arrays are wrapped in an editable zarr array
+            layer.data = self.session.labels
+        layer.events.paint.connect(self.slot_label_layer_painted)
+        self.checkbox_crop_current_cell.setChecked(
+            self.layer_to_evaluate.data.size >= CROP_MIN_PIXELS
+            or not isinstance(layer.data, np.ndarray)
+        )
+        self.logger.debug(f"{len(self.label_index)} unique ids found")
+        next_id = (
+            str(self.remaining.lowest()) if len(self.remaining) > 0 else ""
+        )
         self.lineedit_next_id.setText(next_id)
-        self.next_id = next_id if next_id != "" else None
         self.logger.debug(
             f"Selfdrawn lower bound: {self.selfdrawn_lower_bound}"
         )
@@ -494,26 +672,33 @@ class CellAnalyzer(QWidget):
         self.btn_export.setEnabled(True)
         self.btn_show_included.setEnabled(True)
         self.btn_undo.setEnabled(True)
+        self.btn_redo.setEnabled(True)
         self.btn_show_excluded.setEnabled(True)
         self.btn_show_remaining.setEnabled(True)
         self.btn_segment.setEnabled(True)
         self.btn_include_multiple.setEnabled(True)
+        self.checkbox_crop_current_cell.setEnabled(False)
         self.label_next_id.setText("Next cell:")
         self.layer_to_evaluate.opacity = 0.3
 
+        data = self.layer_to_evaluate.data
+        # a full size layer of a chunked label image may not fit in memory
+        self.current_cell_cropped = (
+            self.checkbox_crop_current_cell.isChecked()
+            or not isinstance(data, np.ndarray)
+        )
+        if self.current_cell_cropped:
+            self.logger.debug("Using cropped current cell layer")
+            data = np.zeros((1,) * data.ndim, dtype=data.dtype)
         self.current_cell_layer = self.viewer.add_labels(
-            np.zeros_like(self.layer_to_evaluate.data), name="Current Cell"
-        )
-        if not start_id in self.remaining:
-            self.logger.warning("Start id not in remaining ids")
-            lower_ids = {value for value in self.remaining if value < start_id}
-            if len(lower_ids) > 0:
-                self.logger.info("Using lower id")
-                start_id = max(lower_ids)
-            else:
-                self.logger.info("Using lowest remaining id")
-                start_id = min(self.remaining)
-        self.next_id = min(x for x in self.remaining if x > start_id)
+            np.zeros(data.shape, dtype=data.dtype), name="Current Cell"
+        )
+        self.current_cell_offset = (0,) * data.ndim
+        self.current_cell_region = None
+        self.current_cell_layer.events.paint.connect(
+            self.slot_current_cell_painted
+        )
+        start_id = self.session.start(start_id)
         self.lineedit_next_id.setText(
             str(self.next_id) if self.next_id is not None else ""
         )
@@ -524,20 +709,150 @@ class CellAnalyzer(QWidget):
 
     def display_cell(self, cell_id: int):
         self.logger.debug(f"Displaying cell {cell_id}")
-        self.current_cell_layer.data[:] = 0
-        indices = np.where(self.layer_to_evaluate.data == cell_id)
-        self.current_cell_layer.data[indices] = cell_id
+        region, mask = self.session.get_cell_mask(cell_id, prefetched=True)
+        if self.current_cell_cropped:
+            self.set_current_cell_tile(
+                tuple(
+                    slice(max(s.start - CROP_MARGIN, 0), s.stop + CROP_MARGIN)
+                    for s in region
+                )
+            )
+            region = self.to_layer_region(region)
+        else:
+            self.clear_current_cell()
+        self.current_cell_layer.data[region][mask] = cell_id
+        self.current_cell_region = region
         self.current_cell_layer.opacity = 0.7
         self.current_cell_layer.refresh()
-        centroid = ndimage.center_of_mass(
-            self.current_cell_layer.data,
-            labels=self.current_cell_layer.data,
-            index=cell_id,
-        )
+        centroid = self.label_index.centroid(cell_id)
         self.viewer.camera.center = centroid
         self.logger.debug(f"Centroid: {centroid}")
         self.viewer.camera.zoom = 7.5  # !!
         self.current_cell_layer.selected_label = cell_id
+        # read the following cells while this one is evaluated
+        self.session.prefetch(cell_id)
+
+    def clear_current_cell(self):
+        """Removes all labels from the current cell layer."""
+        if self.current_cell_region is not None:
+            self.current_cell_layer.data[self.current_cell_region] = 0
+        self.current_cell_region = None
+
+    def set_current_cell_tile(self, region: Tuple[slice, ...]):
+        """
+        Replaces the cropped current cell layer by an empty tile.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the image the tile covers, clipped to the image bounds
+        """
+        region = tuple(
+            slice(s.start, min(s.stop, size))
+            for s, size in zip(region, self.layer_to_evaluate.data.shape)
+        )
+        self.current_cell_offset = tuple(s.start for s in region)
+        self.current_cell_layer.data = np.zeros(
+            [s.stop - s.start for s in region],
+            dtype=self.layer_to_evaluate.data.dtype,
+        )
+        self.current_cell_layer.translate = self.current_cell_offset
+        self.current_cell_region = full_region(
+            self.current_cell_layer.data.shape
+        )
+
+    def to_image_region(
+        self, region: Tuple[slice, ...]
+    ) -> Tuple[slice, ...]:
+        """
+        Converts a region of the current cell layer to a region of the image.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the current cell layer
+
+        Returns
+        -------
+        tuple of slice
+            Region of the image
+        """
+        return tuple(
+            slice(s.start + offset, s.stop + offset)
+            for s, offset in zip(region, self.current_cell_offset)
+        )
+
+    def to_layer_region(
+        self, region: Tuple[slice, ...]
+    ) -> Tuple[slice, ...]:
+        """
+        Converts a region of the image to a region of the current cell layer.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the image
+
+        Returns
+        -------
+        tuple of slice
+            Region of the current cell layer
+        """
+        return tuple(
+            slice(s.start - offset, s.stop - offset)
+            for s, offset in zip(region, self.current_cell_offset)
+        )
+
+    def slot_label_layer_painted(self, event):
+        # single edits emit the paint event before their pixels are written,
+        # so the edited regions are logged and applied once napari returned
+        region = edited_region(event.value, self.layer_to_evaluate.data.shape)
+        if region is None:
+            return
+        if not self.painted_regions:
+            QTimer.singleShot(0, self.apply_painted_regions)
+        self.painted_regions.append(region)
+
+    def apply_painted_regions(self):
+        """
+        Updates the session with the regions painted into the label layer.
+
+        Keeps the label index, the remaining cells and the autosave in step
+        with corrections painted into the label layer, see
+        `AnalysisSession.labels_edited`.
+        """
+        regions, self.painted_regions = self.painted_regions, []
+        for region in regions:
+            self.session.labels_edited(region)
+        self.update_labels()
+
+    def slot_current_cell_painted(self, _):
+        # painted pixels may lie anywhere in the layer
+        self.current_cell_region = full_region(
+            self.current_cell_layer.data.shape
+        )
+
+    def get_current_cell_centroid(self) -> Tuple[float, ...]:
+        """
+        Returns the centroid of the selected label in the current cell layer.
+
+        Returns
+        -------
+        tuple of float
+            Centroid of the current cell
+        """
+        region = self.current_cell_region
+        if region is None:
+            region = full_region(self.current_cell_layer.data.shape)
+        cell = self.current_cell_layer.data[region]
+        centroid = ndimage.center_of_mass(
+            cell,
+            labels=cell,
+            index=self.current_cell_layer.selected_label,
+        )
+        return tuple(
+            c + s.start for c, s in zip(centroid, self.to_image_region(region))
+        )
 
     def import_on_click(self):
         self.logger.debug("Importing data...")
@@ -547,71 +862,136 @@ class CellAnalyzer(QWidget):
             return
         zarr_filepath = csv_filepath.with_suffix(".zarr")
         try:
-            data_to_evaluate, accepted_cells, rejected_cells, data, metrics, undo_stack, self.selfdrawn_lower_bound = read(
-                zarr_filepath
-            )
+            data_to_evaluate, *session_data = read(zarr_filepath, lazy=True)
         except FileNotFoundError:
             zarr_filepath = Path(open_dialog(self), dir=True)
             if str(zarr_filepath) == ".":
                 self.logger.debug("No zarr file selected. Aborting.")
                 return
-            data_to_evaluate, accepted_cells, rejected_cells, data, metrics, undo_stack, self.selfdrawn_lower_bound = read(
-                zarr_filepath
-            )
-        self.logger.debug(f"Minimum id: {min(pd.unique(data_to_evaluate.flatten()))}, Maximum id: {max(pd.unique(data_to_evaluate.flatten()))}")
-        self.accepted_cells = accepted_cells
-        self.rejected_cells = rejected_cells
-        self.mean_size, self.std_size = metrics  # , self.metric_value = ...
-        self.undo_stack = undo_stack.tolist()
-        self.included = set(pd.unique(self.accepted_cells.flatten())) - {0}
-        self.excluded = set(pd.unique(self.rejected_cells.flatten())) - {0}
+            data_to_evaluate, *session_data = read(zarr_filepath, lazy=True)
+        self.logger.debug(
+            f"Opened label images of shape {data_to_evaluate.shape}"
+        )
         self.btn_export.setEnabled(True)
-        self.metric_data = data
 
         layer = self.viewer.add_labels(data_to_evaluate, name="Imported Data")
-        self.set_label_layer(layer)
-
         self.logger.debug("Filling in values for imported data")
-        unique_ids = pd.unique(self.layer_to_evaluate.data.flatten())
-        self.remaining = set(unique_ids) - (
-            self.included | self.excluded | {0}
-        )
-        next_id = (
-            str(min(self.remaining)) if len(self.remaining) > 0 else ""
-        )
-        self.lineedit_next_id.setText(next_id)
+        self.session.load(layer.data, *session_data)
+        self.set_label_layer(layer)
         self.btn_start_analysis.setEnabled(True)
 
         self.update_labels()
 
     def export_on_click(self):
+        """
+        Exports the session, or cancels the running export.
+
+        The session is snapshotted on the GUI thread and written by a
+        worker thread, so the evaluation can go on during the export.
+        """
+        if self.export_worker is not None:
+            self.logger.debug("Cancelling export...")
+            self.session.cancel_export()
+            return
         self.logger.debug("Exporting data...")
         csv_filepath = Path(save_dialog(self))
         if csv_filepath.name == ".csv":
             self.logger.debug("No file selected. Aborting.")
             return
-        zarr_filepath = csv_filepath.with_suffix(".zarr")
-        tiff_filepath = csv_filepath.with_suffix(".tiff")
-        self.metric_data = sorted(self.metric_data, key=lambda x: x[0])
-        write(
+        export = self.session.start_export()
+        self.lock_label_layer()
+        # errors are handled by export_failed instead of being raised again
+        worker = create_worker(
+            export.run,
             csv_filepath,
-            self.metric_data,
-            (self.mean_size, self.std_size, 0),
-        )
-        self.logger.debug("Metrics written to csv")
-        write(tiff_filepath, self.accepted_cells)
-        self.logger.debug("Accepted cells written to tiff")
-        write(
-            zarr_filepath,
-            self.layer_to_evaluate.data,
-            self.accepted_cells,
-            self.rejected_cells,
-            self.metric_data,
-            (self.mean_size, self.std_size),
-            self.undo_stack,
-            self.selfdrawn_lower_bound,
+            _start_thread=False,
+            _connect={
+                "yielded": lambda progress: self.progress_export.setValue(
+                    int(progress * 100)
+                ),
+                "returned": lambda _: self.export_finished(export),
+                "errored": lambda error: self.export_failed(export, error),
+                "finished": self.export_stopped,
+            },
+        )
+        self.export_worker = worker
+        self.btn_export.setText("Cancel export")
+        self.progress_export.setValue(0)
+        self.progress_export.setVisible(True)
+        worker.start()
+
+    def export_finished(self, export: SessionExport):
+        self.session.finish_export(export)
+        self.logger.debug("Export finished")
+
+    def export_failed(self, export: SessionExport, error: Exception):
+        self.session.abort_export(export)
+        if isinstance(error, ExportCancelled):
+            self.logger.debug("Export cancelled")
+            return
+        self.logger.error(f"Export failed: {error}")
+        msg = QMessageBox()
+        msg.setWindowTitle("napari")
+        msg.setText(f"Export failed: {error}")
+        msg.exec_()
+
+    def lock_label_layer(self):
+        """
+        Stops painting into the label layer while an export is running.
+
+        napari writes painted pixels before the session is told about them,
+        too late to preserve the region for the export snapshot, see
+        `AnalysisSession.preserve_region`. Including and excluding cells
+        goes on during the export.
+        """
+        layer = self.layer_to_evaluate
+        if layer is None:
+            return
+        self.export_locked_layer = (layer, layer.editable)
+        layer.editable = False
+
+    def unlock_label_layer(self):
+        """Restores the editability of the label layer after an export."""
+        if self.export_locked_layer is None:
+            return
+        layer, editable = self.export_locked_layer
+        self.export_locked_layer = None
+        layer.editable = editable
+
+    def export_stopped(self):
+        self.unlock_label_layer()
+        self.export_worker = None
+        self.btn_export.setText("Export")
+        self.progress_export.setVisible(False)
+
+    def autosave(self):
+        """
+        Saves the changes since the last save to the exported session.
+
+        The changed chunks are copied on the GUI thread and written by a
+        worker thread. Nothing is saved before the first export or while
+        the previous autosave is running.
+        """
+        if self.autosave_worker is not None:
+            return
+        update = self.session.snapshot_changes()
+        if update is None:
+            return
+        self.logger.debug("Autosaving...")
+        worker = create_worker(self.session.save_changes, update)
+        worker.errored.connect(
+            lambda error: self.autosave_failed(update, error)
         )
-        self.logger.debug("Data written to zarr")
+        worker.finished.connect(self.autosave_finished)
+        self.autosave_worker = worker
+        worker.start()
+
+    def autosave_failed(self, update: SessionUpdate, error: Exception):
+        self.logger.warning(f"Autosave failed: {error}")
+        self.session.restore_changes(update)
+
+    def autosave_finished(self):
+        self.autosave_worker = None
 
     def include_on_click(self, self_drawn=False):
         """
@@ -642,7 +1022,9 @@ class CellAnalyzer(QWidget):
         endtime = time.time()
         self.logger.debug(f"Runtime overlap check: {endtime - starttime_abs}")
         starttime = time.time()
-        if len(pd.unique(self.current_cell_layer.data.flatten())) > 2:
+        region = self.current_cell_region
+        cell = self.current_cell_layer.data[region]
+        if len(pd.unique(cell.ravel())) > 2:
             self.logger.debug("Multiple ids in current cell layer")
             msg = QMessageBox()
             msg.setWindowTitle("napari")
@@ -654,15 +1036,14 @@ class CellAnalyzer(QWidget):
         endtime = time.time()
         self.logger.debug(f"Runtime multiple ids check: {endtime - starttime}")
         starttime = time.time()
-        id_ = int(np.max(self.current_cell_layer.data))
-        self.include(id_, self.current_cell_layer.data, not self_drawn)
-        if self_drawn:
-            self.layer_to_evaluate.data += self.current_cell_layer.data
+        id_ = int(np.max(cell))
+        self.session.include_cell(
+            id_, cell, self.to_image_region(region), self_drawn
+        )
+        self.update_labels()
         endtime = time.time()
         self.logger.debug(f"Runtime include: {endtime - starttime}")
 
-        self.undo_stack.append(id_)
-
         if len(self.remaining) > 0:
             starttime = time.time()
             self.display_next_cell()
@@ -684,7 +1065,9 @@ class CellAnalyzer(QWidget):
             msg.exec_()
             return
 
-        unique_ids = pd.unique(self.current_cell_layer.data.flatten())
+        region = self.current_cell_region
+        cell = self.current_cell_layer.data[region]
+        unique_ids = pd.unique(cell.ravel())
         if len(unique_ids) > 2:
             self.logger.debug("Multiple ids in current cell layer")
             msg = QMessageBox()
@@ -696,13 +1079,9 @@ class CellAnalyzer(QWidget):
             return
 
         current_id = int(max(unique_ids))
-        self.excluded.add(current_id)
-        self.remaining.remove(current_id)
-        self.undo_stack.append(current_id)
-
-        mask = np.where(self.current_cell_layer.data == current_id)
-        self.rejected_cells[mask] = current_id
-        self.layer_to_evaluate.data[mask] = 0
+        self.session.exclude_cell(
+            current_id, cell == current_id, self.to_image_region(region)
+        )
         self.layer_to_evaluate.refresh()
 
         self.update_labels()
@@ -717,39 +1096,41 @@ class CellAnalyzer(QWidget):
             return
         self.logger.debug("Before undo:")
         self.logger.debug(f"Last evaluated: {self.undo_stack[-1]}")
-        last_evaluated = self.undo_stack.pop(-1)
-        if last_evaluated < self.selfdrawn_lower_bound:
-            self.logger.debug("Adding cell back to remaining")
-            self.remaining.add(last_evaluated)
-        if last_evaluated in self.accepted_cells:
-            self.logger.debug("Removing cell from accepted")
-            self.metric_data.pop(-1)
-            indices = np.where(self.accepted_cells == last_evaluated)
-            self.accepted_cells[indices] = 0
-            self.included.remove(last_evaluated)
-            if last_evaluated >= self.selfdrawn_lower_bound:
-                mask = np.where(self.layer_to_evaluate.data == last_evaluated)
-                self.layer_to_evaluate.data[mask] = 0
-                self.layer_to_evaluate.refresh()
-        else:
-            self.excluded.remove(last_evaluated)
-            mask = np.where(self.rejected_cells == last_evaluated)
-            self.layer_to_evaluate.data[mask] = last_evaluated
-            self.rejected_cells[mask] = 0
+        last_evaluated = self.session.undo().cell_id
+        self.layer_to_evaluate.refresh()
         self.lineedit_next_id.setText(str(last_evaluated))
 
-        self.calculate_metrics()
         self.update_labels()
         if last_evaluated < self.selfdrawn_lower_bound:
             self.display_next_cell(True)
         else:
             self.redisplay_current_cell()
 
+    def redo_on_click(self):
+        self.logger.debug("Redoing last undone action...")
+        entry = self.session.redo()
+        if entry is None:
+            self.logger.info("No actions to redo")
+            return
+        redone = entry.cell_id
+        self.logger.debug(f"Redone: {redone}")
+        self.layer_to_evaluate.refresh()
+
+        self.update_labels()
+        if (
+            redone == self.current_cell_layer.selected_label
+            and len(self.remaining) > 0
+        ):
+            self.display_next_cell()
+        else:
+            self.redisplay_current_cell()
+
     def cancel_on_click(self):
         self.logger.debug("Cancelling draw own cell...")
         self.btn_include.setEnabled(True)
         self.btn_exclude.setEnabled(True)
         self.btn_undo.setVisible(True)
+        self.btn_redo.setVisible(True)
         self.btn_cancel.setVisible(False)
         self.current_cell_layer.mode = "pan_zoom"
         self.btn_segment.setText("Draw own cell")
@@ -761,6 +1142,7 @@ class CellAnalyzer(QWidget):
             self.btn_include.setEnabled(False)
             self.btn_exclude.setEnabled(False)
             self.btn_undo.setEnabled(False)
+            self.btn_redo.setEnabled(False)
             self.btn_show_included.setText("Back")
             self.set_visitibility_label_layers(False)
             if self.excluded_layer is not None:
@@ -782,16 +1164,12 @@ class CellAnalyzer(QWidget):
             self.set_visitibility_label_layers(True)
             self.btn_show_included.setText("Show Included")
             self.viewer.layers.selection.active = self.current_cell_layer
-            centroid = ndimage.center_of_mass(
-                self.current_cell_layer.data,
-                labels=self.current_cell_layer.data,
-                index=self.current_cell_layer.selected_label,
-            )
-            self.viewer.camera.center = centroid
+            self.viewer.camera.center = self.get_current_cell_centroid()
             self.viewer.camera.zoom = 7.5
             self.btn_include.setEnabled(True)
             self.btn_exclude.setEnabled(True)
             self.btn_undo.setEnabled(True)
+            self.btn_redo.setEnabled(True)
 
     def show_excluded_on_click(self):
         if self.btn_show_excluded.text() == "Show Excluded":
@@ -799,6 +1177,7 @@ class CellAnalyzer(QWidget):
             self.btn_include.setEnabled(False)
             self.btn_exclude.setEnabled(False)
             self.btn_undo.setEnabled(False)
+            self.btn_redo.setEnabled(False)
             self.btn_show_excluded.setText("Back")
             self.set_visitibility_label_layers(False)
             if self.included_layer is not None:
@@ -820,16 +1199,12 @@ class CellAnalyzer(QWidget):
             self.set_visitibility_label_layers(True)
             self.btn_show_excluded.setText("Show Excluded")
             self.viewer.layers.selection.active = self.current_cell_layer
-            centroid = ndimage.center_of_mass(
-                self.current_cell_layer.data,
-                labels=self.current_cell_layer.data,
-                index=self.current_cell_layer.selected_label,
-            )
-            self.viewer.camera.center = centroid
+            self.viewer.camera.center = self.get_current_cell_centroid()
             self.viewer.camera.zoom = 7.5
             self.btn_include.setEnabled(True)
             self.btn_exclude.setEnabled(True)
             self.btn_undo.setEnabled(True)
+            self.btn_redo.setEnabled(True)
 
     def show_remaining_on_click(self):
         if self.btn_show_remaining.text() == "Show Remaining":
@@ -837,6 +1212,7 @@ class CellAnalyzer(QWidget):
             self.btn_include.setEnabled(False)
             self.btn_exclude.setEnabled(False)
             self.btn_undo.setEnabled(False)
+            self.btn_redo.setEnabled(False)
             self.btn_show_remaining.setText("Back")
             self.set_visitibility_label_layers(False)
             if self.included_layer is not None:
@@ -847,9 +1223,9 @@ class CellAnalyzer(QWidget):
                 self.viewer.layers.remove(self.excluded_layer)
                 self.excluded_layer = None
                 self.btn_show_excluded.setText("Show Excluded")
-            data = copy.deepcopy(self.layer_to_evaluate.data)
-            mask = np.isin(data, list(self.remaining | {0}), invert=True)
-            data[mask] = 0
+            data = remaining_labels(
+                self.layer_to_evaluate.data, list(self.remaining)
+            )
             self.remaining_layer = self.viewer.add_labels(
                 data, name="Remaining Cells"
             )
@@ -861,16 +1237,12 @@ class CellAnalyzer(QWidget):
             self.set_visitibility_label_layers(True)
             self.btn_show_remaining.setText("Show Remaining")
             self.viewer.layers.selection.active = self.current_cell_layer
-            centroid = ndimage.center_of_mass(
-                self.current_cell_layer.data,
-                labels=self.current_cell_layer.data,
-                index=self.current_cell_layer.selected_label,
-            )
-            self.viewer.camera.center = centroid
+            self.viewer.camera.center = self.get_current_cell_centroid()
             self.viewer.camera.zoom = 7.5
             self.btn_include.setEnabled(True)
             self.btn_exclude.setEnabled(True)
             self.btn_undo.setEnabled(True)
+            self.btn_redo.setEnabled(True)
 
     def include_multiple_on_click(self):
         self.logger.debug(
@@ -885,7 +1257,9 @@ class CellAnalyzer(QWidget):
             given_ids
         )
         self.lineedit_include.setText("")
-        next_id = str(min(self.remaining)) if len(self.remaining) > 0 else ""
+        next_id = (
+            str(self.remaining.lowest()) if len(self.remaining) > 0 else ""
+        )
         self.lineedit_next_id.setText(next_id)
         self.display_next_cell(True)
         msg = QMessageBox()
@@ -937,33 +1311,10 @@ class CellAnalyzer(QWidget):
 
     def include_multiple(
         self, ids: List[int]
-    ) -> Tuple[Set[int], Set[int], Set[int]]:
-        self.logger.debug("Including multiple cells...")
-        included = set()
-        ignored = set()
-        overlapped = set()
-        faulty = set()
-        existing_ids = set(pd.unique(self.layer_to_evaluate.data.flatten()))
-        for val in ids:
-            if val == 0:
-                continue
-            if val not in existing_ids:
-                faulty.add(val)
-                continue
-            if val not in self.remaining:
-                ignored.add(val)
-                continue
-            indices = np.where(self.layer_to_evaluate.data == val)
-            if np.sum(self.accepted_cells[indices]):
-                overlapped.add(val)
-                continue
-            data_array = np.zeros_like(self.layer_to_evaluate.data)
-            data_array[indices] = val
-            self.include(val, data_array)
-            included.add(val)
-            self.undo_stack.append(val)
-        self.logger.debug("Multiple cells evaluated")
-        return included, ignored, overlapped, faulty
+    ) -> Tuple[Set[int], Set[int], Set[int], Set[int]]:
+        result = self.session.include_multiple(ids)
+        self.update_labels()
+        return result
 
     def draw_own_cell(self):
         if self.btn_segment.text() == "Draw own cell":
@@ -972,12 +1323,30 @@ class CellAnalyzer(QWidget):
             self.btn_exclude.setEnabled(False)
             self.btn_include.setEnabled(False)
             self.btn_undo.setVisible(False)
+            self.btn_redo.setVisible(False)
             self.btn_cancel.setVisible(True)
             # Set next id label to current cell layer id
-            current_id = str(np.max(self.current_cell_layer.data))
+            current_id = str(
+                np.max(self.current_cell_layer.data[self.current_cell_region])
+            )
             self.lineedit_next_id.setText(current_id)
             # Display empty current cell layer
-            self.current_cell_layer.data[:] = 0
+            if self.current_cell_cropped:
+                center = self.get_current_cell_centroid()
+                self.set_current_cell_tile(
+                    tuple(
+                        slice(
+                            max(int(c) - DRAW_TILE_SIZE // 2, 0),
+                            int(c) + DRAW_TILE_SIZE // 2,
+                        )
+                        for c in center
+                    )
+                )
+            else:
+                self.clear_current_cell()
+                self.current_cell_region = full_region(
+                    self.current_cell_layer.data.shape
+                )
             self.current_cell_layer.refresh()
             # Select current cell layer, set mode to paint
             self.viewer.layers.select_all()
@@ -986,16 +1355,17 @@ class CellAnalyzer(QWidget):
             # Select unique id
             self.current_cell_layer.selected_label = (
                 max(
-                    np.max(self.accepted_cells),
-                    np.max(self.rejected_cells),
-                    np.max(self.layer_to_evaluate.data),
+                    self.label_index.max_id,
+                    max(self.included, default=0),
+                    max(self.excluded, default=0),
                 )
                 + 1
             )
         else:
             self.logger.debug("Draw own cell confirmed")
             self.current_cell_layer.mode = "pan_zoom"
-            if len(pd.unique(self.current_cell_layer.data.flatten())) < 2:
+            cell = self.current_cell_layer.data[self.current_cell_region]
+            if len(pd.unique(cell.ravel())) < 2:
                 self.logger.debug("No label drawn")
                 msg = QMessageBox()
                 msg.setWindowTitle("napari")
@@ -1007,6 +1377,7 @@ class CellAnalyzer(QWidget):
                 self.btn_exclude.setEnabled(True)
                 self.btn_include.setEnabled(True)
                 self.btn_undo.setVisible(True)
+                self.btn_redo.setVisible(True)
                 self.btn_cancel.setVisible(False)
 
     def display_next_cell(self, ignore_jump_back: bool = False):
@@ -1024,169 +1395,111 @@ class CellAnalyzer(QWidget):
         except ValueError:
             given_id = None
         self.logger.debug(f"Id given by textfield: {given_id}")
-        last_evaluated_id = (
-            self.undo_stack[-1] if len(self.undo_stack) > 0 else 0
-        )
-        self.logger.debug(f"Last evaluated id: {last_evaluated_id}")
-        next_lower = max(
-            [i for i in self.remaining if i < given_id], default=None
-        )
-        self.logger.debug(f"Next lower id: {next_lower}")
-        next_higher = min(
-            [i for i in self.remaining if i > given_id], default=None
-        )
-        self.logger.debug(f"Next higher id: {next_higher}")
-        computed_id = self.next_id
-        self.logger.debug(f"Computed next id: {computed_id}")
-
-        if given_id is None:
-            # no valid id given
-            next_id = computed_id
-        elif given_id == computed_id:
-            # id was not changed
-            if computed_id < last_evaluated_id and not ignore_jump_back:
-                # jump back to lowest unprocessed id
-                msg = QMessageBox()
-                msg.setWindowTitle("napari")
-                self.logger.debug("No higher id remaining")
-                msg.setText("Dataset is finished. Jumping to earlier cells.")
-            next_id = computed_id
-        elif given_id != computed_id and given_id in self.remaining:
-            # id was changed and is in remaining
-            next_id = given_id
-        elif given_id > computed_id:
-            # id was increased and is not in remaining
-            next_id = next_lower
-        else:
-            # given_id < computed_id -> id was decreased and is not in remaining
-            if given_id > last_evaluated_id:
-                # maybe others < last < given < computed
-                next_id = next_lower if next_lower is not None else computed_id
-            elif computed_id < last_evaluated_id and not ignore_jump_back:
-                # given < computed (smallest existing) < maybe others < last
-                next_id = computed_id
-            else:
-                # others? < given < others? < computed < last (self drawn)
-                # others? < given < others? < last < computed
-                next_id = next_lower if next_lower is not None else next_higher
-
-        if "msg" in locals():
+        self.logger.debug(f"Computed next id: {self.next_id}")
+        next_id, jumped_back = self.session.choose_next_id(
+            given_id, ignore_jump_back
+        )
+        if jumped_back:
+            msg = QMessageBox()
+            msg.setWindowTitle("napari")
+            msg.setText("Dataset is finished. Jumping to earlier cells.")
             msg.exec_()
         self.display_cell(next_id)
-
-        if len(self.remaining) > 1:
-            candidate_ids = sorted([i for i in self.remaining if i > next_id])
-            if len(candidate_ids) > 0:
-                self.next_id = candidate_ids[0]
-            else:
-                self.next_id = min(self.remaining)
-            self.lineedit_next_id.setText(str(self.next_id))
-        else:
-            self.lineedit_next_id.setText("")
-            self.next_id = None
-        self.logger.debug("Value for next cell set")
+        self.set_next_id(next_id)
 
     def redisplay_current_cell(self):
         self.logger.debug("Redisplaying current cell...")
         id_ = self.current_cell_layer.selected_label
         self.display_cell(id_)
+        self.set_next_id(id_)
 
-        if len(self.remaining) > 1:
-            candidate_ids = sorted([i for i in self.remaining if i > id_])
-            if len(candidate_ids) > 0:
-                self.next_id = candidate_ids[0]
-            else:
-                self.next_id = min(self.remaining)
-            self.lineedit_next_id.setText(str(self.next_id))
-        else:
-            self.lineedit_next_id.setText("")
-            self.next_id = None
+    def set_next_id(self, current_id: int):
+        """Shows the id following the displayed cell as next id."""
+        next_id = self.session.advance(current_id)
+        self.lineedit_next_id.setText(
+            str(next_id) if next_id is not None else ""
+        )
         self.logger.debug("Value for next cell set")
 
-    def include(
-        self,
-        id_: int,
-        data_array: np.ndarray,
-        remove_from_remaining: bool = True,
-    ):
-        self.logger.debug("Including cell...")
-        self.accepted_cells += data_array
-        if remove_from_remaining:
-            self.remaining.remove(id_)
-        self.included.add(id_)
-
-        self.add_cell_to_accepted(id_, data_array)
-
     def check_for_overlap(self, self_drawn=False):
         self.logger.debug("Checking for overlap...")
         overlap = self.get_overlap()
 
-        if not overlap:
+        if len(overlap) == 0:
             return False
 
         self.handle_overlap(overlap, self_drawn)
         return True
 
-    def get_overlap(self):
+    def get_overlap(self) -> np.ndarray:
         """
-        Returns the indices of the overlapping pixels between the current cell and the accepted cells.
+        Returns the indices of the pixels where the current cell overlaps other cells.
+
+        Only the bounding box of the labels in the current cell layer is
+        compared to the label layer.
 
         Returns:
         --------
-        overlap: set
-            A set of tuples containing the indices of the overlapping pixels.
+        overlap: np.ndarray
+            Flat indices of the overlapping pixels in the label layer.
         """
         self.logger.debug("Calculating overlap...")
-        nonzero_current = np.nonzero(self.current_cell_layer.data)
-        eval_cells = np.copy(self.layer_to_evaluate.data)
-        id_ = self.current_cell_layer.selected_label
-        eval_cells[eval_cells == id_] = 0
-        nonzero_eval = np.nonzero(eval_cells)
-        combined_layer = np.zeros_like(self.layer_to_evaluate.data)
-        combined_layer[nonzero_current] += 1
-        combined_layer[nonzero_eval] += 1
-        overlap = set(map(tuple, np.transpose(np.where(combined_layer == 2))))
-        return overlap
-
-    def add_cell_to_accepted(self, cell_id: int, data: np.ndarray):
-        self.logger.debug("Adding cell to list of accepted...")
-        self.included.add(cell_id)
-        centroid = ndimage.center_of_mass(data)
-        centroid = tuple(int(value) for value in centroid)
-        self.metric_data.append(  # TODO
-            (
-                cell_id,
-                np.count_nonzero(data),
-                centroid,
-            )
+        cropped = crop_region(
+            self.current_cell_region,
+            self.current_cell_layer.data[self.current_cell_region],
         )
+        if cropped is None:
+            return np.zeros(0, dtype=np.intp)
+        region, current_cells = cropped
+        region = self.to_image_region(region)
+        overlap = find_overlap(
+            current_cells,
+            np.asarray(self.layer_to_evaluate.data[region]),
+            self.current_cell_layer.selected_label,
+        )
+        indices = np.nonzero(overlap)
+        indices = tuple(
+            axis_indices + s.start for axis_indices, s in zip(indices, region)
+        )
+        return np.ravel_multi_index(indices, self.layer_to_evaluate.data.shape)
 
-        self.calculate_metrics()
-        self.update_labels()
-
-    def handle_overlap(self, overlap: set, user_drawn: bool = False):
+    def handle_overlap(self, overlap: np.ndarray, user_drawn: bool = False):
         """
         Handles the overlap between the current cell and the accepted cells.
 
         Parameters:
         -----------
-        overlap: set
-            A set of tuples containing the indices of the overlapping pixels.
+        overlap: np.ndarray
+            Flat indices of the overlapping pixels in the label layer.
         user_drawn: bool
             A boolean indicating whether the current cell was drawn by the user.
         """
         self.logger.debug("Handling overlap...")
-        overlap_indices = tuple(np.array(list(overlap)).T)
+        overlap_indices = np.unravel_index(
+            overlap, self.layer_to_evaluate.data.shape
+        )
+        lower = [int(np.min(indices)) for indices in overlap_indices]
+        upper = [int(np.max(indices)) + 1 for indices in overlap_indices]
         self.layer_to_evaluate.opacity = 0.2
         self.current_cell_layer.opacity = 0.3
         self.logger.debug("Displaying overlap...")
         overlap_layer = self.viewer.add_labels(
-            np.zeros_like(self.layer_to_evaluate.data),
+            np.zeros(
+                [up - lo for lo, up in zip(lower, upper)],
+                dtype=self.layer_to_evaluate.data.dtype,
+            ),
             name="Overlap",
             opacity=1,
+            translate=lower,
         )
-        overlap_layer.data[overlap_indices] = (
-            np.amax(self.current_cell_layer.data) + 1
+        overlap_layer.data[
+            tuple(
+                axis_indices - lo
+                for axis_indices, lo in zip(overlap_indices, lower)
+            )
+        ] = (
+            np.amax(self.current_cell_layer.data[self.current_cell_region])
+            + 1
         )
         overlap_layer.refresh()
         msg = QMessageBox()
@@ -1208,16 +1521,6 @@ class CellAnalyzer(QWidget):
             self.btn_segment.setText("Draw own cell")
             self.current_cell_layer.mode = "pan_zoom"
 
-    def calculate_metrics(self):
-        self.logger.debug("Calculating metrics...")
-        sizes = [t[1] for t in self.metric_data]
-        if len(sizes):
-            self.mean_size = np.round(np.mean(sizes), 3)
-            self.std_size = np.round(np.std(sizes), 3)
-        else:
-            self.mean_size = 0
-            self.std_size = 0
-
     def set_visitibility_label_layers(self, visible: bool):
         self.logger.debug(
             f"Setting visibility of label layers to {visible}..."
@@ -1244,6 +1547,10 @@ class CellAnalyzer(QWidget):
         self.logger.debug(
             f"ROI parameters: {lower_y}, {upper_y}, {lower_x}, {upper_x}, {threshold}"
         )
+        try:
+            features, image = self.get_roi_features()
+        except ValueError:
+            return
         csv_filepath = Path(save_dialog(self, "(*.csv);; (*.tiff *.tif)"))
         if csv_filepath.name == ".csv":
             self.logger.debug("No file selected. Aborting.")
@@ -1258,10 +1565,136 @@ class CellAnalyzer(QWidget):
             (lower_x, upper_x),
             threshold,
             (csv_filepath, tiff_filepath),
+            features,
+            image,
         )
         worker.returned.connect(self.call_export)
         worker.start()
 
+    def export_roi_batch_on_click(self):
+        self.logger.debug("Exporting data of multiple ROIs...")
+        threshold = self.get_roi_param(self.lineedit_threshold_size)
+        if threshold is None or threshold < 0:
+            self.lineedit_threshold_size.setText("")
+            msg = QMessageBox()
+            msg.setWindowTitle("napari")
+            msg.setText("Threshold must be a positive integer.")
+            msg.exec_()
+            return
+        try:
+            features, image = self.get_roi_features()
+            rois = self.get_rois()
+        except ValueError:
+            return
+        if rois is None:
+            self.logger.debug("No ROI file selected. Aborting.")
+            return
+        self.logger.debug(f"Amount of ROIs: {len(rois)}")
+        summary_filepath = Path(save_dialog(self))
+        if summary_filepath.name == ".csv":
+            self.logger.debug("No file selected. Aborting.")
+            return
+        worker = analyse_roi_batch(
+            self.layer_to_evaluate.data,
+            rois,
+            threshold,
+            summary_filepath,
+            features,
+            image,
+        )
+        worker.returned.connect(self.call_export_batch)
+        worker.errored.connect(self.show_roi_batch_error)
+        self.btn_export_roi_batch.setEnabled(False)
+        worker.finished.connect(
+            lambda: self.btn_export_roi_batch.setEnabled(True)
+        )
+        worker.start()
+
+    def get_roi_features(self):
+        """
+        Returns the selected ROI features and the intensity image
+
+        Returns
+        -------
+        tuple
+            Keys of the checked features and the intensity image, the image
+            is None if the mean intensity is not requested
+
+        Raises
+        ------
+        ValueError
+            If the mean intensity is requested without a matching image
+        """
+        features = [
+            feature
+            for feature, checkbox in self.roi_feature_checkboxes.items()
+            if checkbox.isChecked()
+        ]
+        image = None
+        if "mean_intensity" in features:
+            name = self.combobox_intensity_image.currentText()
+            if name not in self.viewer.layers:
+                self.logger.debug("No intensity image selected")
+                msg = QMessageBox()
+                msg.setWindowTitle("napari")
+                msg.setText("Please select an image for the mean intensity.")
+                msg.exec_()
+                raise ValueError("No intensity image selected.")
+            image = self.viewer.layers[name].data
+            if image.shape != self.layer_to_evaluate.data.shape:
+                self.logger.debug("Intensity image shape does not match")
+                msg = QMessageBox()
+                msg.setWindowTitle("napari")
+                msg.setText(
+                    "The intensity image must have the shape of the labels."
+                )
+                msg.exec_()
+                raise ValueError("Intensity image shape does not match.")
+        self.logger.debug(f"ROI features: {features}")
+        return features, image
+
+    def get_rois(self):
+        """
+        Returns the ROIs of the selected shapes layer or CSV file
+
+        Returns
+        -------
+        list of Roi or None
+            ROIs to analyse, None if no CSV file was selected
+
+        Raises
+        ------
+        ValueError
+            If there are no ROIs or they can not be used
+        """
+        name = self.combobox_roi_shapes.currentText()
+        try:
+            if name == ROI_CSV_ENTRY:
+                filepath = Path(open_dialog(self))
+                if str(filepath) == ".":
+                    return None
+                rois = read_roi_csv(filepath)
+            else:
+                layer = self.viewer.layers[name]
+                rois = rois_from_shapes(layer.data, layer.shape_type)
+            if len(rois) == 0:
+                raise ValueError("There are no ROIs to analyse.")
+        except (ValueError, KeyError) as error:
+            self.logger.debug(f"Invalid ROIs: {error}")
+            msg = QMessageBox()
+            msg.setWindowTitle("napari")
+            msg.setText(f"The ROIs can not be analysed: {error}")
+            msg.exec_()
+            raise ValueError("Invalid ROIs.") from error
+        return rois
+
+    def show_roi_batch_error(self, error: Exception):
+        self.logger.error(f"ROI export failed: {error}")
+        msg = QMessageBox()
+        msg.setWindowTitle("napari")
+        msg.setText(f"ROI export failed: {error}")
+        msg.exec_()
+
     def validate_roi_params(self):
         self.logger.debug("Validating ROI parameters...")
 
@@ -1323,14 +1756,9 @@ class CellAnalyzer(QWidget):
 
     def call_export(self, params):
         self.logger.debug("Exporting ROI data...")
-        image, df, paths, threshold = params
-        csv_filepath, tiff_filepath = paths
-        data = df.itertuples(index=False)
-        metrics = (
-            np.round(df["count [px]"].mean(), 3),
-            np.round(df["count [px]"].std(), 3),
-            threshold,
-        )
+        df, paths, threshold = params
+        csv_filepath, _ = paths
+        metrics = roi_metrics(df, threshold)
         # if self.lineedit_conversion_rate.text() == "":
         #     factor = 1
         #     unit = "pixel"
@@ -1341,15 +1769,28 @@ class CellAnalyzer(QWidget):
         #     unit = self.combobox_conversion_unit.currentText()
         # pixelsize = (factor, unit)
         # undo_stack = df["id"].tolist()
-        write(csv_filepath, data, metrics)
+        write(csv_filepath, df, metrics, list(df.columns[3:]))
         # write(csv_filepath, data, metrics, pixelsize, set(), undo_stack)
-        write(tiff_filepath, image)
         self.logger.debug("ROI data exported.")
         msg = QMessageBox()
         msg.setWindowTitle("napari")
         msg.setText("ROI data exported.")
         msg.exec_()
 
+    def call_export_batch(self, params):
+        summary, throughput, summary_filepath = params
+        self.logger.debug(f"ROI throughput: {throughput}")
+        msg = QMessageBox()
+        msg.setWindowTitle("napari")
+        msg.setText(
+            f"Data of {throughput['rois']} ROIs with "
+            f"{summary['cells'].sum()} cells exported to "
+            f"{summary_filepath.parent}.\n"
+            f"{throughput['seconds']} s, {throughput['rois/s']} ROIs/s, "
+            f"{throughput['Mpx/s']} Mpx/s"
+        )
+        msg.exec_()
+
 
 class ChoiceDialog(QDialog):
     def __init__(self, layernames: List[str], selected: str):
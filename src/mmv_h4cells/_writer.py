@@ -1,11 +1,42 @@
 import numpy as np
 import csv
+import functools
+import gzip
+import json
 import locale
-from typing import List, Tuple
-from aicsimageio.writers import OmeTiffWriter
+import pandas as pd
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 from pathlib import Path
 from qtpy.QtWidgets import QFileDialog
+import tifffile
 import zarr
+from numcodecs import Blosc
+
+from mmv_h4cells._autosave import SessionUpdate
+from mmv_h4cells._metric_table import METRIC_COLUMNS, MetricTable
+from mmv_h4cells._undo import UndoStack
+from mmv_h4cells._zarr_store import CopyOnWriteStore
+
+# amount of rows of the analysis csv formatted at once
+CSV_BLOCK_ROWS = 2**16
+
+# key of the metrics in the metadata of parquet result tables
+PARQUET_METRICS_KEY = b"mmv_h4cells.metrics"
+
+# edge length of the tiles of tiled TIFF files
+TIFF_TILE_SIZE = 256
+
+# size from which TIFF files are written as BigTIFF
+BIGTIFF_BYTES = 2**32 - 2**25
+
+# edge length of the chunks of the label images of zarr sessions
+ZARR_CHUNK_SIZE = 512
+
+# names of the label images of zarr sessions
+ZARR_LABEL_IMAGES = ("data_to_valuate", "accepted_cells", "rejected_cells")
+
+# compressor of the label images of zarr sessions
+ZARR_COMPRESSOR = Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
 
 
 def save_dialog(parent, filetype="*.csv", directory=""):
@@ -45,9 +76,12 @@ def write(path: Path, *data):
 
 
 def get_writer(path: Path):
-    if path.suffix == ".csv":
+    if path.suffix == ".csv" or path.suffixes[-2:] == [".csv", ".gz"]:
         return write_csv
 
+    if path.suffix == ".parquet":
+        return write_parquet
+
     if path.suffix == ".tiff":
         return write_tiff
 
@@ -59,23 +93,61 @@ def get_writer(path: Path):
 
 def write_csv(
     path: Path,
-    data: List[Tuple[int, int, Tuple[int, int]]],
+    data: Union[MetricTable, pd.DataFrame, Iterable[tuple]],
     metrics: Tuple[float, float, float],
+    features: List[str] = None,
+    compression: Optional[str] = None,
 ):  # adjust if Metrics are added
-    default_locale = locale.getdefaultlocale()[0]
-    if default_locale.startswith("de"):
-        data = [convert_np64_to_string(sublist) for sublist in data]
-        delimiter = ";"
+    """
+    Writes the analysis csv
+
+    The rows are formatted column by column in blocks of CSV_BLOCK_ROWS
+    rows, the output is the same as writing each row with csv.writer.
+    On German locales the columns are separated by semicolons and floats
+    use a decimal comma.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the csv file
+    data : MetricTable, pd.DataFrame or iterable of tuple
+        Rows of id, size, centroid and the features
+    metrics : tuple
+        Mean size, standard deviation of the sizes and size threshold
+    features : list of str, optional
+        Names of the feature columns following the centroid
+    compression : str, optional
+        "gzip" to compress the file, by default gzip if the path ends with
+        ".gz"
+    """
+    delimiter, decimal = csv_format()
+    if compression is None and Path(path).suffix == ".gz":
+        compression = "gzip"
+    if compression == "gzip":
+        file = gzip.open(path, "wt", newline="")
+    elif compression is None:
+        file = open(path, "w", newline="")
     else:
-        delimiter = ","
-    with open(path, "w", newline="") as file:
+        raise ValueError(f"Unsupported compression: {compression}")
+    columns = csv_columns(data)
+    length = len(columns[0]) if columns else 0
+    with file:
         csv_writer = csv.writer(file, delimiter=delimiter)
 
         csv_writer.writerow(
-            ["ID", "Size [px]", "Centroid", ""]
+            ["ID", "Size [px]", "Centroid", *(features or []), ""]
         )  # , "metric name"
-        for row in data:
-            csv_writer.writerow(row)
+        for start in range(0, length, CSV_BLOCK_ROWS):
+            block = [
+                format_csv_column(
+                    column[start : start + CSV_BLOCK_ROWS], delimiter, decimal
+                )
+                for column in columns
+            ]
+            lines = block[0]
+            for column in block[1:]:
+                lines = np.char.add(np.char.add(lines, delimiter), column)
+            file.write("\r\n".join(lines.tolist()) + "\r\n")
 
         csv_writer.writerow([])
         csv_writer.writerow(
@@ -83,19 +155,324 @@ def write_csv(
         )  # , "metric name"
         csv_writer.writerow(metrics)
 
-def convert_np64_to_string(sublist):
-    converted_sublist = []
-    for item in sublist:
-        if isinstance(item, np.float64):
-            converted_sublist.append(str(item).replace(".", ","))
-        else:
-            converted_sublist.append(item)
-    return converted_sublist
+
+def write_table_csv(path: Path, table: pd.DataFrame):
+    """
+    Writes a table in the csv format of the analysis csv
+
+    Delimiter, decimal separator and line endings match `write_csv`, so
+    tables written next to analysis csv files can be read the same way.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the csv file
+    table : pd.DataFrame
+        Table to write, the index is left out
+    """
+    delimiter, decimal = csv_format()
+    table.to_csv(
+        path,
+        index=False,
+        sep=delimiter,
+        decimal=decimal,
+        lineterminator="\r\n",
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def csv_format() -> Tuple[str, str]:
+    """
+    Returns delimiter and decimal separator of csv files
+
+    The locale is only looked up on the first call.
+
+    Returns
+    -------
+    tuple of str
+        Semicolon and comma on German locales, comma and dot otherwise
+    """
+    default_locale = locale.getdefaultlocale()[0] or ""
+    if default_locale.startswith("de"):
+        return ";", ","
+    return ",", "."
+
+
+def csv_columns(
+    data: Union[MetricTable, pd.DataFrame, Iterable[tuple]],
+) -> List[np.ndarray]:
+    """
+    Splits the rows of the analysis csv into columns
+
+    Parameters
+    ----------
+    data : MetricTable, pd.DataFrame or iterable of tuple
+        Rows of id, size, centroid and the features
+
+    Returns
+    -------
+    list of np.ndarray
+        One array per column, the centroids as array of shape (n, 2)
+    """
+    if isinstance(data, MetricTable):
+        return [
+            data.column("id"),
+            data.column("size"),
+            data.to_array(("y", "x")),
+        ]
+    if isinstance(data, pd.DataFrame):
+        values = [data[column].to_numpy() for column in data.columns]
+    else:
+        rows = list(data)
+        if not rows:
+            return []
+        values = [np.asarray(column, dtype=object) for column in zip(*rows)]
+    return [_column_array(column) for column in values]
+
+
+def _column_array(values: np.ndarray) -> np.ndarray:
+    """Converts a column of python objects to the array of their type"""
+    if values.dtype != object or len(values) == 0:
+        return values
+    kinds = {type(value) for value in values}
+    if len(kinds) != 1:
+        return values
+    kind = kinds.pop()
+    if kind is tuple:
+        array = np.array(values.tolist())
+        if array.ndim == 2 and array.dtype.kind in "iuf":
+            return array
+        return values
+    if kind in (int, float, bool) or issubclass(kind, np.number):
+        return np.array(values.tolist())
+    return values
+
+
+def format_csv_column(
+    values: np.ndarray, delimiter: str, decimal: str = "."
+) -> np.ndarray:
+    """
+    Formats a column of the analysis csv like csv.writer
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values of the column, tuples as array of shape (n, size)
+    delimiter : str
+        Delimiter of the csv file, fields containing it are quoted
+    decimal : str, optional
+        Decimal separator of floats, by default "."
+
+    Returns
+    -------
+    np.ndarray
+        Fields of the column
+    """
+    if values.ndim == 2:
+        fields = np.char.add("(", values[:, 0].astype(str))
+        for i in range(1, values.shape[1]):
+            fields = np.char.add(
+                np.char.add(fields, ", "), values[:, i].astype(str)
+            )
+        if values.shape[1] == 1:
+            fields = np.char.add(fields, ",")
+        fields = np.char.add(fields, ")")
+    elif values.dtype.kind == "f":
+        fields = values.astype(str)
+        if decimal != ".":
+            fields = np.char.replace(fields, ".", decimal)
+    elif values.dtype.kind in "iub":
+        fields = values.astype(str)
+    else:
+        fields = np.array(
+            ["" if value is None else str(value) for value in values],
+            dtype=str,
+        )
+    quoted = np.zeros(len(fields), dtype=bool)
+    for char in (delimiter, '"', "\r", "\n"):
+        quoted |= np.char.find(fields, char) >= 0
+    if quoted.any():
+        escaped = np.char.replace(fields[quoted], '"', '""')
+        fields = fields.astype(object)
+        fields[quoted] = np.char.add(np.char.add('"', escaped), '"')
+        fields = fields.astype(str)
+    return fields
+
+
+def write_parquet(
+    path: Path,
+    data: Union[MetricTable, pd.DataFrame, Iterable[tuple]],
+    metrics: Tuple[float, float, float],
+    features: List[str] = None,
+):
+    """
+    Writes the rows of the analysis csv as parquet result table
+
+    The table has the columns id, size, y, x and the features, the metrics
+    are stored in its metadata. Result tables of many images can be read
+    at once with `read_results`. Requires pyarrow.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the parquet file
+    data : MetricTable, pd.DataFrame or iterable of tuple
+        Rows of id, size, centroid and the features
+    metrics : tuple
+        Mean size, standard deviation of the sizes and size threshold
+    features : list of str, optional
+        Names of the feature columns following the centroid
+    """
+    import pyarrow
+    from pyarrow import parquet
+
+    columns = csv_columns(data)
+    features = list(features or [])
+    if not columns:
+        columns = [np.zeros(0, np.int64)] * 2 + [np.zeros((0, 2), np.int64)]
+        columns += [np.zeros(0)] * len(features)
+    y, x = np.asarray(columns[2]).reshape(-1, 2).T
+    arrays = [columns[0], columns[1], y, x, *columns[3:]]
+    table = pyarrow.table(
+        {
+            name: pyarrow.array(np.asarray(values))
+            for name, values in zip([*METRIC_COLUMNS, *features], arrays)
+        }
+    )
+    metrics = [np.asarray(value).item() for value in metrics]
+    table = table.replace_schema_metadata(
+        {PARQUET_METRICS_KEY: json.dumps(metrics)}
+    )
+    parquet.write_table(table, path)
 
 
 def write_tiff(path: Path, data: np.ndarray):
-    data = data.astype(np.uint16)
-    OmeTiffWriter.save(data, path, dim_order_out="YX")
+    """
+    Writes a label image to a tiled, compressed OME-TIFF file
+
+    The labels are stored in the smallest unsigned integer type holding the
+    largest label, see label_dtype, and written tile by tile, so label
+    images opened from a zarr session are never read into memory at once.
+    Large images are written as BigTIFF.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the TIFF file
+    data : np.ndarray
+        2D label image, any array supporting slicing
+    """
+    dtype = label_dtype(label_max(data))
+    tiles = iter_tiles(data, TIFF_TILE_SIZE)
+    write_tiff_tiles(path, data.shape, dtype, tiles, ome=True)
+
+
+def label_dtype(max_label: int) -> np.dtype:
+    """
+    Returns the smallest unsigned integer type holding a label
+
+    Parameters
+    ----------
+    max_label : int
+        Largest label of the image
+
+    Returns
+    -------
+    np.dtype
+        uint8, uint16, uint32 or uint64
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def label_max(data: np.ndarray) -> int:
+    """
+    Returns the largest label of an image, reading it in strips
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D label image, any array supporting slicing
+
+    Returns
+    -------
+    int
+        Largest label, 0 for an empty image
+    """
+    if isinstance(data, np.ndarray):
+        return int(data.max(initial=0))
+    return max(
+        (
+            int(np.max(data[y : y + TIFF_TILE_SIZE], initial=0))
+            for y in range(0, data.shape[0], TIFF_TILE_SIZE)
+        ),
+        default=0,
+    )
+
+
+def iter_tiles(data: np.ndarray, tile_size: int) -> Iterator[np.ndarray]:
+    """
+    Yields the tiles of a 2D image in row-major order
+
+    Each strip of tile_size rows is read once, so only one strip is held
+    in memory at a time.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D image, any array supporting slicing
+    tile_size : int
+        Edge length of the tiles, tiles at the border are smaller
+
+    Yields
+    ------
+    np.ndarray
+        Tiles of the image
+    """
+    for y in range(0, data.shape[0], tile_size):
+        strip = np.asarray(data[y : y + tile_size])
+        for x in range(0, data.shape[1], tile_size):
+            yield strip[:, x : x + tile_size]
+
+
+def write_tiff_tiles(
+    path: Path,
+    shape: Tuple[int, int],
+    dtype: np.dtype,
+    tiles: Iterable[np.ndarray],
+    ome: bool = False,
+):
+    """
+    Writes a 2D image to a tiled, compressed TIFF file tile by tile
+
+    Parameters
+    ----------
+    path : Path
+        Path of the TIFF file
+    shape : tuple of int
+        Shape of the image
+    dtype : np.dtype
+        Data type the tiles are stored as
+    tiles : iterable of np.ndarray
+        Tiles of edge length TIFF_TILE_SIZE in row-major order, tiles at the
+        border may be smaller
+    ome : bool, optional
+        Whether to write OME-TIFF metadata, by default False
+    """
+    dtype = np.dtype(dtype)
+    tifffile.imwrite(
+        str(path),
+        (np.asarray(tile).astype(dtype, copy=False) for tile in tiles),
+        shape=shape,
+        dtype=dtype,
+        tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE),
+        compression="zlib",
+        bigtiff=int(np.prod(shape)) * dtype.itemsize >= BIGTIFF_BYTES,
+        ome=ome,
+        metadata={"axes": "YX"},
+    )
 
 
 def write_zarr(
@@ -103,36 +480,59 @@ def write_zarr(
     data_to_evaluate: np.ndarray,
     accepted_cells: np.ndarray,
     rejected_cells: np.ndarray,
-    data: List[Tuple[int, int, Tuple[int, int]]],
+    data: Union[MetricTable, List[Tuple[int, int, Tuple[int, int]]]],
     metrics: Tuple[float, float],
-    undo_stack: List[int],
+    undo_stack: Union[UndoStack, List[int]],
     selfdrawn_lower_bound: int,
 ):
-    zarr_file = zarr.open(str(path), mode="w")
-    zarr_file.create_dataset(
-        "data_to_valuate",
-        shape=data_to_evaluate.shape,
-        dtype="i4",
-        data=data_to_evaluate,
-    )
-    zarr_file.create_dataset(
-        "accepted_cells",
-        shape=accepted_cells.shape,
-        dtype="i4",
-        data=accepted_cells,
-    )
-    zarr_file.create_dataset(
-        "rejected_cells",
-        shape=rejected_cells.shape,
-        dtype="i4",
-        data=rejected_cells,
+    """
+    Writes the state of an evaluation to a zarr session
+
+    The label images are stored in compressed chunks of edge length
+    ZARR_CHUNK_SIZE and copied block by block, so label images that were
+    opened lazily are never read into memory at once.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the zarr directory
+    data_to_evaluate : np.ndarray
+        Label image with the remaining and included cells
+    accepted_cells : np.ndarray
+        Label image of the accepted cells
+    rejected_cells : np.ndarray
+        Label image of the rejected cells
+    data : MetricTable or list of tuple
+        Metric data rows of the included cells
+    metrics : tuple of float
+        Mean and standard deviation of the cell sizes
+    undo_stack : UndoStack or list of int
+        Journal or evaluated cell ids in order of evaluation
+    selfdrawn_lower_bound : int
+        Lowest id of self drawn cells
+    """
+    label_images = dict(
+        zip(
+            ZARR_LABEL_IMAGES,
+            (data_to_evaluate, accepted_cells, rejected_cells),
+        )
     )
-    flattened_data = [(id_, amount, centroid[0], centroid[1]) for id_, amount, centroid in data]
+    for label_image in label_images.values():
+        # lazily opened label images still read from the session that is
+        # about to be replaced
+        store = getattr(label_image, "store", None)
+        if isinstance(store, CopyOnWriteStore) and store.is_based_on(path):
+            store.detach()
+    zarr_file = zarr.open(str(path), mode="w")
+    for name, label_image in label_images.items():
+        write_zarr_labels(zarr_file, name, label_image)
+    if not isinstance(data, MetricTable):
+        data = MetricTable(data)
     zarr_file.create_dataset(
         "data",
         shape=(len(data), 4),
         dtype="i4",
-        data=flattened_data,
+        data=data.to_array(),
     )
     zarr_file.create_dataset(
         "metrics",
@@ -144,6 +544,92 @@ def write_zarr(
         "undo_stack",
         shape=(len(undo_stack),),
         dtype="i4",
-        data=undo_stack,
+        data=list(undo_stack),
     )
+    if isinstance(undo_stack, UndoStack):
+        undo_stack.to_zarr(zarr_file.create_group("journal"))
     zarr_file.attrs["selfdrawn_lower_bound"] = selfdrawn_lower_bound
+
+
+def write_zarr_labels(zarr_file, name: str, data: np.ndarray):
+    """
+    Writes a label image as chunked, compressed int32 array
+
+    Parameters
+    ----------
+    zarr_file : zarr.hierarchy.Group
+        Group of the session
+    name : str
+        Name of the array
+    data : np.ndarray or zarr.Array
+        Label image
+    """
+    chunks = zarr_chunks(data.shape)
+    array = zarr_file.create_dataset(
+        name,
+        shape=data.shape,
+        chunks=chunks,
+        dtype="i4",
+        compressor=ZARR_COMPRESSOR,
+    )
+    if data.ndim == 0 or data.shape[0] == 0:
+        return
+    step = chunks[0]
+    for start in range(0, data.shape[0], step):
+        array[start : start + step] = np.asarray(data[start : start + step])
+
+
+def zarr_chunks(shape: Tuple[int, ...]) -> Tuple[int, ...]:
+    """
+    Returns the chunk shape of the label images of a zarr session
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the label images
+
+    Returns
+    -------
+    tuple of int
+        Edge lengths of the chunks
+    """
+    return tuple(min(ZARR_CHUNK_SIZE, max(size, 1)) for size in shape)
+
+
+def update_zarr(path: Path, update: SessionUpdate):
+    """
+    Writes the changes of an evaluation into a session written by write_zarr
+
+    Only the changed chunks of the label images are rewritten, new metric
+    rows and undo entries are appended to the stored ones.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the zarr directory
+    update : SessionUpdate
+        Changes since the session was written or last updated
+    """
+    zarr_file = zarr.open(str(path), mode="r+")
+    for name, chunks in update.label_chunks.items():
+        array = zarr_file[name]
+        for region, values in chunks:
+            array[region] = values
+    changes = update.changes
+    rows = MetricTable(update.metric_rows).to_array()
+    zarr_file["data"].resize((changes.metric_start, 4))
+    if len(rows):
+        zarr_file["data"].append(rows)
+    zarr_file["metrics"][:] = update.metrics
+    undo_ids = [entry.cell_id for entry in update.undo_entries]
+    zarr_file["undo_stack"].resize((changes.undo_start,))
+    if len(undo_ids):
+        zarr_file["undo_stack"].append(np.array(undo_ids, dtype="i4"))
+    if "journal" in zarr_file:
+        UndoStack.update_zarr(
+            zarr_file["journal"],
+            changes.undo_start,
+            update.undo_entries,
+            update.redo_entries,
+        )
+    zarr_file.attrs["selfdrawn_lower_bound"] = update.selfdrawn_lower_bound
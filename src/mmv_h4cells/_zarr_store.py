@@ -0,0 +1,199 @@
+import itertools
+import numpy as np
+import os
+import zarr
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Dict, Iterator, Set, Tuple
+from zarr.storage import BaseStore, init_array
+
+
+class CopyOnWriteStore(BaseStore):
+    """
+    Zarr store that reads a saved session lazily and keeps writes in memory
+
+    Chunks are read from the underlying store only when they are accessed.
+    Chunks written during the evaluation are kept in memory in their
+    compressed form, so the saved session only changes when it is exported
+    again.
+    """
+
+    def __init__(self, base: MutableMapping):
+        self.base = base  # store of the saved session, None once detached
+        self.changes: Dict[str, bytes] = {}  # values written since opening
+        self.deleted: Set[str] = set()  # keys deleted since opening
+
+    def __getitem__(self, key: str):
+        if key in self.changes:
+            return self.changes[key]
+        if self.base is None or key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key: str, value):
+        self.changes[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self.changes.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key) -> bool:
+        if key in self.changes:
+            return True
+        if self.base is None or key in self.deleted:
+            return False
+        return key in self.base
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.changes
+        if self.base is not None:
+            for key in self.base:
+                if key not in self.changes and key not in self.deleted:
+                    yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def is_based_on(self, path: Path) -> bool:
+        """
+        Returns whether the store reads from the session at a path
+
+        Parameters
+        ----------
+        path : Path
+            Path of a zarr directory
+
+        Returns
+        -------
+        bool
+            Whether unchanged chunks are read from that directory
+        """
+        base_path = getattr(self.base, "path", None)
+        if base_path is None:
+            return False
+        return os.path.abspath(base_path) == os.path.abspath(str(path))
+
+    def detach(self):
+        """
+        Copies all chunks not read yet into memory and drops the base store
+
+        Needed before the saved session is overwritten, the chunks are
+        copied without decompressing them.
+        """
+        if self.base is None:
+            return
+        for key in self.base:
+            if key not in self.changes and key not in self.deleted:
+                self.changes[key] = self.base[key]
+        self.base = None
+
+
+class LazyArrayStore(BaseStore):
+    """
+    Read-only zarr store computing the chunks of an array when they are read
+
+    Presents any array supporting slicing, like a dask array, as an
+    uncompressed zarr array. Chunks are only computed when they are
+    accessed and are not kept, so the array is never held in memory.
+    """
+
+    def __init__(self, array, chunks: Tuple[int, ...]):
+        self.array = array  # array the chunks are computed from
+        self.chunks = tuple(chunks)  # chunk shape of the zarr array
+        self.dtype = np.dtype(array.dtype)  # data type of the array
+        self.metadata: Dict[str, bytes] = {}  # metadata of the zarr array
+        init_array(
+            self.metadata,
+            shape=array.shape,
+            chunks=self.chunks,
+            dtype=self.dtype,
+            compressor=None,
+            fill_value=0,
+        )
+        self.grid = tuple(
+            -(-size // chunk) for size, chunk in zip(array.shape, chunks)
+        )  # amount of chunks along each axis
+
+    def _chunk(self, key: str):
+        try:
+            chunk = tuple(int(i) for i in key.split("."))
+        except ValueError:
+            return None
+        if len(chunk) != len(self.grid) or not all(
+            0 <= i < n for i, n in zip(chunk, self.grid)
+        ):
+            return None
+        return chunk
+
+    def __getitem__(self, key: str):
+        if key in self.metadata:
+            return self.metadata[key]
+        chunk = self._chunk(key)
+        if chunk is None:
+            raise KeyError(key)
+        region = tuple(
+            slice(i * size, (i + 1) * size)
+            for i, size in zip(chunk, self.chunks)
+        )
+        block = self.array[region]
+        if hasattr(block, "compute"):
+            # chunks are read in parallel by the caller, not by dask
+            block = block.compute(scheduler="synchronous")
+        block = np.asarray(block, dtype=self.dtype)
+        if block.shape != self.chunks:
+            padded = np.zeros(self.chunks, dtype=self.dtype)
+            padded[tuple(slice(0, size) for size in block.shape)] = block
+            block = padded
+        return np.ascontiguousarray(block).tobytes()
+
+    def __setitem__(self, key: str, value):
+        raise PermissionError("LazyArrayStore is read-only")
+
+    def __delitem__(self, key: str):
+        raise PermissionError("LazyArrayStore is read-only")
+
+    def __contains__(self, key) -> bool:
+        return key in self.metadata or self._chunk(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.metadata
+        for chunk in itertools.product(*(range(n) for n in self.grid)):
+            yield ".".join(str(i) for i in chunk)
+
+    def __len__(self) -> int:
+        return len(self.metadata) + int(np.prod(self.grid))
+
+
+def open_lazy_labels(data, chunks: Tuple[int, ...]) -> zarr.Array:
+    """
+    Returns a label image that can be edited without loading it
+
+    NumPy arrays and writable zarr arrays are returned as they are. Other
+    arrays, like dask arrays or read-only zarr arrays, are wrapped in a
+    zarr array whose unchanged chunks are read from them on access while
+    edited chunks are kept in memory, see CopyOnWriteStore.
+
+    Parameters
+    ----------
+    data : array
+        Label image, any array supporting slicing
+    chunks : tuple of int
+        Chunk shape used for arrays that are not zarr arrays
+
+    Returns
+    -------
+    np.ndarray or zarr.Array
+        Label image supporting in-place edits
+    """
+    if isinstance(data, np.ndarray):
+        return data
+    if isinstance(data, zarr.Array):
+        if not data.read_only:
+            return data
+        store = CopyOnWriteStore(data.store)
+        return zarr.open_array(store, path=data.path, mode="r+")
+    store = CopyOnWriteStore(LazyArrayStore(data, chunks))
+    return zarr.open_array(store, mode="r+")